@@ -0,0 +1,145 @@
+import sys
+import tempfile
+import time
+import unittest
+import uuid
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+import task_pool  # noqa: E402
+from admission import ResourceAdmission  # noqa: E402
+
+
+def _init_worker():
+    """The worker processes of the tests don't need a ONE instance"""
+
+
+def _fake_run_task(tdict, session_path):
+    """Records the start and end of the task in the log file of the test, the workers are separate processes"""
+    with open(tdict['log'], 'a') as f:
+        f.write(f"{tdict['id']} start {time.time()}\n")
+    time.sleep(.2)
+    with open(tdict['log'], 'a') as f:
+        f.write(f"{tdict['id']} end {time.time()}\n")
+    return [], False, .2
+
+
+class TestResourceAdmission(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.admission = ResourceAdmission(scratch_path=self.tdir.name, n_gpus=1)
+        self.admission.n_cpus = 16
+        # an idle server
+        self.measures = dict(ram_total=64, ram_available=60, disk_total=1000, disk_available=900, load=0.)
+        patcher = mock.patch.object(ResourceAdmission, 'measure', side_effect=lambda: self.measures)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _task(name, **kwargs):
+        return dict(id=str(uuid.uuid4()), name=name, **kwargs)
+
+    def _check(self, rule, tdict, running):
+        """Asserts that the task is held back because of the rule only"""
+        with self.assertLogs('ibllib', 'INFO') as log:
+            self.assertFalse(self.admission.admit(tdict, running))
+        self.assertIn(f'insufficient {rule}:', log.output[0])
+
+    def test_gpu(self):
+        running = [self._task('SpikeSorting')]
+        self.assertTrue(self.admission.admit(self._task('EphysVideoCompress'), running))
+        self._check('gpu', self._task('EphysDLC'), running)
+        self.assertTrue(self.admission.admit(self._task('EphysDLC'), []))
+
+    def test_cpu(self):
+        running = [self._task('EphysVideoCompress')]
+        self.assertTrue(self.admission.admit(self._task('VideoCompress'), running))
+        self._check('cpu', self._task('VideoCompress'), running * 2)
+        # a task requiring more cores than the server is capped
+        self.assertTrue(self.admission.admit(self._task('Huge', cpu=64), []))
+
+    def test_load(self):
+        self.measures['load'] = 15.9
+        self.assertTrue(self.admission.admit(self._task('TrainingVideoCompress'), []))
+        self.measures['load'] = 16.
+        self._check('load', self._task('TrainingVideoCompress'), [])
+
+    def test_ram(self):
+        # RAM available
+        self.measures['ram_available'] = 16
+        self.assertTrue(self.admission.admit(self._task('TrainingDLC'), []))
+        self.measures['ram_available'] = 15
+        self._check('ram', self._task('TrainingDLC'), [])
+        # RAM reserved by the running tasks, that may not have reached their peak usage
+        self.measures['ram_available'] = 60
+        self.assertTrue(self.admission.admit(self._task('Task', ram=16), [self._task('SpikeSorting')]))
+        self._check('ram', self._task('Task', ram=17), [self._task('SpikeSorting')])
+        # a task requiring more RAM than the server is capped
+        self.measures.update(ram_total=32, ram_available=30)
+        self.assertTrue(self.admission.admit(self._task('SpikeSorting'), []))
+
+    def test_disk(self):
+        self.measures['disk_available'] = 200
+        running = [self._task('TrainingVideoCompress')]
+        self.assertTrue(self.admission.admit(self._task('Task', disk=100), running))
+        self._check('disk', self._task('Task', disk=101), running)
+        # with nothing running, the task gets the free space
+        self.assertTrue(self.admission.admit(self._task('SpikeSorting'), []))
+        # the scratch space reserved by the running tasks
+        self.measures['disk_available'] = 900
+        self._check('disk', self._task('EphysVideoCompress'), [self._task('Task', disk=450)] * 2)
+
+    def test_log_once(self):
+        tdict = self._task('TrainingVideoCompress')
+        self.measures['load'] = 20.
+        with self.assertLogs('ibllib', 'DEBUG') as log:
+            self.assertFalse(self.admission.admit(tdict, []))
+            self.assertFalse(self.admission.admit(tdict, []))
+        self.assertEqual([r.levelname for r in log.records], ['INFO', 'DEBUG'])
+
+
+class TestAdmissionInPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.log = Path(self.tdir.name).joinpath('tasks.log')
+        self.log.touch()
+        self.session_paths = {}
+        measures = dict(ram_total=64, ram_available=60, disk_total=1000, disk_available=900, load=0.)
+        for patcher in (mock.patch.object(task_pool, '_init_worker', _init_worker),
+                        mock.patch.object(task_pool, '_run_task', _fake_run_task),
+                        mock.patch.object(task_pool, 'resolve_session_paths', lambda *args: self.session_paths),
+                        mock.patch.object(task_pool, 'ADMISSION_INTERVAL', .05),
+                        mock.patch.object(ResourceAdmission, 'measure', return_value=measures)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _task(self, name):
+        tdict = dict(id=str(uuid.uuid4()), name=name, parents=[], session=str(uuid.uuid4()), log=str(self.log))
+        self.session_paths[tdict['session']] = Path(self.tdir.name).joinpath(tdict['session'])
+        return tdict
+
+    def test_deferred_tasks_run(self):
+        """The tasks held back stay in the queue and are started once the resources are released"""
+        tasks = [self._task('SpikeSorting'), self._task('EphysDLC'), self._task('TrainingVideoCompress')]
+        admission = ResourceAdmission(scratch_path=self.tdir.name, n_gpus=1)
+        admission.n_cpus = 16
+        with self.assertLogs('ibllib', 'INFO'):
+            task_pool.run_tasks_parallel(self.tdir.name, tasks, one=mock.MagicMock(), n_workers=3,
+                                         admit=admission.admit)
+        times = {}
+        for line in self.log.read_text().splitlines():
+            tid, event, t = line.split()
+            times[tid, event] = float(t)
+        self.assertEqual(len(times), 6)
+        # the GPU task is deferred until the first one ends, the CPU task isn't
+        self.assertGreaterEqual(times[tasks[1]['id'], 'start'], times[tasks[0]['id'], 'end'])
+        self.assertLess(times[tasks[2]['id'], 'start'], times[tasks[0]['id'], 'end'])
+
+
+if __name__ == '__main__':
+    unittest.main()
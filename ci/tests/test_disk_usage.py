@@ -0,0 +1,97 @@
+from contextlib import closing
+import os
+import sys
+import tempfile
+import unittest
+from datetime import date, timedelta
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+import disk_usage  # noqa: E402
+import local_db  # noqa: E402
+from file_index import FileIndex  # noqa: E402
+
+GB = 1024 ** 3
+RECENT = str(date.today() - timedelta(days=10))
+OLD = str(date.today() - timedelta(days=400))
+
+
+class TestUsageSummary(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        patcher = mock.patch.object(local_db, 'STATE_DIR', Path(self.tdir.name).joinpath('state'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.root = Path(self.tdir.name).joinpath('Subjects')
+        # sparse files, the usage is computed from the file sizes
+        self._file(f'SW001/{OLD}/001/raw_ephys_data/probe00/_spikeglx_ephysData_g0_t0.imec0.ap.cbin', 2 * GB)
+        self._file(f'SW001/{OLD}/001/alf/probe00/spikes.times.npy', GB // 2)
+        self._file(f'SW001/{RECENT}/001/raw_video_data/_iblrig_leftCamera.raw.mp4', GB)
+        self._file(f'SW002/{RECENT}/002/raw_video_data/_iblrig_leftCamera.raw.mp4', GB)
+        self._file(f'SW002/{RECENT}/002/raw_photometry_data/raw_photometry.csv', GB // 10)
+        self._file(f'SW003/{RECENT}/001/raw_behavior_data/_iblrig_taskData.raw.jsonable', GB // 10)
+
+    def _file(self, relative_path, size):
+        file = self.root.joinpath(relative_path)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        with open(file, 'wb') as f:
+            f.truncate(size)
+        return file
+
+    @staticmethod
+    def _total(usage_by):
+        return round(sum(usage_by.values()), 1)
+
+    def test_usage_summary(self):
+        # the first build of the index is left to the maintenance sweep
+        with self.assertLogs('ibllib', 'INFO'):
+            self.assertIsNone(disk_usage.usage_summary(self.root))
+        with closing(FileIndex(self.root)) as index, self.assertLogs('ibllib', 'INFO'):
+            index.refresh()
+        usage = disk_usage.usage_summary(self.root)
+        self.assertEqual(usage['usage_by_subject'], {'SW001': 3.5, 'SW002': 1.1, 'SW003': .1})
+        self.assertEqual(usage['usage_by_collection'],
+                         {'raw_ephys_data': 2., 'raw_video_data': 2., 'alf': .5, 'other': .1, 'raw_behavior_data': .1})
+        self.assertEqual(usage['usage_by_age'], {'1-2y': 2.5, '<30d': 2.2})
+        # the lab total, i.e. the Subjects folder, is the same for all the groupings
+        for key in ('usage_by_subject', 'usage_by_collection', 'usage_by_age'):
+            self.assertEqual(self._total(usage[key]), 4.7)
+        # the largest subjects only
+        self.assertEqual(list(disk_usage.usage_summary(self.root, n_subjects=1)['usage_by_subject']), ['SW001'])
+
+        # files added and removed: the index is used as is until it is older than max_age
+        self.root.joinpath(f'SW001/{OLD}/001/raw_ephys_data/probe00/_spikeglx_ephysData_g0_t0.imec0.ap.cbin').unlink()
+        self._file(f'SW004/{RECENT}/001/raw_video_data/_iblrig_bodyCamera.raw.mp4', 3 * GB)
+        self._file(f'SW002/{OLD}/001/spike_sorters/ks2_matlab/probe00/_kilosort_raw.output.tar', GB)
+        self.assertEqual(disk_usage.usage_summary(self.root)['usage_by_subject'], usage['usage_by_subject'])
+        with self.assertLogs('ibllib', 'INFO'):
+            usage = disk_usage.usage_summary(self.root, max_age=0)
+        self.assertEqual(usage['usage_by_subject'], {'SW004': 3., 'SW002': 2.1, 'SW001': 1.5, 'SW003': .1})
+        self.assertEqual(usage['usage_by_collection'], {'raw_video_data': 5., 'spike_sorters': 1., 'alf': .5,
+                                                        'other': .1, 'raw_behavior_data': .1})
+        self.assertEqual(usage['usage_by_age'], {'<30d': 5.2, '1-2y': 1.5})
+        for key in ('usage_by_subject', 'usage_by_collection', 'usage_by_age'):
+            self.assertEqual(self._total(usage[key]), 6.7)
+
+    def test_report_usage(self):
+        one = mock.MagicMock()
+        one.alyx.rest.return_value = [{'name': 'mainenlab_SR'}]
+        with mock.patch.object(disk_usage, 'get_local_endpoint_id', return_value='endpoint-id'):
+            with self.assertLogs('ibllib', 'INFO'):
+                self.assertIsNone(disk_usage.report_usage(one, root_path=self.root))
+            one.alyx.json_field_update.assert_not_called()
+            with closing(FileIndex(self.root)) as index, self.assertLogs('ibllib', 'INFO'):
+                index.refresh()
+            usage = disk_usage.report_usage(one, root_path=self.root)
+        one.alyx.rest.assert_called_once_with('data-repository', 'list', globus_endpoint_id='endpoint-id')
+        one.alyx.json_field_update.assert_called_once_with(endpoint='data-repository', uuid='mainenlab_SR',
+                                                           field_name='json', data=usage)
+        self.assertEqual(self._total(usage['usage_by_subject']), 4.7)
+        self.assertTrue(os.path.exists(local_db.STATE_DIR.joinpath('file_index.sqlite')))
+
+
+if __name__ == '__main__':
+    unittest.main()
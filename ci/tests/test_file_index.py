@@ -0,0 +1,89 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+from file_index import FileIndex, _subtree  # noqa: E402
+
+
+class TestFileIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.db_file = Path(self.tdir.name).joinpath('file_index.sqlite')
+        self.root = Path(self.tdir.name).joinpath('Subjects')
+        # sibling subjects whose names sort next to SW001 and contain LIKE / GLOB wildcards
+        for subject in ('SW001', 'SW001_b', 'SW001-b', 'SW001%', 'SW0010'):
+            for number in ('001', '002'):
+                folder = self.root.joinpath(subject, '2023-01-01', number, 'alf')
+                folder.mkdir(parents=True)
+                folder.joinpath('spikes.times.npy').write_bytes(b'0' * 10)
+        self.index = FileIndex(self.root, db_file=self.db_file)
+        self.addCleanup(self.index.close)
+
+    def _touch(self, folder, file_name, size=10):
+        """Adds a file and makes sure the folder mtime changes, even on coarse grained file systems"""
+        mtime = folder.stat().st_mtime
+        folder.joinpath(file_name).write_bytes(b'0' * size)
+        os.utime(folder, (mtime + 1, mtime + 1))
+
+    def test_incremental_refresh(self):
+        self.assertIsNone(self.index.last_refresh)
+        n_dirs = 1 + 5 * 6  # root, then subject, date, 2 numbers and 2 alf folders per subject
+        stats = self.index.refresh()
+        self.assertEqual((stats['checked'], stats['listed']), (n_dirs, n_dirs))
+        self.assertIsNotNone(self.index.last_refresh)
+        self.assertEqual(len(list(self.index.rglob('spikes.times.npy'))), 10)
+        # nothing changed: all the folders are checked, none is listed
+        stats = self.index.refresh()
+        self.assertEqual((stats['checked'], stats['listed']), (n_dirs, 0))
+        # a new file: only its folder is listed again
+        alf = self.root.joinpath('SW001', '2023-01-01', '001', 'alf')
+        self._touch(alf, 'clusters.depths.npy', size=5)
+        stats = self.index.refresh()
+        self.assertEqual(stats['listed'], 1)
+        self.assertEqual(list(self.index.rglob('clusters.*.npy')), [alf.joinpath('clusters.depths.npy')])
+        self.assertEqual(self.index.files_in(alf)[0][1] + self.index.files_in(alf)[1][1], 15)
+        usage = {r['subject']: (r['n_files'], r['size']) for r in self.index.usage('subject')}
+        self.assertEqual(usage['SW001'], (3, 25))
+        # a removed session: its files and its usage are removed with it
+        date_folder = self.root.joinpath('SW001', '2023-01-01')
+        mtime = date_folder.stat().st_mtime
+        shutil.rmtree(date_folder.joinpath('002'))
+        os.utime(date_folder, (mtime + 1, mtime + 1))
+        self.index.refresh()
+        self.assertEqual(len(list(self.index.rglob('spikes.times.npy', check_exists=False))), 9)
+        usage = {r['subject']: (r['n_files'], r['size']) for r in self.index.usage('subject')}
+        self.assertEqual(usage['SW001'], (2, 15))
+        self.assertEqual(sum(n for n, _ in usage.values()), 10)
+        # the rollups kept up to date match the ones rebuilt from the files
+        self.index.rebuild_usage()
+        self.assertEqual({r['subject']: (r['n_files'], r['size']) for r in self.index.usage('subject')}, usage)
+
+    def test_subtree(self):
+        lo, hi = _subtree('/data/SW001')
+        inside = ['/data/SW001/2023-01-01', '/data/SW001/a/b/c']
+        outside = ['/data/SW001', '/data/SW001_b/x', '/data/SW001-b/x', '/data/SW001%/x', '/data/SW0010/x',
+                   '/data/SW002/x', '/data/SW001.b']
+        self.assertTrue(all(lo <= p < hi for p in inside))
+        self.assertFalse(any(lo <= p < hi for p in outside))
+        # an index of a subject only returns its files, not the ones of the siblings in the same database
+        self.index.refresh()
+        subject_index = FileIndex(self.root.joinpath('SW001'), db_file=self.db_file)
+        self.addCleanup(subject_index.close)
+        files = list(subject_index.rglob('spikes.times.npy'))
+        self.assertEqual(len(files), 2)
+        self.assertTrue(all(f.relative_to(self.root).parts[0] == 'SW001' for f in files))
+        self.assertEqual(len(subject_index.stat('spikes.times.npy')), 2)
+        # the wildcards of a subject name are not interpreted
+        wildcard_index = FileIndex(self.root.joinpath('SW001%'), db_file=self.db_file)
+        self.addCleanup(wildcard_index.close)
+        self.assertEqual(len(list(wildcard_index.rglob('*.npy'))), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
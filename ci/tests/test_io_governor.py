@@ -0,0 +1,116 @@
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+import io_governor  # noqa: E402
+from io_governor import IOGovernor  # noqa: E402
+
+MB = 1024 ** 2
+
+
+class FakeClock:
+    """Stands in for the time module of the governor, sleeping advances the clock"""
+    def __init__(self):
+        self.now = 1e9
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestIOGovernor(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(io_governor, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+
+    def test_token_bucket(self):
+        governor = IOGovernor(rate=10, burst=20)
+        # the burst is spent without waiting, the excess is paid at the rate
+        governor.throttle(20 * MB)
+        self.assertEqual(self.clock.sleeps, [])
+        governor.throttle(5 * MB)
+        self.assertAlmostEqual(self.clock.sleeps[-1], .5)
+        # the bucket refills at the rate
+        self.clock.now += 1
+        governor.throttle(10 * MB)
+        self.assertEqual(len(self.clock.sleeps), 1)
+        # up to the burst only, however long the idle period
+        self.clock.now += 3600
+        governor.throttle(20 * MB)
+        self.assertEqual(len(self.clock.sleeps), 1)
+        governor.throttle(1 * MB)
+        self.assertAlmostEqual(self.clock.sleeps[-1], .1)
+        self.assertEqual(governor.stats['ops'], 5)
+        self.assertEqual(governor.stats['throttled'], 2)
+        self.assertAlmostEqual(governor.stats['wait_time'], .6)
+        # a charge larger than the burst is allowed and paid by the next waits
+        governor = IOGovernor(rate=10)
+        governor.throttle(30 * MB)
+        self.assertAlmostEqual(self.clock.sleeps[-1], 2)
+
+    def test_unlimited(self):
+        governor = IOGovernor(rate=0)
+        for _ in range(10):
+            governor.throttle(1024 * MB)
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertEqual(governor.stats['bytes'], 10240 * MB)
+
+    def test_shared_budget(self):
+        budget_file = Path(self.tdir.name).joinpath('io_budget')
+        first, second = (IOGovernor(rate=10, budget_file=budget_file) for _ in range(2))
+        first.throttle(10 * MB)
+        self.assertEqual(self.clock.sleeps, [])
+        # the second governor draws from the bucket emptied by the first one
+        second.throttle(5 * MB)
+        self.assertAlmostEqual(self.clock.sleeps[-1], .5)
+        first.throttle(5 * MB)
+        self.assertAlmostEqual(self.clock.sleeps[-1], .5)
+        # a governor with its own budget is not affected
+        IOGovernor(rate=10, budget_file=Path(self.tdir.name).joinpath('other_budget')).throttle(10 * MB)
+        self.assertEqual(len(self.clock.sleeps), 2)
+
+    def test_open(self):
+        governor = IOGovernor(rate=10)
+        file = Path(self.tdir.name).joinpath('data.bin')
+        with governor.open(file, 'wb') as f:
+            f.write(b'0' * 5 * MB)
+            f.write(b'0' * 10 * MB)
+            self.assertEqual(f.tell(), 15 * MB)
+        self.assertTrue(f.closed)
+        self.assertEqual(file.stat().st_size, 15 * MB)
+        self.assertEqual(governor.stats['ops'], 2)
+        self.assertAlmostEqual(sum(self.clock.sleeps), .5)
+
+    def test_idle_priority(self):
+        with mock.patch.object(io_governor.shutil, 'which', return_value=None), \
+                self.assertLogs('ibllib', 'WARNING'):
+            self.assertFalse(io_governor.set_idle_priority())
+            self.assertFalse(IOGovernor(idle=True).idle)
+        failed = subprocess.CompletedProcess([], 1, stdout='', stderr='ionice: Operation not permitted')
+        with mock.patch.object(io_governor.shutil, 'which', return_value='/usr/bin/ionice'), \
+                mock.patch.object(io_governor.subprocess, 'run', return_value=failed) as run, \
+                self.assertLogs('ibllib', 'WARNING'):
+            self.assertFalse(io_governor.set_idle_priority(pid=1234))
+        self.assertEqual(run.call_args[0][0], ['ionice', '-c3', '-p', '1234'])
+        done = subprocess.CompletedProcess([], 0, stdout='', stderr='')
+        with mock.patch.object(io_governor.shutil, 'which', return_value='/usr/bin/ionice'), \
+                mock.patch.object(io_governor.subprocess, 'run', return_value=done):
+            self.assertTrue(IOGovernor(idle=True).idle)
+        self.assertFalse(IOGovernor(idle=False).idle)
+
+
+if __name__ == '__main__':
+    unittest.main()
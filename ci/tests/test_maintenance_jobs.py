@@ -0,0 +1,163 @@
+import sys
+import tarfile
+import tempfile
+import unittest
+import uuid
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+import io_governor  # noqa: E402
+import local_db  # noqa: E402
+import maintenance_jobs  # noqa: E402
+import reclaim  # noqa: E402
+from checkpoints import Checkpoints  # noqa: E402
+
+
+class FakeAlyx:
+    """Datasets endpoint of Alyx, the bulk query of the sessions can be made to fail"""
+    def __init__(self, registered, bulk_fails=False):
+        self.registered = registered  # list of (eid, probe)
+        self.bulk_fails = bulk_fails
+        self.queries = []
+
+    def rest(self, url, action, name=None, session=None, django=None):
+        assert (url, action, name) == ('datasets', 'list', '_kilosort_raw.output.tar')
+        self.queries.append(django or session)
+        if django is not None:
+            if self.bulk_fails:
+                raise RuntimeError('URI too long')
+            eids = django.split(',', 1)[1]
+            return [self._dataset(eid, probe) for eid, probe in self.registered if eid in eids]
+        return [self._dataset(eid, probe) for eid, probe in self.registered if eid == session]
+
+    @staticmethod
+    def _dataset(eid, probe):
+        return {'session': f'https://alyx.internationalbrainlab.org/sessions/{eid}',
+                'collection': f'alf/{probe}', 'name': '_kilosort_raw.output.tar'}
+
+
+class TestUploadKs2Output(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.root = Path(self.tdir.name).joinpath('Subjects')
+        for patcher in (mock.patch.object(local_db, 'STATE_DIR', Path(self.tdir.name).joinpath('state')),
+                        mock.patch.object(io_governor, '_governor', io_governor.IOGovernor(rate=0))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _ks2_output(self, session, probe):
+        ks2_path = self.root.joinpath(session, 'spike_sorters', 'ks2_matlab', probe)
+        ks2_path.mkdir(parents=True)
+        for fn in reclaim.KS2_OUTPUT[:4] + ['spike_sorting_ks2.log', 'temp_wh.dat']:
+            ks2_path.joinpath(fn).write_bytes(fn.encode() * 100)
+        return ks2_path
+
+    def _upload(self, sessions, registered=(), volume=(1000,), n_workers=2):
+        """Runs upload_ks2_output on the ks2 outputs of the sessions
+        :param sessions: dict {session: eid}
+        :param volume: available disk space returned by the successive checks, the last one repeated
+        :return: the mocked register_dataset
+        """
+        volume = list(volume)
+        self.one = mock.MagicMock()
+        self.one.alyx = FakeAlyx(list(registered))
+        resolver = mock.MagicMock()
+        resolver.return_value.resolve.side_effect = lambda paths: {
+            p: sessions[str(p.relative_to(self.root))] for p in paths}
+        logs = sorted(self.root.rglob('spike_sorting_ks2.log'))
+        with mock.patch.object(maintenance_jobs, 'ONE', return_value=self.one), \
+                mock.patch.object(maintenance_jobs, 'SessionResolver', resolver), \
+                mock.patch.object(maintenance_jobs, '_rglob', return_value=logs), \
+                mock.patch.object(maintenance_jobs, '_get_volume_usage', side_effect=lambda *args: {
+                    'disk_available': volume.pop(0) if len(volume) > 1 else volume[0]}), \
+                mock.patch.object(maintenance_jobs, 'register_dataset') as register_dataset:
+            maintenance_jobs.upload_ks2_output(n_workers=n_workers)
+        return register_dataset
+
+    def test_ks2_to_tar(self):
+        ks2_path = self._ks2_output('SW001/2023-01-01/001', 'probe00')
+        out_file = ks2_path.joinpath('_kilosort_raw.output.tar')
+        self.assertEqual(maintenance_jobs._ks2_to_tar(ks2_path, ks2_path), [out_file])
+        with tarfile.open(out_file) as tar:
+            self.assertEqual(sorted(tar.getnames()), sorted(reclaim.KS2_OUTPUT[:4] + ['spike_sorting_ks2.log']))
+        self.assertFalse(out_file.with_suffix('.tar.part').exists())
+        # an existing tar is not written again
+        mtime = out_file.stat().st_mtime_ns
+        self.assertEqual(maintenance_jobs._ks2_to_tar(ks2_path, ks2_path), [out_file])
+        self.assertEqual(out_file.stat().st_mtime_ns, mtime)
+        # a tar interrupted is left as a part file, that is overwritten by the next attempt
+        out_file.unlink()
+        with mock.patch.object(tarfile.TarFile, 'add', side_effect=OSError('No space left on device')), \
+                self.assertRaises(OSError):
+            maintenance_jobs._ks2_to_tar(ks2_path, ks2_path)
+        self.assertFalse(out_file.exists())
+        self.assertTrue(out_file.with_suffix('.tar.part').exists())
+        maintenance_jobs._ks2_to_tar(ks2_path, ks2_path)
+        self.assertTrue(out_file.exists())
+        self.assertFalse(out_file.with_suffix('.tar.part').exists())
+
+    def test_registered_ks2_tars(self):
+        eids = [str(uuid.uuid4()) for _ in range(5)]
+        alyx = FakeAlyx([(eids[0], 'probe00'), (eids[0], 'probe01'), (eids[3], 'probe00')])
+        one = mock.MagicMock(alyx=alyx)
+        expected = {(eids[0], 'probe00'), (eids[0], 'probe01'), (eids[3], 'probe00')}
+        with mock.patch.object(maintenance_jobs, 'REST_BATCH_SIZE', 2):
+            self.assertEqual(maintenance_jobs._registered_ks2_tars(one, eids), expected)
+            # one query per batch of sessions
+            self.assertEqual(len(alyx.queries), 3)
+            self.assertTrue(all(q.startswith('session__in,') for q in alyx.queries))
+            # when the bulk query fails, the sessions of the batch are queried one by one
+            alyx.bulk_fails, alyx.queries = True, []
+            with self.assertLogs('ibllib', 'WARNING'):
+                self.assertEqual(maintenance_jobs._registered_ks2_tars(one, eids), expected)
+        self.assertEqual(alyx.queries[1:3], eids[:2])
+        self.assertEqual(len(alyx.queries), 8)
+
+    def test_upload(self):
+        sessions = {'SW001/2023-01-01/001': str(uuid.uuid4()),
+                    'SW001/2023-01-02/001': str(uuid.uuid4()),
+                    'SW002/2023-01-01/001': None}
+        new = [self._ks2_output('SW001/2023-01-01/001', probe) for probe in ('probe00', 'probe01')]
+        # tarred and registered by the spike sorting task, but not checkpointed
+        done = self._ks2_output('SW001/2023-01-02/001', 'probe00')
+        maintenance_jobs._ks2_to_tar(done, done)
+        # not on Alyx
+        unknown = self._ks2_output('SW002/2023-01-01/001', 'probe00')
+        register_dataset = self._upload(sessions, registered=[(sessions['SW001/2023-01-02/001'], 'probe00')])
+        # the already registered sessions are found in a single query
+        self.assertEqual(len(self.one.alyx.queries), 1)
+        # the probes of the session are registered in a single call
+        register_dataset.assert_called_once()
+        self.assertEqual(sorted(register_dataset.call_args[0][0]),
+                         [p.joinpath('_kilosort_raw.output.tar') for p in new])
+        self.assertFalse(unknown.joinpath('_kilosort_raw.output.tar').exists())
+        checkpoints = Checkpoints('upload_ks2_output')
+        self.addCleanup(checkpoints.close)
+        self.assertEqual(sorted(checkpoints._keys), sorted(map(str, new + [done])))
+        # the probes checkpointed are skipped by the next run
+        register_dataset = self._upload(sessions)
+        register_dataset.assert_not_called()
+
+    def test_disk_full(self):
+        sessions = {'SW001/2023-01-01/001': str(uuid.uuid4())}
+        ks2_paths = [self._ks2_output('SW001/2023-01-01/001', probe) for probe in ('probe00', 'probe01', 'probe02')]
+        register_dataset = self._upload(sessions, volume=[100])
+        register_dataset.assert_not_called()
+        # nothing is queried when the disk is full from the start
+        self.assertEqual(self.one.alyx.queries, [])
+        # the disk fills up after the first tar: the probes tarred are still registered
+        with self.assertLogs('ibllib', 'WARNING'):
+            register_dataset = self._upload(sessions, volume=[1000, 1000, 100], n_workers=1)
+        register_dataset.assert_called_once_with([ks2_paths[0].joinpath('_kilosort_raw.output.tar')], one=self.one)
+        self.assertFalse(ks2_paths[1].joinpath('_kilosort_raw.output.tar').exists())
+        # the next run resumes with the remaining probes
+        register_dataset = self._upload(sessions)
+        self.assertEqual(sorted(register_dataset.call_args[0][0]),
+                         [p.joinpath('_kilosort_raw.output.tar') for p in ks2_paths[1:]])
+
+
+if __name__ == '__main__':
+    unittest.main()
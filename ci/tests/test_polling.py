@@ -0,0 +1,101 @@
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+import polling  # noqa: E402
+from polling import AdaptiveBackoff, send_wake, wait_for_wake  # noqa: E402
+
+
+class FakeClock:
+    """Stands in for the time module of the polling, sleeping advances the clock"""
+    def __init__(self):
+        self.now = 1e9
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestAdaptiveBackoff(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        patcher = mock.patch.object(polling.local_db, 'STATE_DIR', Path(self.tdir.name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_backoff(self):
+        backoff = AdaptiveBackoff('small_jobs', min_sleep=30, max_sleep=300)
+        # the sleep time doubles on each idle poll, up to the cap
+        self.assertEqual([backoff.idle() for _ in range(7)], [30, 60, 120, 240, 300, 300, 300])
+        # the state is persisted for the next run of the runner script
+        self.assertEqual(AdaptiveBackoff('small_jobs', min_sleep=30, max_sleep=300).idle(), 300)
+        self.assertEqual(AdaptiveBackoff('large_jobs', min_sleep=30, max_sleep=300).idle(), 30)
+        # activity resets the sleep time
+        backoff.reset()
+        self.assertEqual(backoff.idle(), 30)
+        self.assertEqual(AdaptiveBackoff('small_jobs', min_sleep=30, max_sleep=300).idle(), 60)
+
+    def test_corrupted_state(self):
+        Path(self.tdir.name).joinpath('small_jobs.backoff.json').write_text('{"sleep')
+        self.assertEqual(AdaptiveBackoff('small_jobs').idle(), polling.MIN_SLEEP)
+
+
+class TestWaitForWake(unittest.TestCase):
+
+    def setUp(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.bind(('localhost', 0))
+            self.port = s.getsockname()[1]
+
+    def _send_later(self, *messages, delay=.1):
+        def send():
+            time.sleep(delay)
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                for message in messages:
+                    s.sendto(message, ('localhost', self.port))
+        thread = threading.Thread(target=send, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def test_timeout(self):
+        t0 = time.time()
+        self.assertFalse(wait_for_wake(self.port, .2))
+        self.assertGreaterEqual(time.time() - t0, .2)
+
+    def test_wake(self):
+        # the other messages don't interrupt the sleep
+        self._send_later(b'CHECK', b'WAKE')
+        t0 = time.time()
+        # the clock doesn't advance: only the wake up message can end the sleep
+        with mock.patch.object(polling, 'time', FakeClock()), self.assertLogs('ibllib', 'INFO'):
+            self.assertTrue(wait_for_wake(self.port, 3600))
+        self.assertLess(time.time() - t0, 5)
+        # the port is released, the next sleep is woken up by the create job
+        threading.Timer(.1, send_wake, args=(self.port,)).start()
+        with self.assertLogs('ibllib', 'INFO'):
+            self.assertTrue(wait_for_wake(self.port, 30))
+
+    def test_port_in_use(self):
+        clock = FakeClock()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s, \
+                mock.patch.object(polling, 'time', clock), \
+                self.assertLogs('ibllib', 'WARNING'):
+            s.bind(('localhost', self.port))
+            self.assertFalse(wait_for_wake(self.port, 600))
+        self.assertEqual(clock.sleeps, [600])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import sys
+import tempfile
+import unittest
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+from queue_mirror import TaskQueueMirror  # noqa: E402
+
+
+class FakeAlyx:
+    """Local stand-in of the Alyx tasks REST endpoint, supporting the filters used by the mirror"""
+    def __init__(self):
+        self.tasks = {}
+        self.clock = datetime(2023, 1, 1)
+        self.n_requests = 0
+
+    def add(self, name, status='Waiting', priority=90, executable='ibllib.pipes.Small'):
+        tid = str(uuid.uuid4())
+        self.tasks[tid] = {'id': tid, 'name': name, 'priority': priority, 'executable': executable,
+                           'session': str(uuid.uuid4()), 'parents': []}
+        self.update(tid, status)
+        return tid
+
+    def update(self, tid, status):
+        self.clock += timedelta(seconds=1)
+        self.tasks[tid].update(status=status, datetime=self.clock.isoformat())
+
+    def rest(self, url, action, status=None, django='', no_cache=False):
+        assert (url, action) == ('tasks', 'list')
+        self.n_requests += 1
+        fields = django.split(',')
+        filters = dict(zip(fields[::2], fields[1::2]))
+        tasks = self.tasks.values()
+        if status:
+            tasks = [t for t in tasks if t['status'] == status]
+        if 'datetime__gte' in filters:
+            tasks = [t for t in tasks if t['datetime'] >= filters['datetime__gte']]
+        return [dict(t) for t in tasks]
+
+
+class TestTaskQueueMirror(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.alyx = FakeAlyx()
+        self.mirror = TaskQueueMirror(
+            self.alyx, ['cortexlab'], 'cortexlab_SR', db_file=Path(self.tempdir.name).joinpath('tasks.sqlite'),
+            job_size=lambda executable: 'large' if executable.endswith('Large') else 'small')
+
+    def tearDown(self):
+        self.mirror.close()
+        self.tempdir.cleanup()
+
+    def test_incremental_sync(self):
+        self.alyx.add('TrainingRegisterRaw', status='Complete')
+        t1 = self.alyx.add('TrainingTrials', priority=90)
+        t2 = self.alyx.add('SpikeSorting', priority=60, executable='ibllib.pipes.Large')
+        self.assertEqual(self.mirror.sync(), 2)
+        self.assertEqual([t['id'] for t in self.mirror.waiting_tasks()], [t1, t2])
+        self.assertEqual([t['id'] for t in self.mirror.waiting_tasks('small')], [t1])
+        self.assertEqual([t['id'] for t in self.mirror.waiting_tasks('large')], [t2])
+
+        # only the tasks modified since the last sync are pulled, plus the last task of the previous sync
+        self.alyx.update(t1, 'Complete')
+        t3 = self.alyx.add('TrainingStatus', priority=100)
+        self.assertEqual(self.mirror.sync(), 3)
+        self.assertEqual([t['id'] for t in self.mirror.waiting_tasks()], [t3, t2])
+        # the tasks that are not waiting anymore are removed from the mirror
+        self.assertEqual(self.mirror.con.execute('SELECT COUNT(*) FROM tasks').fetchone()[0], 2)
+
+        # the tasks deleted from Alyx are forgotten on full sync
+        self.alyx.tasks.pop(t2)
+        self.mirror.sync(full=True)
+        self.assertEqual([t['id'] for t in self.mirror.waiting_tasks()], [t3])
+
+    def test_unknown_job_size(self):
+        def job_size(executable):
+            raise ImportError(executable)
+        self.mirror.job_size = job_size
+        tid = self.alyx.add('NewTask')
+        self.mirror.sync()
+        self.assertEqual([t['id'] for t in self.mirror.waiting_tasks('large')], [tid])
+
+
+if __name__ == '__main__':
+    unittest.main()
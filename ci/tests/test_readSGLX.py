@@ -0,0 +1,192 @@
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'ephys', 'DemoReadSGLXData')))
+import readSGLX  # noqa: E402
+
+try:
+    import mtscomp
+except ImportError:
+    mtscomp = None
+
+IMEC_META = """typeThis=imec
+imSampRate=30000
+imAiRangeMax=0.6
+nSavedChans=5
+fileSizeBytes=10000
+snsApLfSy=4,0,1
+snsSaveChanSubset=0:2,5,768
+~imroTbl=(0,384){}
+""".format(''.join(f'({i} 0 0 {500 if i % 2 else 250} 125 1)' for i in range(384)))
+
+
+class TestSGLXMeta(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.bin_file = Path(self.tdir.name).joinpath('probe_g0_t0.imec.ap.bin')
+        self.bin_file.with_suffix('.meta').write_text(IMEC_META)
+
+    def tearDown(self):
+        self.tdir.cleanup()
+
+    def test_parse(self):
+        meta = readSGLX.readMeta(self.bin_file)
+        self.assertEqual(meta['typeThis'], 'imec')
+        self.assertIn('imroTbl', meta)
+        self.assertEqual(readSGLX.SampRate(meta), 30000.)
+        self.assertEqual(readSGLX.ChannelCountsIM(meta), (4, 0, 1))
+        np.testing.assert_array_equal(readSGLX.OriginalChans(meta), [0, 1, 2, 5, 768])
+        APgain, LFgain = readSGLX.ChanGainsIM(meta)
+        self.assertEqual(APgain.shape, (384,))
+        np.testing.assert_array_equal(APgain[:4], [250, 500, 250, 500])
+        np.testing.assert_array_equal(LFgain, 125)
+        # the helpers still accept a plain dictionary of strings
+        np.testing.assert_array_equal(readSGLX.OriginalChans(dict(meta)), meta.originalChans)
+
+    def test_cache(self):
+        meta = readSGLX.readMeta(self.bin_file)
+        self.assertIs(readSGLX.readMeta(self.bin_file), meta)
+        self.assertIs(meta.originalChans, meta.originalChans)
+        self.assertFalse(meta.originalChans.flags.writeable)
+        # a modified meta file is parsed again
+        time.sleep(0.01)
+        self.bin_file.with_suffix('.meta').write_text(IMEC_META.replace('imSampRate=30000', 'imSampRate=30000.25'))
+        self.assertEqual(readSGLX.readMeta(self.bin_file).sampRate, 30000.25)
+
+    def test_gain_correct_chunks(self):
+        meta = readSGLX.readMeta(self.bin_file)
+        np.random.default_rng(0).integers(-2000, 2000, (meta.nFileSamp, 5), dtype=np.int16).tofile(self.bin_file)
+        raw = readSGLX.makeMemMapRaw(self.bin_file, meta)
+        chans = [0, 1, 3, 4]
+        expected = readSGLX.GainCorrectIM(raw[chans, 5:900], chans, meta)
+        # AP channels are divided by their gain, the sync channel is left as is
+        np.testing.assert_allclose(expected[-1], raw[4, 5:900] * 1.)
+        np.testing.assert_allclose(expected[0], raw[0, 5:900] * 0.6 / 512 / 250)
+        out = np.empty((len(chans), 256), dtype=np.float32)
+        chunks = [c.copy() for c in readSGLX.GainCorrectChunks(raw, chans, 5, 899, meta, chunkSamp=256, out=out)]
+        self.assertEqual([c.shape[1] for c in chunks], [256, 256, 256, 127])
+        self.assertTrue(all(c.dtype == np.float32 for c in chunks))
+        np.testing.assert_allclose(np.concatenate(chunks, axis=1), expected, rtol=1e-6)
+        del raw
+
+
+class TestExtractDigitalEdges(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.bin_file = Path(self.tdir.name).joinpath('sync_g0_t0.nidq.bin')
+        n_samples, n_chans = 10000, 3
+        rng = np.random.default_rng(42)
+        # sparse random transitions on each of the 16 lines of the digital word
+        bits = np.cumsum(rng.random((n_samples, 16)) < 0.01, axis=0) % 2
+        data = rng.integers(-1000, 1000, (n_samples, n_chans), dtype=np.int16)
+        data[:, -1] = (bits << np.arange(16)).sum(axis=1).astype(np.uint16).view(np.int16)
+        data.tofile(self.bin_file)
+        self.bin_file.with_suffix('.meta').write_text(
+            f'typeThis=nidq\nniSampRate=25000\nnSavedChans={n_chans}\nfileSizeBytes={data.nbytes}\n'
+            'snsMnMaXaDw=0,0,2,1\nsnsSaveChanSubset=all\n')
+
+    def tearDown(self):
+        self.tdir.cleanup()
+
+    def test_against_extract_digital(self):
+        meta = readSGLX.readMeta(self.bin_file)
+        raw = readSGLX.makeMemMapRaw(self.bin_file, meta)
+        lines = [0, 3, 6, 15]
+        first, last = 17, meta.nFileSamp - 1
+        dig = readSGLX.ExtractDigital(raw, first, last, 0, lines, meta).astype(int)
+        iLine, iSamp = np.nonzero(np.diff(dig, axis=1))
+        order = np.lexsort((iLine, iSamp))
+        expected = (iSamp[order] + first + 1, np.array(lines)[iLine[order]], np.diff(dig, axis=1)[iLine, iSamp][order])
+        # small blocks, so that transitions fall on the block boundaries
+        for chunk_samp in (1, 100, 1000, 2 ** 20):
+            edges = readSGLX.ExtractDigitalEdges(raw, first, last, 0, lines, meta, chunkSamp=chunk_samp)
+            for a, b in zip(edges, expected):
+                np.testing.assert_array_equal(a, b)
+        del raw
+
+
+@unittest.skipIf(mtscomp is None, 'mtscomp not installed')
+class TestCbinRaw(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.bin_file = Path(self.tdir.name).joinpath('probe_g0_t0.imec.ap.bin')
+        meta = IMEC_META.replace('snsSaveChanSubset=0:2,5,768', 'snsSaveChanSubset=all')
+        self.bin_file.with_suffix('.meta').write_text(meta.replace('fileSizeBytes=10000', 'fileSizeBytes=300000'))
+        data = np.random.default_rng(0).integers(-2000, 2000, (30000, 5), dtype=np.int16)
+        data.tofile(self.bin_file)
+        # chunks of 3000 samples
+        mtscomp.compress(self.bin_file, self.bin_file.with_suffix('.cbin'), self.bin_file.with_suffix('.ch'),
+                         sample_rate=30000, n_channels=5, dtype=np.int16, chunk_duration=0.1, quiet=True)
+
+    def tearDown(self):
+        self.tdir.cleanup()
+
+    def test_slicing(self):
+        meta = readSGLX.readMeta(self.bin_file)
+        mmap = readSGLX.makeMemMapRaw(self.bin_file, meta)
+        cbin_file = self.bin_file.with_suffix('.cbin')
+        # room for two chunks of 3000 x 5 int16 samples
+        raw = readSGLX.makeMemMapRaw(cbin_file, readSGLX.readMeta(cbin_file), cacheBytes=60000)
+        self.assertIsInstance(raw, readSGLX.CbinRaw)
+        self.assertEqual(raw.shape, mmap.shape)
+        for item in [(slice(None), slice(10, 20)), (4, slice(2990, 9010)), ([0, 3], slice(0, None, 7)),
+                     (slice(1, 3), 29999), (2, slice(-10, None)), (slice(None), slice(5, 5)), 3]:
+            np.testing.assert_array_equal(raw[item], mmap[item])
+        # windows within the cached chunks are not decompressed again
+        misses = raw.stats['misses']
+        raw[:, 27500:29000]
+        self.assertEqual(raw.stats['misses'], misses)
+        self.assertEqual(len(raw._cache), 2)
+        raw.close()
+        del mmap
+
+
+class TestConcatRaw(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        self.segments = []
+        # the t10 segment comes after the t2 segment
+        for trigger, n_samples in zip([0, 1, 2, 10], [1000, 1, 2500, 700]):
+            bin_file = Path(self.tdir.name).joinpath(f'probe_g0_t{trigger}.imec.ap.bin')
+            data = rng.integers(-2000, 2000, (n_samples, 5), dtype=np.int16)
+            data.tofile(bin_file)
+            bin_file.with_suffix('.meta').write_text(IMEC_META.replace('fileSizeBytes=10000', f'fileSizeBytes={data.nbytes}'))
+            self.segments.append(data)
+
+    def tearDown(self):
+        self.tdir.cleanup()
+
+    def test_concat(self):
+        bin_file = Path(self.tdir.name).joinpath('probe_g0_t1.imec.ap.bin')
+        raw = readSGLX.makeConcatRaw(bin_file)
+        self.assertEqual([f.name[:-12] for f in raw.files], ['probe_g0_t0', 'probe_g0_t1', 'probe_g0_t2', 'probe_g0_t10'])
+        expected = np.concatenate(self.segments).T
+        self.assertEqual(raw.shape, expected.shape)
+        iseg, offset = raw.locate([0, 999, 1000, 1001, 4200])
+        np.testing.assert_array_equal(iseg, [0, 0, 1, 2, 3])
+        np.testing.assert_array_equal(offset, [0, 999, 0, 0, 699])
+        for item in [(slice(None), slice(990, 1010)), ([0, 4], slice(0, None, 3)), (2, slice(-800, None, 7)),
+                     (slice(None), 1000), (1, slice(4000, 5000)), (slice(None), slice(20, 20))]:
+            np.testing.assert_array_equal(raw[item], expected[item])
+        # reads within a segment are views of its memmap
+        self.assertTrue(np.shares_memory(raw[:, 1100:1200], raw.raws[2]))
+
+    def test_inconsistent_meta(self):
+        meta_file = Path(self.tdir.name).joinpath('probe_g0_t2.imec.ap.meta')
+        meta_file.write_text(meta_file.read_text().replace('imSampRate=30000', 'imSampRate=2500'))
+        with self.assertRaises(ValueError):
+            readSGLX.makeConcatRaw(meta_file.with_suffix('.bin'))
+
+
+if __name__ == '__main__':
+    unittest.main()
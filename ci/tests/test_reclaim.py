@@ -0,0 +1,103 @@
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+import local_db  # noqa: E402
+import reclaim  # noqa: E402
+from checkpoints import Checkpoints  # noqa: E402
+from file_index import FileIndex  # noqa: E402
+
+
+class TestReclaim(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        patcher = mock.patch.object(local_db, 'STATE_DIR', Path(self.tdir.name).joinpath('state'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.root = Path(self.tdir.name).joinpath('Subjects')
+        old, recent = (f'{datetime.now() - timedelta(days=d):%Y-%m-%d}' for d in (200, 10))
+        # old session with a tar, old session without a tar, recent session with a tar
+        self.tarred = self._make_session(f'SW001/{old}/001', tar=True)
+        self.untarred = self._make_session(f'SW001/{old}/002', tar=False)
+        self.recent = self._make_session(f'SW002/{recent}/001', tar=True)
+        self.index = FileIndex(self.root)
+        self.addCleanup(self.index.close)
+        self.index.refresh()
+
+    def _make_session(self, relative_path, tar=True):
+        session_path = self.root.joinpath(relative_path)
+        ks2_dir = session_path.joinpath('spike_sorters', 'ks2_matlab', 'probe00')
+        ks2_dir.mkdir(parents=True)
+        for fn in ('spike_sorting_ks2.log', 'spike_times.npy', 'templates.npy', 'spikes.times.npy'):
+            ks2_dir.joinpath(fn).write_bytes(b'0' * 10)
+        if tar:
+            ks2_dir.joinpath('_kilosort_raw.output.tar').write_bytes(b'0' * 100)
+        return session_path
+
+    def test_make_plan(self):
+        plan = reclaim.make_plan(self.index, reclaim.Policy())
+        self.assertEqual(set(sp for sp, *_ in plan), {self.tarred, self.recent})
+        # only the ks2 outputs are selected, not the tar nor the other files next to them
+        self.assertEqual(set(f.name for _, _, f, _ in plan), {'spike_sorting_ks2.log', 'spike_times.npy', 'templates.npy'})
+        self.assertTrue(all(probe == 'probe00' and size == 10 for _, probe, _, size in plan))
+        # minimum age
+        plan = reclaim.make_plan(self.index, reclaim.Policy(min_age_days=90))
+        self.assertEqual(set(sp for sp, *_ in plan), {self.tarred})
+        # without requiring the tar
+        plan = reclaim.make_plan(self.index, reclaim.Policy(min_age_days=90, require_tar=False))
+        self.assertEqual(set(sp for sp, *_ in plan), {self.tarred, self.untarred})
+        # a probe checkpointed by upload_ks2_output has been tarred, even if the tar is no longer on disk
+        checkpoints = Checkpoints('upload_ks2_output')
+        checkpoints.mark(self.untarred.joinpath('spike_sorters', 'ks2_matlab', 'probe00'))
+        checkpoints.close()
+        plan = reclaim.make_plan(self.index, reclaim.Policy(min_age_days=90))
+        self.assertEqual(set(sp for sp, *_ in plan), {self.tarred, self.untarred})
+        # registered set
+        policy = reclaim.Policy(require_registered=True)
+        with self.assertRaises(ValueError):
+            reclaim.make_plan(self.index, policy)
+        plan = reclaim.make_plan(self.index, policy, registered={(self.recent, 'probe00'), (self.tarred, 'probe01')})
+        self.assertEqual(set(sp for sp, *_ in plan), {self.recent})
+
+    def test_execute(self):
+        plan = reclaim.make_plan(self.index, reclaim.Policy())
+        run_id = reclaim.save_plan(plan, 'test')
+        files = [f for _, _, f, _ in plan]
+        self.assertEqual(reclaim.execute(run_id, dry=True), 60)
+        self.assertTrue(all(f.exists() for f in files))
+        # interrupted run: one file deleted and marked, one file deleted but not marked
+        files[0].unlink()
+        con = reclaim._ledger()
+        with con:
+            con.execute('UPDATE ledger SET deleted = 1 WHERE run_id = ? AND path = ?', (run_id, str(files[0])))
+        files[1].unlink()
+        # a file that can't be deleted stays pending
+        governor = mock.MagicMock()
+
+        def unlink(path):
+            if path == str(files[2]):
+                raise PermissionError(path)
+            Path(path).unlink()
+        governor.unlink.side_effect = unlink
+        freed = reclaim.execute(run_id, n_threads=2, governor=governor)
+        self.assertEqual(freed, 30)
+        self.assertEqual(governor.unlink.call_count, len(files) - 1)
+        self.assertTrue(files[2].exists())
+        self.assertFalse(any(f.exists() for f in files[3:]))
+        pending = [r['path'] for r in con.execute('SELECT path FROM ledger WHERE run_id = ? AND deleted IS NULL',
+                                                  (run_id,))]
+        self.assertEqual(pending, [str(files[2])])
+        con.close()
+        summary = reclaim.summary(run_id)
+        self.assertEqual(sum(s['planned'] for s in summary), 60)
+        self.assertEqual(sum(s['deleted'] for s in summary), 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import json
+import socket
+import sys
+import threading
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+from scheduler import Scheduler  # noqa: E402
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.port = _free_port()
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(5)
+        self.addCleanup(self.client.close)
+        self.runs = {'periodic': 0, 'woken': 0}
+        self.release = threading.Event()  # lets the slow job finish
+
+        def periodic_job():
+            self.runs['periodic'] += 1
+
+        def woken_job():
+            self.runs['woken'] += 1
+            self.release.wait(5)
+
+        self.periodic = self.scheduler.add_timer('periodic', periodic_job, 3600)
+        self.woken = self.scheduler.add_timer('woken', woken_job, None)
+        self.scheduler.listen(self.port, [self.periodic, self.woken])
+        self.thread = threading.Thread(target=self.scheduler.run, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.release.set()
+        if self.thread.is_alive():
+            self.client.sendto(b'STOP', ('localhost', self.port))
+            self.thread.join(5)
+
+    def _wait_for(self, condition, timeout=5):
+        end = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), end, 'timed out')
+            time.sleep(.01)
+
+    def test_check_and_wake(self):
+        # the periodic timer runs once at start, the timer without period only when woken up
+        self._wait_for(lambda: self.runs['periodic'] == 1)
+        time.sleep(.1)
+        self.assertEqual(self.runs['woken'], 0)
+        self.client.sendto(b'CHECK', ('localhost', self.port))
+        status = json.loads(self.client.recv(65536))
+        self.assertEqual(set(status['jobs']), {'periodic', 'woken'})
+        self.assertFalse(status['jobs']['woken']['running'])
+        self.client.sendto(b'WAKE', ('localhost', self.port))
+        self._wait_for(lambda: self.runs['woken'] == 1)
+        # the periodic timer is woken up as well, before its deadline
+        self._wait_for(lambda: self.runs['periodic'] == 2)
+        # a wake up during a run is deferred until the run is finished
+        self.client.sendto(b'WAKE', ('localhost', self.port))
+        self.client.sendto(b'CHECK', ('localhost', self.port))
+        self.assertTrue(json.loads(self.client.recv(65536))['jobs']['woken']['running'])
+        self.release.set()
+        self._wait_for(lambda: self.runs['woken'] == 2)
+
+    def test_stop(self):
+        self.client.sendto(b'WAKE', ('localhost', self.port))
+        self._wait_for(lambda: self.runs['woken'] == 1)
+        # the acknowledgement waits for the current run to finish
+        self.client.sendto(b'STOP', ('localhost', self.port))
+        with self.assertRaises(socket.timeout):
+            self.client.settimeout(.3)
+            self.client.recv(64)
+        self.release.set()
+        self.client.settimeout(5)
+        self.assertEqual(self.client.recv(64), b'ACK STOP')
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        # the port is released
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.bind(('localhost', self.port))
+
+
+if __name__ == '__main__':
+    unittest.main()
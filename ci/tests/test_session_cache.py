@@ -0,0 +1,90 @@
+import os
+import sys
+import tempfile
+import types
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+import session_cache  # noqa: E402
+from session_cache import session_cache as cache_context  # noqa: E402
+
+
+class TestSessionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.session_path = Path(self.tdir.name).joinpath('SW001', '2023-01-01', '001')
+        self.session_path.joinpath('raw_ephys_data').mkdir(parents=True)
+        self.sync_file = self.session_path.joinpath('raw_ephys_data', '_spikeglx_sync.times.npy')
+        np.save(self.sync_file, np.arange(5.))
+        self.n_loads = 0
+
+        def get_sync(session_path, sync_collection='raw_ephys_data', extra=None):
+            self.n_loads += 1
+            sync_file = Path(session_path).joinpath(sync_collection, '_spikeglx_sync.times.npy')
+            return {'times': np.load(sync_file), 'labels': ['a']} if sync_file.exists() else None
+        # a module of loaders wrapped by the cache, installed for the test only
+        self.module = types.ModuleType('fake_ephys_fpga')
+        self.module.get_sync = get_sync
+        for patcher in (mock.patch.dict(sys.modules, {'fake_ephys_fpga': self.module}),
+                        mock.patch.object(session_cache, '_installed', False),
+                        mock.patch.object(session_cache, 'CACHED_LOADERS',
+                                          [('fake_ephys_fpga', 'get_sync', 'sync_collection', 'raw_ephys_data')])):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        session_cache._install()
+
+    def test_hit(self):
+        with cache_context():
+            sync = self.module.get_sync(self.session_path)
+            # the paths are normalized and the default arguments bound
+            again = self.module.get_sync(str(self.session_path) + '/', sync_collection='raw_ephys_data')
+            self.assertEqual(self.n_loads, 1)
+            np.testing.assert_array_equal(again['times'], sync['times'])
+            # the callers get their own copies, that they can modify in place
+            sync['times'][0] = 10
+            sync['labels'].append('b')
+            again = self.module.get_sync(self.session_path)
+            self.assertEqual((again['times'][0], again['labels']), (0, ['a']))
+            again['times'] *= 2
+            self.assertEqual(self.n_loads, 1)
+            # arguments that can't be compared are not cached
+            self.module.get_sync(self.session_path, extra=[1])
+            self.assertEqual(self.n_loads, 2)
+
+    def test_invalidation(self):
+        with cache_context():
+            self.module.get_sync(self.session_path)
+            # a rewritten file of the collection invalidates the entry
+            np.save(self.sync_file, np.arange(6.))
+            st = self.sync_file.stat()
+            os.utime(self.sync_file, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+            self.assertEqual(self.module.get_sync(self.session_path)['times'].size, 6)
+            self.assertEqual(self.n_loads, 2)
+            # the None results are not cached: the file may be created by the next task
+            self.sync_file.unlink()
+            self.assertIsNone(self.module.get_sync(self.session_path))
+            np.save(self.sync_file, np.arange(3.))
+            self.assertEqual(self.module.get_sync(self.session_path)['times'].size, 3)
+            self.assertEqual(self.n_loads, 4)
+
+    def test_passthrough(self):
+        self.module.get_sync(self.session_path)
+        self.module.get_sync(self.session_path)
+        self.assertEqual(self.n_loads, 2)
+        with cache_context():
+            self.module.get_sync(self.session_path)
+        # the cache is discarded when the context exits
+        self.module.get_sync(self.session_path)
+        with cache_context():
+            self.module.get_sync(self.session_path)
+        self.assertEqual(self.n_loads, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+from file_index import FileIndex  # noqa: E402
+from session_catalog import SessionCatalog  # noqa: E402
+import maintenance_jobs  # noqa: E402
+
+BIASED = '_iblrig_tasks_biasedChoiceWorld'
+DESCRIPTION = """devices:
+  cameras:
+    left: {collection: raw_video_data}
+  photometry: {collection: raw_photometry_data}
+procedures: [Fiber photometry]
+tasks:
+  - _iblrig_tasks_passiveChoiceWorld: {collection: raw_passive_data}
+"""
+
+
+class TestSessionCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.root = Path(self.tdir.name).joinpath('Subjects')
+        self.catalog_file = Path(self.tdir.name).joinpath('session_catalog.pqt')
+        self.biased_ephys = self._session('SW001/2023-01-01/001', '_iblrig_mainenlab_ephys_0', BIASED)
+        self.biased_behaviour = self._session('SW001/2023-01-02/001', '_iblrig_mainenlab_behavior_1', BIASED)
+        self.training_ephys = self._session('SW002/2023-01-01/001', '_iblrig_mainenlab_ephys_0',
+                                            '_iblrig_tasks_trainingChoiceWorld')
+        self.described = self.root.joinpath('SW003/2023-01-01/002')
+        self.described.mkdir(parents=True)
+        self.described.joinpath('_ibl_experiment.description.yaml').write_text(DESCRIPTION)
+        self.index = FileIndex(self.root, db_file=Path(self.tdir.name).joinpath('file_index.sqlite'))
+        self.addCleanup(self.index.close)
+        self.index.refresh()
+
+    def _session(self, relative_path, rig, protocol):
+        session_path = self.root.joinpath(relative_path)
+        session_path.joinpath('raw_behavior_data').mkdir(parents=True)
+        self._write_settings(session_path, rig, protocol)
+        return session_path
+
+    def _write_settings(self, session_path, rig, protocol):
+        """Writes the settings file through a rename, as the index only sees the changes of the folders"""
+        folder = session_path.joinpath('raw_behavior_data')
+        settings = {'PYBPOD_BOARD': rig, 'PYBPOD_PROTOCOL': protocol,
+                    'SESSION_START_TIME': '2023-01-01T10:00:00', 'SESSION_END_TIME': '2023-01-01T11:00:00'}
+        folder.joinpath('tmp.json').write_text(json.dumps(settings))
+        os.replace(folder.joinpath('tmp.json'), folder.joinpath('_iblrig_taskSettings.raw.json'))
+        mtime = folder.stat().st_mtime
+        os.utime(folder, (mtime + 1, mtime + 1))
+
+    def test_update(self):
+        df = SessionCatalog(self.root, index=self.index, catalog_file=self.catalog_file).update()
+        self.assertEqual(len(df), 4)
+        rows = df.set_index('session_path')
+        row = rows.loc[str(self.biased_ephys)]
+        self.assertEqual((row['rig'], row['protocol'], row['duration']), ('_iblrig_mainenlab_ephys_0', BIASED, 3600))
+        self.assertEqual(list(row['collections']), ['raw_behavior_data'])
+        self.assertFalse(row['has_description'])
+        row = rows.loc[str(self.described)]
+        self.assertTrue(row['has_description'])
+        self.assertEqual(list(row['devices']), ['cameras', 'photometry'])
+        self.assertEqual(list(row['collections']), ['raw_passive_data', 'raw_photometry_data', 'raw_video_data'])
+        self.assertEqual(list(row['task_protocols']), ['_iblrig_tasks_passiveChoiceWorld'])
+        # the catalog is saved, the unchanged sessions are not parsed again
+        self._write_settings(self.training_ephys, '_iblrig_mainenlab_ephys_0', BIASED)
+        self.index.refresh()
+        catalog = SessionCatalog(self.root, index=self.index, catalog_file=self.catalog_file)
+        self.assertEqual(len(catalog.df), 4)
+        with self.assertLogs('ibllib', 'INFO') as log:
+            df = catalog.update()
+        self.assertIn('4 sessions, 1 parsed', log.output[-1])
+        self.assertEqual(df.set_index('session_path').loc[str(self.training_ephys), 'protocol'], BIASED)
+
+    def test_biased_ephys_sessions(self):
+        catalog = SessionCatalog(self.root, index=self.index, catalog_file=self.catalog_file).update()
+        self.assertEqual(maintenance_jobs._biased_ephys_sessions(catalog), {self.biased_ephys})
+
+    def test_transition_photometry(self):
+        """A session missing from a stale catalog still keeps its experiment description"""
+        photometry_yaml = self.described.joinpath('_device', 'photometry_00.yaml')
+        photometry_yaml.parent.mkdir()
+        photometry_yaml.touch()
+        maintenance_jobs._transition_photometry(photometry_yaml, described=set())
+        self.assertEqual(self.described.joinpath('_ibl_experiment.description.yaml').read_text(), DESCRIPTION)
+        self.assertFalse(self.described.joinpath('raw_session.flag').exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import sys
+import tempfile
+import unittest
+import uuid
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+import session_paths  # noqa: E402
+from session_paths import SessionPathCache, resolve_session_paths  # noqa: E402
+
+
+class FakeAlyx:
+    """Sessions endpoint of Alyx, the bulk query can be made to fail"""
+    def __init__(self, sessions):
+        self.sessions = sessions  # dict {eid: session dict}
+        self.queries = []
+        self.bulk_fails = False
+
+    def rest(self, url, action, django=None):
+        assert (url, action) == ('sessions', 'list')
+        self.queries.append(django)
+        if django.startswith('pk__in,') and self.bulk_fails:
+            raise RuntimeError('URI too long')
+        return [ses for eid, ses in self.sessions.items() if eid in django]
+
+
+class TestSessionPathCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.db_file = Path(self.tdir.name).joinpath('session_paths.sqlite')
+        self.eids = [str(uuid.uuid4()) for _ in range(5)]
+        self.alyx = FakeAlyx({eid: {'id': eid, 'subject': 'SW001', 'start_time': f'2023-01-0{i + 1}T10:00:00',
+                                    'number': 1} for i, eid in enumerate(self.eids)})
+        self.one = mock.MagicMock(alyx=self.alyx)
+        self.expected = {eid: f'SW001/2023-01-0{i + 1}/001' for i, eid in enumerate(self.eids)}
+
+    def _cache(self, **kwargs):
+        cache = SessionPathCache(self.one, db_file=self.db_file, **kwargs)
+        self.addCleanup(cache.close)
+        self.statements = []
+        cache.con.set_trace_callback(self.statements.append)
+        return cache
+
+    def _cached(self):
+        cache = self._cache()
+        return set(r['eid'] for r in cache.con.execute('SELECT eid FROM sessions'))
+
+    def test_batched_lookups(self):
+        cache = self._cache()
+        with mock.patch.object(session_paths, 'BATCH_SIZE', 2):
+            self.assertEqual(cache.resolve(self.eids + self.eids[:2]), self.expected)
+            # one Alyx query per batch of missing sessions
+            self.assertEqual(len(self.alyx.queries), 3)
+            self.assertTrue(all(q.startswith('pk__in,') for q in self.alyx.queries))
+            # the cached sessions are read in batches and the hits don't write to the database
+            self.statements.clear()
+            self.assertEqual(cache.resolve(reversed(self.eids)), self.expected)
+            self.assertEqual(len(self.alyx.queries), 3)
+            self.assertEqual(len(self.statements), 3)
+            self.assertTrue(all(s.startswith('SELECT') for s in self.statements))
+        # the cache is persistent
+        self.assertEqual(resolve_session_paths(self.one, '/mnt/s0/Data/Subjects', self.eids[:1], db_file=self.db_file),
+                         {self.eids[0]: Path('/mnt/s0/Data/Subjects', self.expected[self.eids[0]])})
+
+    def test_fallback(self):
+        self.alyx.bulk_fails = True
+        unknown = str(uuid.uuid4())
+        with self.assertLogs('ibllib', 'WARNING') as log:
+            self.assertEqual(self._cache().resolve(self.eids[:2] + [unknown]), {e: self.expected[e] for e in self.eids[:2]})
+        self.assertEqual(self.alyx.queries[1:], [f'pk,{eid}' for eid in self.eids[:2] + [unknown]])
+        self.assertIn(unknown, log.output[-1])
+
+    def test_eviction(self):
+        cache = self._cache(max_size=3)
+        with mock.patch.object(session_paths.time, 'time', side_effect=range(100)):
+            for eid in self.eids[:3]:
+                cache.resolve([eid])
+            # a hit below the capacity doesn't write to the database
+            self.statements.clear()
+            cache.resolve(self.eids[:1])
+            self.assertEqual(len(self.statements), 1)
+            # the sessions used by a lookup that exceeds the capacity are kept, the least recently used evicted
+            cache.resolve([self.eids[0], self.eids[3]])
+            self.assertEqual(self._cached(), {self.eids[0], self.eids[2], self.eids[3]})
+            cache.resolve([self.eids[4]])
+            self.assertEqual(self._cached(), {self.eids[0], self.eids[3], self.eids[4]})
+            # an evicted session is fetched again
+            n_queries = len(self.alyx.queries)
+            self.assertEqual(cache.resolve([self.eids[1]]), {self.eids[1]: self.expected[self.eids[1]]})
+            self.assertEqual(len(self.alyx.queries), n_queries + 1)
+
+    def test_missing_path(self):
+        subjects_path = Path(self.tdir.name).joinpath('Subjects')
+        for rel_path in self.expected.values():
+            subjects_path.joinpath(rel_path).mkdir(parents=True)
+        cache = self._cache(subjects_path=subjects_path)
+        self.assertEqual(cache.resolve(self.eids), self.expected)
+        self.assertEqual(len(self.alyx.queries), 1)
+        # the session renamed on Alyx and locally, the path found in the cache doesn't exist anymore
+        self.alyx.sessions[self.eids[0]]['number'] = 2
+        subjects_path.joinpath(self.expected[self.eids[0]]).rename(subjects_path.joinpath('SW001/2023-01-01/002'))
+        # the session deleted from Alyx and locally
+        self.alyx.sessions.pop(self.eids[1])
+        subjects_path.joinpath(self.expected[self.eids[1]]).rmdir()
+        with self.assertLogs('ibllib', 'ERROR'):
+            paths = cache.resolve(self.eids)
+        self.assertEqual(paths, {self.eids[0]: 'SW001/2023-01-01/002', **{e: self.expected[e] for e in self.eids[2:]}})
+        self.assertEqual(self.alyx.queries[-1], f'pk__in,{self.eids[:2]}')
+        self.assertNotIn(self.eids[1], self._cached())
+        # the paths found are cached again
+        self.assertEqual(cache.resolve(self.eids[:1]), {self.eids[0]: 'SW001/2023-01-01/002'})
+        self.assertEqual(len(self.alyx.queries), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
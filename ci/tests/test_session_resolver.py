@@ -0,0 +1,70 @@
+import sys
+import unittest
+import uuid
+from datetime import date
+from pathlib import Path
+from unittest import mock
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+from session_resolver import SessionResolver  # noqa: E402
+
+ROOT = Path('/mnt/s0/Data/Subjects')
+
+
+class TestSessionResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.cached = {ROOT.joinpath('SW001', '2023-01-02', '001'): str(uuid.uuid4()),
+                       ROOT.joinpath('SW002', '2023-01-03', '002'): str(uuid.uuid4())}
+        sessions = pd.DataFrame([{'subject': p.parts[-3], 'date': date.fromisoformat(p.parts[-2]), 'number': int(p.parts[-1])}
+                                 for p in self.cached], index=list(self.cached.values()))
+        # sessions on Alyx that are not in the cache table
+        self.remote = {ROOT.joinpath('SW001', '2023-02-01', '001'): str(uuid.uuid4()),
+                       ROOT.joinpath('SW001', '2023-03-01', '003'): str(uuid.uuid4())}
+        self.one = mock.MagicMock()
+        self.one._cache = {'sessions': sessions}
+        self.one.alyx.rest.side_effect = self._rest
+
+    def _rest(self, url, action, subject=None, date_range=None):
+        self.assertEqual((url, action), ('sessions', 'list'))
+        return [{'id': eid, 'start_time': f'{p.parts[-2]}T10:00:00', 'number': int(p.parts[-1])}
+                for p, eid in self.remote.items()
+                if p.parts[-3] == subject and date_range[0] <= p.parts[-2] <= date_range[1]]
+
+    def test_cache(self):
+        resolver = SessionResolver(self.one)
+        # the paths are normalized: str and Path, duplicates
+        paths = list(map(str, self.cached)) + list(self.cached)
+        self.assertEqual(resolver.resolve(paths), self.cached)
+        self.one.alyx.rest.assert_not_called()
+
+    def test_alyx_fallback(self):
+        resolver = SessionResolver(self.one)
+        unknown = ROOT.joinpath('SW001', '2023-02-15', '001')
+        not_a_session = ROOT.joinpath('SW001', '2023-02-15')
+        paths = [*self.cached, *self.remote, unknown, not_a_session]
+        eids = resolver.resolve(paths)
+        self.assertEqual(eids, {**self.cached, **self.remote, unknown: None, not_a_session: None})
+        # one query for the subject, for the range of the missing dates
+        self.one.alyx.rest.assert_called_once_with('sessions', 'list', subject='SW001',
+                                                   date_range=['2023-02-01', '2023-03-01'])
+        # the sessions found are added to the table, only the unknown session is queried again
+        self.one.alyx.rest.reset_mock()
+        self.assertEqual(resolver.resolve(self.remote), self.remote)
+        self.one.alyx.rest.assert_not_called()
+        resolver.resolve([unknown])
+        self.one.alyx.rest.assert_called_once()
+
+    def test_query_failure(self):
+        self.one.alyx.rest.side_effect = RuntimeError('Alyx down')
+        self.one._cache = {}
+        resolver = SessionResolver(self.one)
+        with self.assertLogs('ibllib', 'WARNING'):
+            eids = resolver.resolve(self.remote)
+        self.assertEqual(eids, dict.fromkeys(self.remote))
+
+
+if __name__ == '__main__':
+    unittest.main()
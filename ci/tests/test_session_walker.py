@@ -0,0 +1,55 @@
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+import session_walker  # noqa: E402
+
+
+class TestSessionWalker(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.root = Path(self.tdir.name)
+        self.sessions = []
+        for i in range(50):
+            for date, number in [('2023-01-01', '001'), ('2023-01-02', '002')]:
+                session_path = self.root.joinpath(f'SW{i:03d}', date, number)
+                session_path.joinpath('_device').mkdir(parents=True)
+                self.sessions.append(session_path)
+        # the folders not matching subject/20*/0* are not walked
+        self.root.joinpath('SW000', 'notes').mkdir()
+        self.root.joinpath('SW000', '2023-01-01', 'tmp').mkdir()
+        self.root.joinpath('readme.txt').touch()
+        for session_path in self.sessions[::3]:
+            session_path.joinpath('_device', 'photometry_00.yaml').touch()
+
+    def test_walk(self):
+        self.assertEqual(sorted(session_walker.walk_sessions(self.root, n_threads=4)), sorted(self.sessions))
+        self.assertEqual(list(session_walker.walk_sessions(self.root, n_threads=4, ordered=True)), sorted(self.sessions))
+        expected = sorted(s.joinpath('_device', 'photometry_00.yaml') for s in self.sessions[::3])
+        self.assertEqual(list(session_walker.glob_sessions('_device/photometry_00.yaml', self.root, ordered=True)), expected)
+        self.assertEqual(sorted(session_walker.glob_sessions('_device/*.yaml', self.root)), expected)
+        self.assertEqual(list(session_walker.walk_sessions(self.root.joinpath('missing'))), [])
+
+    def test_close(self):
+        walked = []
+
+        def walk_subject(subject_path, *args):
+            walked.append(subject_path)
+            time.sleep(.02)
+            return [subject_path]
+        with mock.patch.object(session_walker, '_walk_subject', walk_subject):
+            sessions = session_walker.walk_sessions(self.root, n_threads=1, ordered=True)
+            self.assertEqual(next(sessions), self.root.joinpath('SW000'))
+            sessions.close()
+        # the subjects queued behind the running one are cancelled
+        self.assertLess(len(walked), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
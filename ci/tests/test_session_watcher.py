@@ -0,0 +1,182 @@
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from datetime import date, timedelta
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+import jobs  # noqa: E402
+import session_watcher  # noqa: E402
+from scheduler import Scheduler  # noqa: E402
+from session_watcher import SessionWatcher, inotify_available  # noqa: E402
+
+TODAY = str(date.today())
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+@unittest.skipUnless(inotify_available(), 'inotify is only available on Linux')
+class TestSessionWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.root = Path(self.tdir.name)
+        self.recent = self.root.joinpath('SW001', TODAY, '001')
+        self.recent.mkdir(parents=True)
+        self.old = self.root.joinpath('SW001', str(date.today() - timedelta(days=60)), '001')
+        self.old.mkdir(parents=True)
+        self.flagged = self.root.joinpath('SW001', TODAY, '002')
+        self.flagged.mkdir()
+        self.flagged.joinpath('extract_me.flag').touch()
+        self.watcher = SessionWatcher(self.root)
+        self.addCleanup(self.watcher.close)
+
+    def test_flags(self):
+        # the flags present at start-up are queued
+        self.assertEqual(list(self.watcher.pending), [self.flagged])
+        self.recent.joinpath('raw_session.flag').touch()
+        # the folders older than RECENT_DAYS are not watched, and the other files are ignored
+        self.old.joinpath('raw_session.flag').touch()
+        self.recent.joinpath('raw_behavior_data').mkdir()
+        self.recent.joinpath('raw_behavior_data', 'raw_session.flag').touch()
+        self.recent.joinpath('transfer_me.flag').touch()
+        self.assertEqual(self.watcher.read_events(), 2)
+        self.assertEqual(set(self.watcher.pending), {self.flagged, self.recent})
+        # a flag created with its subject and date folders, while the watcher runs
+        session_path = self.root.joinpath('SW002', '2020-01-01', '001')
+        session_path.mkdir(parents=True)
+        session_path.joinpath('raw_session.flag').touch()
+        self.watcher.read_events()
+        # the new folders are watched: a flag written afterwards is seen as well
+        other = session_path.parent.joinpath('002')
+        other.mkdir()
+        self.watcher.read_events()
+        other.joinpath('tmp').write_text('')
+        os.rename(other.joinpath('tmp'), other.joinpath('extract_me.flag'))
+        self.watcher.read_events()
+        self.assertEqual(set(self.watcher.pending), {self.flagged, self.recent, session_path, other})
+
+    def test_pop_settled(self):
+        self.watcher.pending[self.recent] = time.time() - 1
+        settled, next_in = self.watcher.pop_settled(settle_time=5)
+        self.assertEqual(settled, [])
+        self.assertAlmostEqual(next_in, 4, places=1)
+        # the flag found at start-up is more recent
+        settled, next_in = self.watcher.pop_settled(settle_time=.5)
+        self.assertEqual(settled, [self.recent])
+        self.assertAlmostEqual(next_in, .5, places=1)
+        settled, next_in = self.watcher.pop_settled(settle_time=0)
+        self.assertEqual(settled, [self.flagged])
+        self.assertIsNone(next_in)
+        self.assertEqual(self.watcher.pending, {})
+
+    def test_overflow(self):
+        """Events lost by the kernel set the flag for a full scan"""
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        self.addCleanup(os.close, write_fd)
+        os.close(self.watcher.fd)
+        self.watcher.fd = read_fd
+        os.write(write_fd, session_watcher._EVENT.pack(-1, session_watcher.IN_Q_OVERFLOW, 0, 0))
+        with self.assertLogs('ibllib', 'WARNING'):
+            self.watcher.read_events()
+        self.assertTrue(self.watcher.overflowed)
+
+
+class _Watcher(SessionWatcher):
+    """Settles the sessions after 50 ms, and loses the events on demand"""
+    instances = []
+    lose_events = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.instances.append(self)
+
+    def read_events(self):
+        n = super().read_events()
+        if self.lose_events:
+            self.overflowed = True
+        return n
+
+    def pop_settled(self, settle_time=.05):
+        return super().pop_settled(settle_time=settle_time)
+
+
+@unittest.skipUnless(inotify_available(), 'inotify is only available on Linux')
+class TestCreateWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.root = Path(self.tdir.name)
+        self.root.joinpath('SW001').mkdir()
+        self.created, self.full_scans = [], []
+        # the task runners, woken up once the jobs are created
+        self.runner = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.runner.bind(('localhost', 0))
+        self.runner.settimeout(5)
+        self.addCleanup(self.runner.close)
+        runner_port = self.runner.getsockname()[1]
+        create_sessions = types.SimpleNamespace(
+            __wrapped__=lambda root_path, dry: self.full_scans.append(root_path), period=900)
+        _Watcher.instances = []
+        for patcher in (mock.patch.object(jobs, 'SessionWatcher', _Watcher),
+                        mock.patch.object(jobs, 'SETTLE_TIME', .05),
+                        mock.patch.object(jobs, 'create_sessions', create_sessions),
+                        mock.patch.object(jobs, 'job_creator', lambda path, dry: self.created.append(path)),
+                        mock.patch.dict(jobs.DEFINED_PORTS, run=runner_port, small_jobs=runner_port,
+                                        large_jobs=runner_port)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.scheduler = Scheduler()
+        timers = jobs._add_create_watch(self.scheduler, self.root)
+        self.assertEqual(timers[0].period, jobs.RECONCILE_PERIOD)
+        self.port = _free_port()
+        self.scheduler.listen(self.port, timers)
+        self.thread = threading.Thread(target=self.scheduler.run, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        if self.thread.is_alive():
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.sendto(b'STOP', ('localhost', self.port))
+            self.thread.join(5)
+
+    def _wait_for(self, condition, timeout=5):
+        end = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), end, 'timed out')
+            time.sleep(.01)
+
+    def test_wake(self):
+        # the full scan runs at start-up
+        self._wait_for(lambda: len(self.full_scans) == 1)
+        session_path = self.root.joinpath('SW001', TODAY, '001')
+        session_path.mkdir(parents=True)
+        session_path.joinpath('raw_session.flag').touch()
+        self._wait_for(lambda: self.created == [session_path])
+        self.assertEqual(self.runner.recv(16), b'WAKE')
+        self.assertEqual(len(self.full_scans), 1)
+
+    def test_overflow(self):
+        """When events are lost, a full scan is run instead of waiting for the reconciliation period"""
+        self._wait_for(lambda: len(self.full_scans) == 1)
+        _Watcher.instances[0].lose_events = True
+        self.root.joinpath('SW002').mkdir()
+        self._wait_for(lambda: len(self.full_scans) == 2)
+        self.assertFalse(_Watcher.instances[0].overflowed)
+
+
+if __name__ == '__main__':
+    unittest.main()
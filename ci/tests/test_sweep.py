@@ -0,0 +1,105 @@
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+from file_index import FileIndex  # noqa: E402
+from sweep import Sweep  # noqa: E402
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.root = Path(self.tdir.name).joinpath('Subjects')
+        self.sessions = [self.root.joinpath(f'SW00{i}', '2023-01-01', '001') for i in range(4)]
+        for session_path in self.sessions:
+            session_path.joinpath('raw_video_data').mkdir(parents=True)
+            session_path.joinpath('video_data_transferred.flag').touch()
+            session_path.joinpath('raw_video_data', '_iblrig_leftCamera.raw.mp4').touch()
+        self.sessions[0].joinpath('raw_session.flag').touch()
+        index = FileIndex(self.root, db_file=Path(self.tdir.name).joinpath('file_index.sqlite'))
+        self.addCleanup(index.close)
+        self.sweep = Sweep(self.root, index=index)
+        self.handled = []
+
+    def _handler(self, name, action=None):
+        def handler(file):
+            self.handled.append((name, file))
+            if action:
+                action(file)
+        handler.__name__ = name
+        return handler
+
+    def test_run(self):
+        self.sweep.register('video_data_transferred.flag', self._handler('transferred'))
+        # a file matching several patterns of a handler is handled once
+        self.sweep.register(['*.flag', 'raw_session.flag'], self._handler('flags'), name='all_flags')
+        self.sweep.register('raw_video_data/*.mp4', self._handler('videos'))
+        with mock.patch.object(self.sweep.index, 'refresh', wraps=self.sweep.index.refresh) as refresh, \
+                self.assertLogs('ibllib', 'INFO') as log:
+            stats = self.sweep.run()
+        # a single traversal of the tree for all the handlers
+        refresh.assert_called_once()
+        self.assertIn('Sweep done', log.output[-1])
+        self.assertEqual({k: (s['matches'], s['errors']) for k, s in stats.items()},
+                         {'transferred': (4, 0), 'all_flags': (5, 0), 'videos': (4, 0)})
+        # the files are dispatched in path order, handler after handler
+        self.assertEqual([f for name, f in self.handled if name == 'transferred'],
+                         [s.joinpath('video_data_transferred.flag') for s in self.sessions])
+        self.assertEqual([name for name, _ in self.handled], ['transferred'] * 4 + ['flags'] * 5 + ['videos'] * 4)
+        # the files created since the refresh are found by the next sweep only
+        self.sweep.handlers = self.sweep.handlers[:1]
+        new_session = self.root.joinpath('SW009', '2023-01-01', '001')
+        new_session.mkdir(parents=True)
+        new_session.joinpath('video_data_transferred.flag').touch()
+        with self.assertLogs('ibllib', 'INFO'):
+            self.assertEqual(self.sweep.run(refresh=False)['transferred']['matches'], 4)
+            self.assertEqual(self.sweep.run()['transferred']['matches'], 5)
+
+    def test_files_removed(self):
+        """The files removed during the sweep, by a handler or another process, are skipped"""
+        with self.assertLogs('ibllib', 'INFO'):
+            self.sweep.index.refresh()
+        # removed after the refresh
+        self.sessions[3].joinpath('raw_video_data', '_iblrig_leftCamera.raw.mp4').unlink()
+
+        def remove_flags(file):
+            # removes the flags of the next sessions as well
+            for session_path in self.sessions[1:3]:
+                session_path.joinpath('video_data_transferred.flag').unlink(missing_ok=True)
+            file.unlink()
+
+        def remove_videos(file):
+            # the video folder of a session removed with its flag
+            video = file.parent.joinpath('raw_video_data', '_iblrig_leftCamera.raw.mp4')
+            video.unlink(missing_ok=True)
+        self.sweep.register('video_data_transferred.flag', self._handler('transferred', remove_flags))
+        self.sweep.register('raw_session.flag', self._handler('raw', remove_videos))
+        self.sweep.register('*.mp4', self._handler('videos', lambda f: f.stat()))
+        with self.assertLogs('ibllib', 'INFO'):
+            stats = self.sweep.run(refresh=False)
+        self.assertEqual({k: (s['matches'], s['errors']) for k, s in stats.items()},
+                         {'transferred': (2, 0), 'raw': (1, 0), 'videos': (2, 0)})
+        self.assertEqual([f for name, f in self.handled if name == 'transferred'],
+                         [self.sessions[i].joinpath('video_data_transferred.flag') for i in (0, 3)])
+        self.assertEqual([f.parents[1] for name, f in self.handled if name == 'videos'], self.sessions[1:3])
+
+    def test_errors(self):
+        def fail(file):
+            if file.parts[-4] == 'SW001':
+                raise ValueError('corrupted file')
+        self.sweep.register('video_data_transferred.flag', self._handler('transferred', fail))
+        with self.assertLogs('ibllib', 'INFO') as log:
+            stats = self.sweep.run()
+        # the error is logged and the handler carries on with the next files
+        self.assertEqual((stats['transferred']['matches'], stats['transferred']['errors']), (4, 1))
+        self.assertEqual(len(self.handled), 4)
+        self.assertTrue(any('ValueError: corrupted file' in line for line in log.output))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import sys
+import tempfile
+import time
+import unittest
+import uuid
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+import task_pool  # noqa: E402
+
+
+def _init_worker():
+    """The worker processes of the tests don't need a ONE instance"""
+
+
+def _fake_run_task(tdict, session_path):
+    """Records the start and end of the task in the log file of the test, the workers are separate processes"""
+    with open(tdict['log'], 'a') as f:
+        f.write(f"{tdict['name']} {tdict['id']} start {time.time()}\n")
+    time.sleep(tdict.get('sleep', .2))
+    with open(tdict['log'], 'a') as f:
+        f.write(f"{tdict['name']} {tdict['id']} end {time.time()}\n")
+    return [f"{tdict['id']}.npy"], False, tdict.get('sleep', .2)
+
+
+def _fake_run_session_group(tdicts, session_path, one=None):
+    return [(t['name'], _fake_run_task(t, session_path)[0], False, 0) for t in tdicts]
+
+
+class TestRunTasksParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.log = Path(self.tdir.name).joinpath('tasks.log')
+        self.log.touch()
+        self.session_paths = {}
+        for target, new in [('_init_worker', _init_worker), ('_run_task', _fake_run_task),
+                            ('_run_session_group', _fake_run_session_group),
+                            ('resolve_session_paths', lambda *args: self.session_paths)]:
+            patcher = mock.patch.object(task_pool, target, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _task(self, name, parents=None, session=None, **kwargs):
+        tdict = dict(id=str(uuid.uuid4()), name=name, parents=parents or [], session=session or str(uuid.uuid4()),
+                     log=str(self.log), **kwargs)
+        self.session_paths[tdict['session']] = Path(self.tdir.name).joinpath(tdict['session'])
+        return tdict
+
+    def _intervals(self):
+        """:return: dict {task id: (name, start, end)}"""
+        out = {}
+        for line in self.log.read_text().splitlines():
+            name, tid, event, t = line.split()
+            start, end = out.get(tid, (name, None, None))[1:]
+            out[tid] = (name, float(t), end) if event == 'start' else (name, start, float(t))
+        return out
+
+    def test_parents(self):
+        parent = self._task('Parent')
+        # the child comes first in the queue, it is held back until its parent is finished
+        child = self._task('Child', parents=[parent['id']], session=parent['session'])
+        other = self._task('Other')
+        dsets = task_pool.run_tasks_parallel('/mnt/s0/Data/Subjects', [child, parent, other], one=mock.MagicMock(),
+                                             n_workers=3)
+        self.assertEqual(len(dsets), 3)
+        intervals = self._intervals()
+        self.assertGreaterEqual(intervals[child['id']][1], intervals[parent['id']][2])
+        # the other task is not held back by the child
+        self.assertLess(intervals[other['id']][1], intervals[parent['id']][2])
+        # a task whose parent is not part of the batch is dispatched
+        self.log.write_text('')
+        orphan = self._task('Child', parents=[str(uuid.uuid4())])
+        task_pool.run_tasks_parallel('/mnt/s0/Data/Subjects', [orphan], one=mock.MagicMock(), n_workers=2)
+        self.assertIn(orphan['id'], self._intervals())
+
+    def test_caps(self):
+        tasks = [self._task('EphysPulses') for _ in range(3)] + [self._task('Small')]
+        task_pool.run_tasks_parallel('/mnt/s0/Data/Subjects', tasks, one=mock.MagicMock(), n_workers=4,
+                                     max_per_task={'EphysPulses': 1})
+        intervals = self._intervals()
+        pulses = sorted(v[1:] for v in intervals.values() if v[0] == 'EphysPulses')
+        self.assertEqual(len(pulses), 3)
+        # the capped tasks run one after the other, the other task alongside them
+        self.assertTrue(all(s >= e for (_, e), (s, _) in zip(pulses[:-1], pulses[1:])))
+        self.assertLess(intervals[tasks[-1]['id']][1], pulses[0][1] + .2)
+
+    def test_admission_and_count(self):
+        tasks = [self._task('Small', sleep=.1) for _ in range(4)]
+        # the first task isn't admitted, the count stops the dispatch after the first two tasks
+        dsets = task_pool.run_tasks_parallel('/mnt/s0/Data/Subjects', tasks, one=mock.MagicMock(), n_workers=1,
+                                             count=2, admit=lambda tdict, running: tdict is not tasks[0])
+        self.assertEqual(dsets, [f"{t['id']}.npy" for t in tasks[1:3]])
+
+    def test_session_group_caps(self):
+        tasks = [self._task('EphysPulses') for _ in range(2)] + [self._task('Small')]
+        task_pool.run_session_groups('/mnt/s0/Data/Subjects', tasks, one=mock.MagicMock(), n_workers=3,
+                                     max_per_task={'EphysPulses': 1})
+        intervals = self._intervals()
+        (s0, e0), (s1, e1) = sorted(v[1:] for v in intervals.values() if v[0] == 'EphysPulses')
+        self.assertGreaterEqual(s1, e0)
+        self.assertLess(intervals[tasks[-1]['id']][1], e0)
+
+
+if __name__ == '__main__':
+    unittest.main()
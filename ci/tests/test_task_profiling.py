@@ -0,0 +1,105 @@
+import contextlib
+import io
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('deploy', 'serverpc', 'crontab')))
+import task_profiling  # noqa: E402
+
+
+def trivial_extraction(n):
+    return sum(i ** 2 for i in range(n))
+
+
+class TestTaskProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tdir.cleanup)
+        self.profile_dir = Path(self.tdir.name)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+        def run_alyx_task(tdict=None, session_path=None, **kwargs):
+            if tdict.get('block'):
+                self.started.set()
+                self.release.wait(5)
+            trivial_extraction(1000)
+            return tdict['name'], [f'{session_path}/alf/trials.npy']
+        patcher = mock.patch.object(task_profiling, 'run_alyx_task', run_alyx_task)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _run(self, i, **kwargs):
+        return task_profiling.run_task(tdict={'name': 'TrainingTrials', **kwargs}, profile=True,
+                                       session_path=f'/mnt/s0/Data/Subjects/SW001/2023-01-01/{i:03d}',
+                                       profile_dir=self.profile_dir)
+
+    def test_rotation_and_summarize(self):
+        n_runs = task_profiling.N_KEEP + 2
+        with self.assertLogs('ibllib', 'INFO'):
+            for i in range(n_runs):
+                task_name, dsets = self._run(i)
+        self.assertEqual(dsets, [f'/mnt/s0/Data/Subjects/SW001/2023-01-01/{n_runs - 1:03d}/alf/trials.npy'])
+        # the oldest runs are removed with their memory report
+        task_dir = self.profile_dir.joinpath('TrainingTrials')
+        prof_files = sorted(task_dir.glob('*.prof'))
+        self.assertEqual(len(prof_files), task_profiling.N_KEEP)
+        self.assertEqual(sorted(f.name.split('.')[0] for f in task_dir.glob('*.mem.txt')),
+                         [f.stem for f in prof_files])
+        self.assertTrue(prof_files[0].stem.endswith('SW001_2023-01-01_002'))
+        self.assertTrue(prof_files[-1].stem.endswith(f'SW001_2023-01-01_{n_runs - 1:03d}'))
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            task_profiling.summarize('TrainingTrials', sort='tottime', top=5, profile_dir=self.profile_dir)
+        summary = stdout.getvalue()
+        self.assertIn(f'TrainingTrials: {task_profiling.N_KEEP} runs from {prof_files[0].stem}', summary)
+        self.assertIn('peak traced memory: median', summary)
+        # the calls of all the runs are aggregated
+        self.assertRegex(summary, rf'{task_profiling.N_KEEP}\s.*trivial_extraction')
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            task_profiling.summarize('TrainingStatus', profile_dir=self.profile_dir)
+        self.assertIn('No profiles found', stdout.getvalue())
+
+    def test_concurrent_tasks(self):
+        """A single task of the process is profiled at a time, the others run normally"""
+        results = {}
+        thread = threading.Thread(target=lambda: results.update(first=self._run(0, block=True)))
+        with self.assertLogs('ibllib', 'INFO') as log:
+            thread.start()
+            self.assertTrue(self.started.wait(5))
+            results['second'] = self._run(1)
+            self.release.set()
+            thread.join(5)
+        self.assertIn('Another task is being profiled in this process, running TrainingTrials without profiling',
+                      log.output[0])
+        self.assertEqual(set(results), {'first', 'second'})
+        prof_files = list(self.profile_dir.joinpath('TrainingTrials').glob('*.prof'))
+        self.assertEqual(len(prof_files), 1)
+        self.assertTrue(prof_files[0].stem.endswith('_000'))
+        # the lock is released once the profiled task is done
+        with self.assertLogs('ibllib', 'INFO'):
+            self._run(2)
+        self.assertEqual(len(list(self.profile_dir.joinpath('TrainingTrials').glob('*.prof'))), 2)
+
+    def test_rotate_concurrently(self):
+        """A profile removed by the rotation of another process is skipped"""
+        task_dir = self.profile_dir.joinpath('TrainingTrials')
+        task_dir.mkdir()
+        for i in range(4):
+            task_dir.joinpath(f'{i}.prof').touch()
+        # the listing still contains the profile that the other process has removed
+        listing = sorted(task_dir.glob('*.prof'))
+        task_dir.joinpath('0.prof').unlink()
+        with mock.patch.object(Path, 'glob', return_value=listing):
+            task_profiling._rotate(task_dir, n_keep=2)
+        self.assertEqual(sorted(f.name for f in task_dir.iterdir()), ['2.prof', '3.prof'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""
+Resource aware admission control of the large tasks.
+
+Each task name declares a resource profile: CPU cores, RAM and scratch disk in GB, and GPUs.
+Before a task is started, the free RAM, the free scratch disk space and the CPU load of the server
+are measured. A task is admitted if its profile fits both in what is measured free and in what the
+running tasks have not reserved out of the total, as they may not have reached their peak usage yet.
+The requirements are capped to the size of the machine, so that a profile larger than the server
+is not held back forever.
+Task names without a local profile use the cpu, ram and gpu fields of the Alyx task record.
+
+>>> admission = ResourceAdmission()
+>>> run_tasks_parallel(subjects_path, waiting_tasks, admit=admission.admit)
+"""
+import logging
+import os
+import time
+from pathlib import Path
+
+from ibllib.pipes.local_server import _get_volume_usage
+
+_logger = logging.getLogger('ibllib')
+
+# cpu: cores, ram: GB, disk: GB of scratch space, gpu: number of GPUs
+RESOURCE_PROFILES = {
+    'SpikeSorting': dict(cpu=8, ram=48, disk=400, gpu=1),
+    'EphysDLC': dict(cpu=4, ram=16, disk=20, gpu=1),
+    'TrainingDLC': dict(cpu=4, ram=16, disk=20, gpu=1),
+    'EphysVideoCompress': dict(cpu=8, ram=8, disk=100, gpu=0),
+    'TrainingVideoCompress': dict(cpu=4, ram=4, disk=20, gpu=0),
+    'VideoCompress': dict(cpu=8, ram=8, disk=100, gpu=0),
+}
+DEFAULT_PROFILE = dict(cpu=4, ram=16, disk=50, gpu=0)
+SCRATCH_PATH = Path('/mnt/h0')  # spike sorting scratch volume
+DATA_PATH = Path('/mnt/s0/Data')
+DISK_MARGIN = 100  # GB always left free on the scratch volume
+MAX_LOAD = 1.  # maximum 1 min load average per CPU core before holding back new tasks
+MEASURE_TTL = 5  # seconds during which the resource measurements are reused
+
+
+def resource_profile(tdict):
+    """
+    Returns the resource profile of a task: local profile of the task name, else the Alyx task fields
+    :param tdict: task dictionary from Alyx
+    :return: dict with keys cpu, ram, disk, gpu
+    """
+    if tdict['name'] in RESOURCE_PROFILES:
+        return RESOURCE_PROFILES[tdict['name']]
+    return {k: tdict.get(k) if tdict.get(k) is not None else v for k, v in DEFAULT_PROFILE.items()}
+
+
+def _meminfo():
+    """Total and available RAM in GB from /proc/meminfo"""
+    with open('/proc/meminfo') as fid:
+        info = dict(line.split(':', 1) for line in fid)
+    return [int(info[k].split()[0]) / 1024 ** 2 for k in ('MemTotal', 'MemAvailable')]
+
+
+def _gpu_count():
+    return len(list(Path('/dev').glob('nvidia[0-9]*')))
+
+
+class ResourceAdmission:
+    """
+    Admits tasks according to the free resources of the server
+    :param scratch_path: volume where the large tasks write their temporary files
+    :param n_gpus: number of GPUs, detected from the nvidia devices if None
+    """
+    def __init__(self, scratch_path=None, n_gpus=None):
+        self.scratch_path = Path(scratch_path or (SCRATCH_PATH if SCRATCH_PATH.exists() else DATA_PATH))
+        self.n_cpus = os.cpu_count()
+        # if no GPU is detected, GPU tasks are still admitted one at a time rather than held back forever
+        self.n_gpus = max(_gpu_count() if n_gpus is None else n_gpus, 1)
+        self._measured = (-MEASURE_TTL, None)
+        self._held = set()  # ids of the tasks whose hold back was logged at the info level
+
+    def measure(self):
+        """
+        Measures the free resources of the server, reused for MEASURE_TTL seconds
+        :return: dict with keys ram_total, ram_available, disk_total, disk_available (GB) and load
+        """
+        t, measures = self._measured
+        if time.time() - t > MEASURE_TTL:
+            ram_total, ram_available = _meminfo()
+            disk = _get_volume_usage(str(self.scratch_path), 'disk')
+            measures = dict(ram_total=ram_total, ram_available=ram_available, load=os.getloadavg()[0],
+                            disk_total=disk['disk_total'], disk_available=disk['disk_available'])
+            self._measured = (time.time(), measures)
+        return measures
+
+    def admit(self, tdict, running):
+        """
+        Whether a task can start now
+        :param tdict: task dictionary of the candidate
+        :param running: list of task dictionaries of the tasks running
+        :return: bool
+        """
+        profile = resource_profile(tdict)
+        reserved = {k: sum(resource_profile(t)[k] for t in running) for k in DEFAULT_PROFILE}
+        m = self.measure()
+        # a profile larger than the machine is capped so that the task can run on an idle server
+        ram = min(profile['ram'], .8 * m['ram_total'])
+        disk = min(profile['disk'], max(m['disk_total'] - DISK_MARGIN, 0))
+        # the usage of the running tasks is part of the measures, their reservations are only
+        # compared to the totals so that it isn't subtracted twice
+        checks = {
+            'gpu': reserved['gpu'] + profile['gpu'] <= self.n_gpus,
+            'cpu': reserved['cpu'] + min(profile['cpu'], self.n_cpus) <= self.n_cpus,
+            'load': m['load'] < self.n_cpus * MAX_LOAD,
+            'ram': m['ram_available'] >= ram and m['ram_total'] - reserved['ram'] >= ram,
+            # with nothing running, the free space is all the task can get
+            'disk': not running or min(m['disk_available'], m['disk_total'] - reserved['disk']) - DISK_MARGIN >= disk,
+        }
+        if not all(checks.values()):
+            log = _logger.debug if tdict['id'] in self._held else _logger.info
+            self._held.add(tdict['id'])
+            log(f"Holding back {tdict['name']}, insufficient {', '.join(k for k, v in checks.items() if not v)}: "
+                f"{len(running)} tasks running, load {m['load']:.1f}, {m['ram_available']:.0f} GB RAM "
+                f"available, {m['disk_available']:.0f} GB scratch available")
+            return False
+        return True
@@ -0,0 +1,62 @@
+"""
+Progress of the long-running maintenance jobs, kept in a local database instead of flag files.
+
+Each job records the keys it has processed (e.g. a probe or session path), and a rerun skips them
+with a set lookup, so that a crashed run is resumed with the keys it had not processed.
+The flag files used previously are honoured: a key whose flag exists is recorded as processed.
+
+>>> checkpoints = Checkpoints('upload_ks2_output')
+>>> for tar_dir in tar_dirs:
+>>>     if checkpoints.done(tar_dir, flag=tar_dir.joinpath('tar_existed.flag')):
+>>>         continue
+>>>     ...
+>>>     checkpoints.mark(tar_dir)
+"""
+import time
+
+import local_db
+
+
+class Checkpoints:
+    """
+    :param job: name of the job
+    :param db_file: optional database file, defaults to local_db.STATE_DIR/checkpoints.sqlite
+    """
+    def __init__(self, job, db_file=None):
+        self.job = job
+        self.con = local_db.connect('checkpoints', db_file=db_file)
+        with self.con:
+            self.con.execute("""CREATE TABLE IF NOT EXISTS processed (
+                job TEXT, key TEXT, time REAL, PRIMARY KEY (job, key))""")
+        self._keys = set(r['key'] for r in self.con.execute('SELECT key FROM processed WHERE job = ?', (job,)))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def done(self, key, flag=None):
+        """
+        Whether a key has been processed
+        :param key: str or Path
+        :param flag: optional legacy flag file, if it exists the key is recorded as processed
+        """
+        if str(key) in self._keys:
+            return True
+        if flag is not None and flag.exists():
+            self.mark(key)
+            return True
+        return False
+
+    def mark(self, key):
+        """Records a key as processed"""
+        with self.con:
+            self.con.execute('INSERT OR REPLACE INTO processed VALUES (?, ?, ?)', (self.job, str(key), time.time()))
+        self._keys.add(str(key))
+
+    def discard(self, key):
+        """Forgets a processed key, so that it is processed again by the next run"""
+        with self.con:
+            self.con.execute('DELETE FROM processed WHERE job = ? AND key = ?', (self.job, str(key)))
+        self._keys.discard(str(key))
+
+    def close(self):
+        self.con.close()
@@ -0,0 +1,85 @@
+"""
+Disk usage of the Subjects folder per collection type, session age and subject, from the usage
+rollups of the file index, reported alongside the health indicators of the server.
+The first full build of the index is left to the maintenance sweep: until then, the usage is not
+reported rather than walking the whole tree within the report.
+
+>>> report_usage(one=one)  # labels the json field of the lab data repositories
+
+From the command line:
+    python disk_usage.py --by subject age
+"""
+import argparse
+from datetime import datetime
+import logging
+from pathlib import Path
+import time
+
+from one.remote.globus import get_local_endpoint_id
+
+from file_index import FileIndex
+
+_logger = logging.getLogger('ibllib')
+
+ROOT_PATH = Path('/mnt/s0/Data/Subjects')
+INDEX_MAX_AGE = 3600 * 2  # seconds after which the file index is refreshed before reporting
+N_SUBJECTS = 20  # number of largest subjects reported
+
+
+def usage_summary(root_path=ROOT_PATH, n_subjects=N_SUBJECTS, max_age=INDEX_MAX_AGE):
+    """
+    Usage in GB per collection type, per session age and for the largest subjects
+    :param root_path: Subjects folder
+    :param n_subjects: number of largest subjects listed
+    :param max_age: the file index is refreshed if older than max_age seconds
+    :return: json serializable dict, None if the file index has not been built yet
+    """
+    index = FileIndex(root_path)
+    if index.last_refresh is None:
+        _logger.info(f'File index of {root_path} not built yet, disk usage not reported')
+        index.close()
+        return
+    if index.last_refresh < time.time() - max_age:
+        index.refresh()
+
+    def gb(rows, key):
+        return {r[key]: round(r['size'] / 1024 ** 3, 1) for r in rows}
+
+    usage = {
+        'usage_time': datetime.fromtimestamp(index.last_refresh).isoformat(timespec='seconds'),
+        'usage_by_collection': gb(index.usage('collection'), 'collection'),
+        'usage_by_age': gb(index.usage('age'), 'age'),
+        'usage_by_subject': gb(index.usage('subject')[:n_subjects], 'subject'),
+    }
+    index.close()
+    return usage
+
+
+def report_usage(one, root_path=ROOT_PATH):
+    """
+    Labels the lab data repositories json field with the disk usage, see report_health
+    :param one: ONE instance
+    :param root_path: Subjects folder
+    :return: the usage reported, None if the file index has not been built yet
+    """
+    usage = usage_summary(root_path)
+    if usage is None:
+        return
+    data_repos = one.alyx.rest('data-repository', 'list', globus_endpoint_id=get_local_endpoint_id())
+    for dr in data_repos:
+        one.alyx.json_field_update(endpoint='data-repository', uuid=dr['name'], field_name='json', data=usage)
+    return usage
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Disk usage of the Subjects folder from the file index')
+    parser.add_argument('--root', help='Subjects folder', default=str(ROOT_PATH))
+    parser.add_argument('--by', help='Groupings: subject, date, collection, age', nargs='+', default=['collection', 'age'])
+    parser.add_argument('--top', help='Number of rows printed', default=50, type=int)
+    args = parser.parse_args()
+    index = FileIndex(args.root)
+    if index.last_refresh is None:
+        index.refresh()
+    for row in index.usage(args.by)[:args.top]:
+        keys = ' '.join(f'{row[b]:<20}' for b in args.by)
+        print(f"{keys} {row['n_files']:>10} files {row['size'] / 1024 ** 3:10.1f} GB")
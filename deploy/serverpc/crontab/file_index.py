@@ -0,0 +1,240 @@
+"""
+Persistent index of the files of the server data root, to avoid walking the whole tree with rglob.
+
+The index holds the path, size and modification time of each file and the modification time of
+each folder. It is refreshed incrementally: a folder whose mtime hasn't changed since the last
+refresh has the same entries, so it is not listed again and only its known sub-folders are
+checked. NB: the size and mtime of a file modified in place, without its folder changing, are
+only updated when the folder is listed again.
+
+>>> index = FileIndex('/mnt/s0/Data/Subjects')
+>>> index.refresh()
+>>> flags = list(index.rglob('video_data_transferred.flag'))
+>>> yamls = list(index.rglob('_device/photometry_00.yaml', max_age=600))  # refreshes if older than 10 min
+
+The index also keeps the number of files and bytes per subject, session date and top level
+collection of the sessions, updated with each folder listed. Where the space is used is then
+queried without walking the tree:
+>>> index.usage(by=('collection', 'age'))
+"""
+import logging
+import os
+import time
+from pathlib import Path, PurePosixPath
+
+import local_db
+
+_logger = logging.getLogger('ibllib')
+
+BATCH_SIZE = 1000  # number of folders listed between two commits
+COLLECTION_TYPES = ('raw_ephys_data', 'raw_video_data', 'raw_behavior_data', 'alf', 'spike_sorters')
+# SQL expressions of the usage groupings, see FileIndex.usage
+USAGE_GROUPS = {
+    'subject': 'subject',
+    'date': 'date',
+    'collection': f"CASE WHEN collection IN {COLLECTION_TYPES} THEN collection ELSE 'other' END",
+    'age': """CASE WHEN julianday(date) IS NULL THEN 'unknown'
+        WHEN julianday('now') - julianday(date) < 30 THEN '<30d'
+        WHEN julianday('now') - julianday(date) < 90 THEN '30-90d'
+        WHEN julianday('now') - julianday(date) < 365 THEN '90d-1y'
+        WHEN julianday('now') - julianday(date) < 730 THEN '1-2y'
+        ELSE '>2y' END""",
+}
+
+
+def _subtree(path):
+    """SQL range of the paths below a folder: '/' + 1 == '0', this doesn't suffer from LIKE wildcards"""
+    return path + '/', path + '0'
+
+
+class FileIndex:
+    """
+    SQLite index of the files below a root folder
+    :param root_path: root folder, e.g. /mnt/s0/Data/Subjects
+    :param db_file: optional database file, defaults to local_db.STATE_DIR/file_index.sqlite
+    """
+    def __init__(self, root_path, db_file=None):
+        self.root_path = Path(root_path)
+        self.root = str(self.root_path)
+        self.con = local_db.connect('file_index', db_file=db_file)
+        new_usage = self.con.execute("SELECT name FROM sqlite_master WHERE name = 'usage'").fetchone() is None
+        with self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL)')
+            self.con.execute('CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)')
+            self.con.execute("""CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, dir TEXT, name TEXT, size INTEGER, mtime REAL)""")
+            self.con.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+            self.con.execute('CREATE INDEX IF NOT EXISTS files_name ON files (name)')
+            self.con.execute('CREATE TABLE IF NOT EXISTS refreshes (root TEXT PRIMARY KEY, last_refresh REAL)')
+            self.con.execute("""CREATE TABLE IF NOT EXISTS usage (
+                root TEXT, subject TEXT, date TEXT, collection TEXT, n_files INTEGER, size INTEGER,
+                PRIMARY KEY (root, subject, date, collection))""")
+        if new_usage:
+            # index created before the usage rollups
+            self.rebuild_usage()
+
+    @property
+    def last_refresh(self):
+        row = self.con.execute('SELECT last_refresh FROM refreshes WHERE root = ?', (self.root,)).fetchone()
+        return row['last_refresh'] if row else None
+
+    def _usage_key(self, dir_path):
+        """(subject, date, collection) of a folder: Subjects/subject/date/number/collection/..."""
+        parts = Path(dir_path).relative_to(self.root_path).parts
+        return (parts + ('',) * 4)[:2] + (parts[3] if len(parts) > 3 else '',)
+
+    def _update_usage(self, deltas):
+        """:param deltas: dict {(subject, date, collection): (n_files, size)} added to the rollups"""
+        self.con.executemany("""INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (root, subject, date, collection) DO UPDATE
+            SET n_files = n_files + excluded.n_files, size = size + excluded.size""",
+                             [(self.root, *k, n, size) for k, (n, size) in deltas.items() if n or size])
+        if any(n < 0 for n, _ in deltas.values()):
+            self.con.execute('DELETE FROM usage WHERE n_files <= 0')
+
+    def _dir_usage(self, where, args):
+        """Rollup of the indexed files of the folders selected by an SQL condition on files.dir"""
+        deltas = {}
+        for r in self.con.execute(f'SELECT dir, COUNT(*) AS n, SUM(size) AS size FROM files WHERE {where} GROUP BY dir',
+                                  args):
+            n, size = deltas.get(key := self._usage_key(r['dir']), (0, 0))
+            deltas[key] = (n + r['n'], size + (r['size'] or 0))
+        return deltas
+
+    def rebuild_usage(self):
+        """Recomputes the usage rollups of the root from the indexed files"""
+        with self.con:
+            self.con.execute('DELETE FROM usage WHERE root = ?', (self.root,))
+            self._update_usage(self._dir_usage('dir = ? OR (dir >= ? AND dir < ?)', (self.root, *_subtree(self.root))))
+
+    def _remove_dir(self, path):
+        lo, hi = _subtree(path)
+        removed = self._dir_usage('dir = ? OR (dir >= ? AND dir < ?)', (path, lo, hi))
+        self._update_usage({k: (-n, -size) for k, (n, size) in removed.items()})
+        self.con.execute('DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)', (path, lo, hi))
+        self.con.execute('DELETE FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)', (path, lo, hi))
+
+    def _list_dir(self, path, mtime):
+        """Lists a folder whose mtime changed, updates its files and returns its sub-folders"""
+        files, dirs = [], {}
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs[entry.path] = entry.stat(follow_symlinks=False).st_mtime
+                        elif entry.is_file():
+                            st = entry.stat()
+                            files.append((entry.path, path, entry.name, st.st_size, st.st_mtime))
+                    except FileNotFoundError:
+                        continue
+        except (FileNotFoundError, NotADirectoryError):
+            self._remove_dir(path)
+            return {}
+        except PermissionError as e:
+            _logger.warning(f'File index: {e}')
+            return {}
+        known_dirs = {r['path'] for r in self.con.execute('SELECT path FROM dirs WHERE parent = ?', (path,))}
+        for removed in known_dirs.difference(dirs):
+            self._remove_dir(removed)
+        n, size = self._dir_usage('dir = ?', (path,)).get(self._usage_key(path), (0, 0))
+        self._update_usage({self._usage_key(path): (len(files) - n, sum(f[3] for f in files) - size)})
+        self.con.execute('DELETE FROM files WHERE dir = ?', (path,))
+        self.con.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)', files)
+        self.con.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                         (path, str(Path(path).parent) if path != self.root else None, mtime))
+        # new sub-folders get a null mtime so that they are listed in turn, even if this refresh is interrupted
+        self.con.executemany('INSERT OR IGNORE INTO dirs VALUES (?, ?, NULL)', [(d, path) for d in dirs])
+        known = {r['path']: r['mtime'] for r in self.con.execute('SELECT path, mtime FROM dirs WHERE parent = ?', (path,))}
+        return {d: (m, known.get(d)) for d, m in dirs.items()}
+
+    def refresh(self):
+        """
+        Updates the index, listing only the folders whose mtime changed since the last refresh
+        :return: dict with the number of folders checked and listed and the duration in seconds
+        """
+        tstart = time.time()
+        n_checked, n_listed = 0, 0
+        try:
+            root_mtime = os.stat(self.root).st_mtime
+        except FileNotFoundError:
+            _logger.error(f'File index: {self.root} not found')
+            return
+        row = self.con.execute('SELECT mtime FROM dirs WHERE path = ?', (self.root,)).fetchone()
+        # stack of (folder, current mtime, indexed mtime)
+        stack = [(self.root, root_mtime, row['mtime'] if row else None)]
+        while stack:
+            path, mtime, indexed_mtime = stack.pop()
+            n_checked += 1
+            if mtime != indexed_mtime:
+                n_listed += 1
+                children = self._list_dir(path, mtime)
+                stack.extend((d, m, im) for d, (m, im) in children.items())
+            else:
+                # the entries are unchanged, only the known sub-folders need checking
+                for r in self.con.execute('SELECT path, mtime FROM dirs WHERE parent = ?', (path,)).fetchall():
+                    try:
+                        stack.append((r['path'], os.stat(r['path']).st_mtime, r['mtime']))
+                    except FileNotFoundError:
+                        self._remove_dir(r['path'])
+            if n_checked % BATCH_SIZE == 0:
+                self.con.commit()
+        self.con.execute('INSERT OR REPLACE INTO refreshes VALUES (?, ?)', (self.root, time.time()))
+        self.con.commit()
+        stats = dict(checked=n_checked, listed=n_listed, duration=time.time() - tstart)
+        _logger.info(f"File index of {self.root} refreshed in {stats['duration']:.1f} s: "
+                     f"{n_listed} of {n_checked} folders listed")
+        return stats
+
+    def rglob(self, pattern, max_age=None, check_exists=True):
+        """
+        Same as Path(root_path).rglob(pattern) for files, from the index
+        :param pattern: file name or trailing path pattern, e.g. 'spike_sorting_ks2.log', '_device/*.yaml'
+        :param max_age: if set, refreshes the index first if the last refresh is older than max_age seconds
+        :param check_exists: if True, skips the indexed files that no longer exist
+        :return: generator of Path, in path order
+        """
+        if max_age is not None and (self.last_refresh or 0) < time.time() - max_age:
+            self.refresh()
+        name = PurePosixPath(pattern).name
+        lo, hi = _subtree(self.root)
+        rows = self.con.execute('SELECT path FROM files WHERE name GLOB ? AND path >= ? AND path < ? ORDER BY path',
+                                (name, lo, hi)).fetchall()
+        for r in rows:
+            file = Path(r['path'])
+            if file.match(pattern) and (not check_exists or file.exists()):
+                yield file
+
+    def stat(self, pattern):
+        """
+        Indexed size and mtime of the files matching a pattern, without touching the file system
+        :param pattern: see rglob
+        :return: list of (Path, size, mtime)
+        """
+        lo, hi = _subtree(self.root)
+        rows = self.con.execute('SELECT path, size, mtime FROM files WHERE name GLOB ? AND path >= ? AND path < ?',
+                                (PurePosixPath(pattern).name, lo, hi))
+        return [(Path(r['path']), r['size'], r['mtime']) for r in rows if Path(r['path']).match(pattern)]
+
+    def files_in(self, folder):
+        """
+        Indexed files directly in a folder, without touching the file system
+        :return: list of (Path, size, mtime)
+        """
+        rows = self.con.execute('SELECT path, size, mtime FROM files WHERE dir = ?', (str(folder),))
+        return [(Path(r['path']), r['size'], r['mtime']) for r in rows]
+
+    def usage(self, by=('subject',)):
+        """
+        Number of files and bytes used, from the rollups kept up to date by refresh
+        :param by: grouping or list of groupings among 'subject', 'date', 'collection', 'age'
+        :return: list of dict with the grouping keys, n_files and size in bytes, largest first
+        """
+        by = (by,) if isinstance(by, str) else tuple(by)
+        columns = ', '.join(f'{USAGE_GROUPS[b]} AS {b}' for b in by)
+        rows = self.con.execute(f"""SELECT {columns}, SUM(n_files) AS n_files, SUM(size) AS size FROM usage
+            WHERE root = ? GROUP BY {', '.join(by)} ORDER BY size DESC""", (self.root,))
+        return [dict(r) for r in rows]
+
+    def close(self):
+        self.con.close()
@@ -0,0 +1,188 @@
+"""
+Throttling of the disk I/O of the background jobs, so that they don't starve the transfers of the rigs.
+
+The governor holds a token bucket of bytes: each copy, deletion or write is charged its volume of
+bytes before it proceeds, and waits while the budget is exhausted. The bucket of the governor
+returned by get_governor is kept in a file of local_db.STATE_DIR, locked at each charge, so that the
+budget is shared by all the processes of the server jobs, including the workers of a process pool.
+The processes sharing a bucket are expected to use the same rate. The process can also be put in
+the idle I/O scheduling class (ionice -c3, inherited by the child processes), in which case it
+only gets disk time when no other process needs it. NB: the I/O classes are only honoured by the
+CFQ and BFQ schedulers.
+The default budget and idle class are read from the IBL_IO_RATE (MB/s, 0 for unlimited) and
+IBL_IO_IDLE environment variables.
+
+>>> governor = get_governor()
+>>> governor.copytree(src, dst)
+>>> with governor.open(file, 'wb') as f:  # writes throttled as they are streamed
+>>>     f.write(data)
+>>> governor.throttle(nbytes)  # before writing nbytes by other means
+>>> governor.unlink(file)
+>>> governor.log_stats()
+"""
+import fcntl
+import logging
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import threading
+import time
+
+import local_db
+
+_logger = logging.getLogger('ibllib')
+
+DEFAULT_RATE = 100  # MB/s
+CHUNK_SIZE = 1024 ** 2 * 8  # bytes per throttled read / write
+DELETE_COST = 1024 ** 2  # bytes charged per file deleted, the deletion of a file costs metadata writes only
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def set_idle_priority(pid=None):
+    """
+    Puts a process in the idle I/O scheduling class, its children inherit it
+    :param pid: defaults to the current process
+    :return: True if the class was set
+    """
+    if shutil.which('ionice') is None:
+        _logger.warning('ionice not found, the I/O priority is unchanged')
+        return False
+    result = subprocess.run(['ionice', '-c3', '-p', str(pid or os.getpid())], capture_output=True, text=True)
+    if result.returncode != 0:
+        _logger.warning(f'ionice failed: {result.stderr.strip()}')
+    return result.returncode == 0
+
+
+class _ThrottledWriter:
+    """File object whose writes are charged to a governor, see IOGovernor.open"""
+    def __init__(self, file, governor):
+        self._file = file
+        self._governor = governor
+
+    def write(self, data):
+        self._governor.throttle(len(data))
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._file.close()
+
+
+class IOGovernor:
+    """
+    Token bucket of bytes shared by the threads of a process, or by several processes through a file
+    :param rate: budget in MB/s, None or 0 for unlimited
+    :param burst: MB that can be spent at once after an idle period, defaults to one second of budget
+    :param idle: if True, the process is put in the idle I/O class
+    :param budget_file: optional file holding the bucket, shared with the other processes using it
+    """
+    def __init__(self, rate=DEFAULT_RATE, burst=None, idle=False, budget_file=None):
+        self.rate = rate * 1024 ** 2 if rate else None
+        self.burst = (burst * 1024 ** 2 if burst else self.rate) or 0
+        self.idle = idle and set_idle_priority()
+        self.budget_file = budget_file
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+        self.stats = dict(bytes=0, ops=0, throttled=0, wait_time=0.)
+
+    def throttle(self, nbytes):
+        """
+        Charges nbytes to the budget, sleeps as long as needed to stay within the rate.
+        A charge larger than the burst is allowed and paid by the following waits.
+        """
+        with self._lock:
+            self.stats['bytes'] += nbytes
+            self.stats['ops'] += 1
+            if not self.rate:
+                return
+            if self.budget_file is None:
+                self._tokens, self._last, wait = self._charge(self._tokens, self._last, nbytes)
+            else:
+                wait = self._charge_shared(nbytes)
+            if wait:
+                self.stats['throttled'] += 1
+                self.stats['wait_time'] += wait
+        # sleeping outside the lock: the debt is already accounted for, the next callers wait longer
+        if wait:
+            time.sleep(wait)
+
+    def _charge(self, tokens, last, nbytes):
+        """
+        Refills the bucket since the last charge and takes nbytes from it
+        :return: tokens left, time of the charge, seconds to wait
+        """
+        now = time.time()
+        tokens = min(self.burst, tokens + max(now - last, 0) * self.rate) - nbytes
+        return tokens, now, -tokens / self.rate if tokens < 0 else 0
+
+    def _charge_shared(self, nbytes):
+        """Same as _charge with the bucket read from and written to the budget file, under an exclusive lock"""
+        # the file is opened at each charge: a descriptor inherited by a forked worker would share the lock
+        with open(self.budget_file, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                tokens, last = map(float, f.read().split())
+            except ValueError:  # new file
+                tokens, last = self.burst, time.time()
+            tokens, last, wait = self._charge(tokens, last, nbytes)
+            f.truncate(0)
+            f.write(f'{tokens} {last}')
+        return wait
+
+    def open(self, path, mode='wb'):
+        """
+        Opens a file whose writes are throttled as they are streamed, e.g. as the fileobj of a tarfile.
+        Each write is charged: write in blocks of about CHUNK_SIZE bytes.
+        """
+        return _ThrottledWriter(open(path, mode), self)
+
+    def copyfile(self, src, dst, *args, **kwargs):
+        """Same as shutil.copy2 with the data throttled chunk by chunk, usable as copy_function"""
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            while chunk := fsrc.read(CHUNK_SIZE):
+                self.throttle(len(chunk))
+                fdst.write(chunk)
+        shutil.copystat(src, dst)
+        return dst
+
+    def copytree(self, src, dst, **kwargs):
+        """Same as shutil.copytree, throttled"""
+        return shutil.copytree(src, dst, copy_function=self.copyfile, **kwargs)
+
+    def unlink(self, path, missing_ok=False):
+        """Deletes a file, charged DELETE_COST bytes"""
+        self.throttle(DELETE_COST)
+        Path(path).unlink(missing_ok=missing_ok)
+
+    def log_stats(self, label='I/O governor'):
+        s = self.stats
+        _logger.info(f"{label}: {s['bytes'] / 1024 ** 3:.2f} GB in {s['ops']} operations, "
+                     f"throttled {s['throttled']} times for {s['wait_time']:.1f} s"
+                     f"{', idle I/O class' if self.idle else ''}")
+
+
+def get_governor():
+    """
+    Governor of the process, configured from the IBL_IO_RATE and IBL_IO_IDLE environment variables.
+    Its budget is shared with the governors of the other processes, see the module docstring
+    """
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            rate = float(os.environ.get('IBL_IO_RATE', DEFAULT_RATE))
+            idle = os.environ.get('IBL_IO_IDLE', '').lower() in ('1', 'true', 'yes')
+            local_db.STATE_DIR.mkdir(parents=True, exist_ok=True)
+            _governor = IOGovernor(rate=rate, idle=idle, budget_file=local_db.STATE_DIR.joinpath('io_budget'))
+        return _governor
@@ -1,20 +1,39 @@
 import argparse
+import functools
+import json
 import logging
+import os
 from pathlib import Path
 import socket
-import time
+import threading
+import traceback
 
 from one.api import ONE
-from ibllib.pipes.local_server import job_creator, task_queue, tasks_runner, report_health
+from ibllib.pipes.local_server import job_creator, report_health
+
+from disk_usage import report_usage
+from queue_mirror import task_queue
+from metrics import get_metrics
+from polling import send_wake
+from scheduler import Scheduler
+import task_profiling
+from session_watcher import SessionWatcher, inotify_available, SETTLE_TIME
+from task_pool import run_tasks_serial, run_tasks_parallel, run_session_groups, parse_task_caps
 
 DEFINED_PORTS = {
     'run': 54320,
     'run_small': 54320,
     'create': 54321,
     'report': 54322,
+    'daemon': 54323,
+    'small_jobs': 54324,
+    'large_jobs': 54325,
 }
 
+RECONCILE_PERIOD = 3600  # full scan period of the create job when driven by file system events
+
 _logger = logging.getLogger('ibllib')
+_create_lock = threading.Lock()  # the full scan and the event driven job creation don't overlap
 
 
 def _parametrized(dec):
@@ -29,79 +48,93 @@ def _parametrized(dec):
 def forever(func, port=None, sleep=600):
     """
     Runs function forever, with a sleep time between successive runs.
-    Relies on socket and checks every 2 seconds between function calls for termination requests
-    (if the socket receives 'STOP' , the loop exits gracefully)
-    Can't run at a rate higher than 2 seconds as it.
+    The scheduler blocks on the control socket and the next run time, so that termination
+    requests (if the socket receives 'STOP', the loop exits gracefully after the current run)
+    and health checks are answered immediately.
     Allows only a single instance by binding to a unique port so subsequent attempts to run
     will indicate that the process is already running and result in an error
     :param port:
     :param sleep:
     :return:
     """
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         assert port
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.settimeout(0.1)
+        scheduler = Scheduler()
+        timer = scheduler.add_timer(func.__name__, func, sleep, args=args, kwargs=kwargs)
         try:
-            s.bind(('localhost', port))
+            scheduler.listen(port, [timer])
         except OSError:
+            scheduler.close()
             print("One instance of the job is already running. Exiting now.")
             return
-        t = 0
-        # loop every 2 seconds to check the socket for termination request.
-        # if the cumulative time is greater than sleep, run the function and re-init t
-        while True:
-            try:
-                # check if a message has been received
-                data, address = s.recvfrom(4096)
-                if data == b'STOP':
-                    print('ABORT !!')
-                    s.sendto(b'ACK STOP', address)
-                    return
-                elif data == b'CHECK':
-                    s.sendto(b"I'm fine, helicopter mum", address)
-            except socket.timeout:
-                pass
-            if (time.time() - t) > sleep:
-                t = time.time()
-                func(*args, **kwargs)
-            time.sleep(2)
+        scheduler.run()
+    wrapper.period = sleep
     return wrapper
 
 
+def _run_queue(subjects_path, mode, dry=False, lab=None, count=20, workers=1, max_per_task=None, metrics=None):
+    """
+    Runs the waiting tasks of the queue, either one after the other or in a pool of processes
+    :param subjects_path: "/mnt/s0/Data/Subjects"
+    :param mode: 'all', 'small' or 'large', see task_queue. The small tasks are run grouped by session
+    :param workers: number of worker processes, if 1 the tasks are run serially in this process
+    :param max_per_task: dict of maximum number of concurrent tasks per task name. For the small tasks, a
+     session is held back while one of its task names is at its cap
+    :param metrics: optional metrics.JobMetrics instance recording the queue depth and task durations
+    """
+    one = ONE(cache_rest=None)
+    waiting_tasks = task_queue(mode=mode, lab=lab, alyx=one.alyx)
+    if metrics:
+        metrics.queue_depth = len(waiting_tasks)
+    if mode == 'small':
+        # the small tasks of a session run back-to-back in the same worker, sharing the raw data they load
+        run_session_groups(subjects_path, waiting_tasks, one=one, n_workers=workers, max_per_task=max_per_task,
+                           count=count, time_out=3600, dry=dry, metrics=metrics)
+    elif workers > 1:
+        run_tasks_parallel(subjects_path, waiting_tasks, one=one, n_workers=workers,
+                           max_per_task=max_per_task, count=count, time_out=3600, dry=dry, metrics=metrics)
+    else:
+        run_tasks_serial(subjects_path, waiting_tasks, one=one, count=count, time_out=3600, dry=dry, metrics=metrics)
+
+
 @forever(DEFINED_PORTS['run'], 600)
-def run_tasks(subjects_path, dry=False, lab=None, count=20):
+def run_tasks(subjects_path, dry=False, lab=None, count=20, workers=1, max_per_task=None):
     """
     Runs task backlog from task records in Alyx for this server
     :param subjects_path: "/mnt/s0/Data/Subjects"
     :param dry:
+    :param workers: number of tasks to run concurrently
+    :param max_per_task: dict of maximum number of concurrent tasks per task name
     :return:
     """
-    one = ONE(cache_rest=None)
-    waiting_tasks = task_queue(mode='all', lab=lab, alyx=one.alyx)
-    tasks_runner(subjects_path, waiting_tasks, one=one, count=count, time_out=3600, dry=dry)
+    _run_queue(subjects_path, 'all', dry=dry, lab=lab, count=count, workers=workers, max_per_task=max_per_task,
+               metrics=get_metrics('run_tasks'))
 
 
 @forever(DEFINED_PORTS['run_small'], 600)
-def run_tasks_small(subjects_path, dry=False, lab=None, count=20):
+def run_tasks_small(subjects_path, dry=False, lab=None, count=20, workers=1, max_per_task=None):
     """
     Runs backlog of tasks excluding video compression, spike sorting and dlc from task records in Alyx for this server
     :param subjects_path: "/mnt/s0/Data/Subjects"
     :param dry:
+    :param workers: number of sessions to process concurrently
+    :param max_per_task: dict of maximum number of concurrent tasks per task name, a session is held back
+     while one of its task names is at its cap
     :return:
     """
-    one = ONE(cache_rest=None)
-    waiting_tasks = task_queue(mode='small', lab=lab, alyx=one.alyx)
-    tasks_runner(subjects_path, waiting_tasks, one=one, count=count, time_out=3600, dry=dry)
+    _run_queue(subjects_path, 'small', dry=dry, lab=lab, count=count, workers=workers, max_per_task=max_per_task,
+               metrics=get_metrics('run_tasks_small'))
 
 
 @forever(DEFINED_PORTS['report'], 3600 * 2)
 def report():
     """
-    Labels the lab endpoint json field with health indicators every 2 hours
+    Labels the lab endpoint json field with health indicators and disk usage every 2 hours
     """
     one = ONE(cache_rest=None)
     report_health(one=one)
+    report_usage(one=one)
 
 
 @forever(DEFINED_PORTS['create'], 60 * 15)
@@ -111,7 +144,82 @@ def create_sessions(root_path, dry=False):
     create the session on Alyx if it doesn't already exist, register the raw data and create
     the tasks backlog
     """
-    job_creator(root_path, dry=dry)
+    with _create_lock:
+        out = job_creator(root_path, dry=dry)
+    if _created_any(out):
+        _wake_runners()
+
+
+def _created_any(out):
+    """Whether job_creator created anything, whatever the structure of its output"""
+    return any(map(bool, out)) if isinstance(out, tuple) else bool(out)
+
+
+def _wake_runners():
+    """Wakes up the task runners so that the tasks just created are run without waiting for the next poll"""
+    send_wake(DEFINED_PORTS['run'], DEFINED_PORTS['small_jobs'], DEFINED_PORTS['large_jobs'])
+
+
+def _add_create_watch(scheduler, root_path, dry=False):
+    """
+    Adds the create job to a scheduler, driven by the inotify events of the new flags with a
+    periodic full scan for reconciliation. Falls back to the periodic full scan only if inotify
+    is not available.
+    :param scheduler: Scheduler instance
+    :param root_path: "/mnt/s0/Data/Subjects"
+    :return: list of timers
+    """
+    full_scan = scheduler.add_timer('create', create_sessions.__wrapped__, create_sessions.period,
+                                    args=(root_path, dry))
+    try:
+        if not inotify_available():
+            raise OSError('inotify is only available on Linux')
+        watcher = SessionWatcher(root_path)
+    except OSError as e:
+        _logger.warning(f'Could not watch {root_path}, falling back to periodic scans: {e}')
+        return [full_scan]
+    full_scan.period = RECONCILE_PERIOD
+
+    def create_settled_sessions():
+        session_paths, next_in = watcher.pop_settled()
+        for session_path in session_paths:
+            _logger.info(f'Creating jobs for new flag in {session_path}')
+            try:
+                with _create_lock:
+                    job_creator(session_path, dry=dry)
+            except Exception:
+                _logger.error(f'Error creating jobs for {session_path}\n{traceback.format_exc()}')
+        if session_paths:
+            _wake_runners()
+        if next_in is not None:
+            scheduler.wake(incremental, delay=next_in)
+
+    def on_events():
+        watcher.read_events()
+        if watcher.overflowed:
+            watcher.overflowed = False
+            scheduler.wake(full_scan)
+        if watcher.pending:
+            scheduler.wake(incremental, delay=SETTLE_TIME)
+
+    incremental = scheduler.add_timer('create_watch', create_settled_sessions, None)
+    scheduler.add_reader(watcher, on_events)
+    return [full_scan, incremental]
+
+
+def watch_sessions(root_path, dry=False):
+    """
+    Create sessions within seconds of the flag files being written, see _add_create_watch
+    """
+    scheduler = Scheduler()
+    timers = _add_create_watch(scheduler, root_path, dry=dry)
+    try:
+        scheduler.listen(DEFINED_PORTS['create'], timers)
+    except OSError:
+        scheduler.close()
+        print("One instance of the job is already running. Exiting now.")
+        return
+    scheduler.run()
 
 
 @forever(DEFINED_PORTS['create'], 4)
@@ -119,17 +227,75 @@ def test_fcn():
     print('Toto')
 
 
-def _send2job(name, bmessage):
+def daemon(jobs, subjects_path, dry=False, workers=1, max_per_task=None, watch=False):
+    """
+    Hosts several jobs as timers of a single resident process.
+    The process listens on the daemon port, where 'STOP' terminates all jobs, and on the port of
+    each hosted job, where 'STOP' only terminates that job. This also prevents the hosted jobs
+    from being started as separate processes.
+    :param jobs: list of job names among 'create', 'run', 'run_small' and 'report'
+    :param subjects_path: "/mnt/s0/Data/Subjects"
+    :param watch: if True, the create job is driven by file system events, see _add_create_watch
+    """
+    run_kwargs = dict(dry=dry, workers=workers, max_per_task=max_per_task)
+    job_functions = {
+        'create': (create_sessions, (subjects_path, dry), {}),
+        'run': (run_tasks, (subjects_path,), run_kwargs),
+        'run_small': (run_tasks_small, (subjects_path,), run_kwargs),
+        'report': (report, (), {}),
+    }
+    scheduler = Scheduler()
+    timers = {}
+    for name in jobs:
+        if name == 'create' and watch:
+            timers[name] = _add_create_watch(scheduler, subjects_path, dry=dry)
+            continue
+        wrapper, args, kwargs = job_functions[name]
+        timers[name] = [scheduler.add_timer(name, wrapper.__wrapped__, wrapper.period, args=args, kwargs=kwargs)]
+    try:
+        scheduler.listen(DEFINED_PORTS['daemon'], scheduler.timers)
+        for port in set(DEFINED_PORTS[name] for name in jobs):
+            scheduler.listen(port, [t for name in jobs if DEFINED_PORTS[name] == port for t in timers[name]])
+    except OSError:
+        scheduler.close()
+        print("One instance of the daemon or of one of its jobs is already running. Exiting now.")
+        return
+    scheduler.run()
+
+
+def _send2job(name, bmessage, verbose=True):
     port = DEFINED_PORTS[name]
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
         s.connect(('localhost', port))
         s.send(bmessage)
         print('status/kill request sent, waiting for job response')
-        print(str(s.recv(4096)))
+        response = s.recv(65535)
+        if verbose:
+            print(str(response))
     except ConnectionRefusedError:
         print("Job doesn't seem to be running")
         return -1
+    return response
+
+
+def print_stats(name):
+    """
+    Prints the metrics of a running job: last run, tasks processed and failed, queue depth,
+    process memory and per task name duration percentiles
+    """
+    response = _send2job(name, b"CHECK", verbose=False)
+    if response == -1:
+        return -1
+    stats = json.loads(response)
+    print(f"pid {stats['pid']}, RSS {stats['rss_mb']} MB")
+    for job, m in stats['jobs'].items():
+        print(f"\n{job}: {'running' if m['running'] else 'idle'}, {m['runs']} runs, last run started "
+              f"{m['last_run_start']} and lasted {m['last_run_duration']} s")
+        print(f"    tasks processed: {m['tasks_processed']}, failed: {m['tasks_failed']}, "
+              f"queue depth: {m['queue_depth']}")
+        for task_name, d in sorted(m['task_durations'].items()):
+            print(f"    {task_name:<40} n={d['n']:<5} p50={d['p50']:10.1f} s  p95={d['p95']:10.1f} s")
     return 0
 
 
@@ -139,20 +305,25 @@ if __name__ == "__main__":
     Run: run the tasks labeled as waiting on Alyx
     Report: label the corresponding lab json field with server health indicators
     Launch neverending jobs (only single instance allowed):
-        python jobs.py create /mnt/s0/Data (--dry, --restart)
+        python jobs.py create /mnt/s0/Data (--dry, --restart, --watch)
         python jobs.py run /mnt/s0/Data (--dry, --restart)
+        python jobs.py run_small /mnt/s0/Data --workers 16 --max-per-task EphysPulses=2 (--profile)
         python jobs.py report
+    Or host several of them in a single process:
+        python jobs.py daemon /mnt/s0/Data --jobs create run_small report
     Check them:
         python jobs.py status create
         python jobs.py status run
         python jobs.py status report
+    Print their metrics (last run, tasks processed and failed, queue depth, memory, task durations):
+        python jobs.py stats run
     Kill them:
         python jobs.py kill create
         python jobs.py kill run
         python jobs.py kill report
     """
-    JOBS = ['create', 'run', 'run_small', 'test', 'report']
-    ALLOWED_ACTIONS = ['kill', 'status'] + JOBS
+    JOBS = ['create', 'run', 'run_small', 'test', 'report', 'daemon']
+    ALLOWED_ACTIONS = ['kill', 'status', 'stats'] + JOBS
 
     parser = argparse.ArgumentParser(description='Creates jobs for new sessions')
     parser.add_argument('action', help='Action: ' + ','.join(ALLOWED_ACTIONS))
@@ -160,23 +331,39 @@ if __name__ == "__main__":
     parser.add_argument('--dry', help='Dry Run', required=False, action='store_true')
     parser.add_argument('--restart', help='Restart if running', required=False,
                         action='store_true')
+    parser.add_argument('--workers', help='Number of tasks to run concurrently (run, run_small)',
+                        required=False, default=1, type=int)
+    parser.add_argument('--max-per-task', help='Maximum concurrent tasks for a task name, e.g. EphysPulses=2',
+                        required=False, nargs='*', default=None)
+    parser.add_argument('--watch', help='Create sessions on file system events (create, daemon)',
+                        required=False, action='store_true')
+    parser.add_argument('--profile', help='Save a cProfile/tracemalloc profile of each task, see task_profiling.py',
+                        required=False, action='store_true')
+    parser.add_argument('--jobs', help='Jobs hosted by the daemon', required=False, nargs='*',
+                        default=['create', 'run_small', 'report'])
 
     args = parser.parse_args()  # returns data from the options specified (echo)
+    if args.profile:
+        os.environ[task_profiling.ENV_VAR] = '1'  # inherited by the worker processes
     if args.action == 'create':
         assert (Path(args.folder).exists())
         if args.restart:
             _send2job(args.action, b"STOP")
-        create_sessions(args.folder, args.dry)
+        if args.watch:
+            watch_sessions(args.folder, args.dry)
+        else:
+            create_sessions(args.folder, args.dry)
     elif args.action == 'run':
         assert (Path(args.folder).exists())
         if args.restart:
             _send2job('run', b"STOP")
-        run_tasks(args.folder, args.dry)
+        run_tasks(args.folder, args.dry, workers=args.workers, max_per_task=parse_task_caps(args.max_per_task))
     elif args.action == 'run_small':
         assert (Path(args.folder).exists())
         if args.restart:
             _send2job('run_small', b"STOP")
-        run_tasks_small(args.folder, args.dry)
+        run_tasks_small(args.folder, args.dry, workers=args.workers,
+                        max_per_task=parse_task_caps(args.max_per_task))
     elif args.action == 'report':
         if args.restart:
             _send2job('report', b"STOP")
@@ -185,12 +372,20 @@ if __name__ == "__main__":
         if args.restart:
             _send2job('create', b"STOP")
         test_fcn()
+    elif args.action == 'daemon':
+        assert (Path(args.folder).exists())
+        if args.restart:
+            _send2job('daemon', b"STOP")
+        daemon(args.jobs, args.folder, args.dry, workers=args.workers,
+               max_per_task=parse_task_caps(args.max_per_task), watch=args.watch)
     elif args.action == 'kill':
-        if _send2job(args.folder, b"STOP") == 0:
+        if _send2job(args.folder, b"STOP") != -1:
             print('Job terminated successfully')
     elif args.action == 'status':
-        if _send2job(args.folder, b"CHECK") == 0:
+        if _send2job(args.folder, b"CHECK") != -1:
             print('Job seems to be alright')
+    elif args.action == 'stats':
+        print_stats(args.folder)
     else:
         _logger.error(f'Action "{args.action}" not valid. Allowed actions are: '
                       f'{"., ".join(ALLOWED_ACTIONS)}')
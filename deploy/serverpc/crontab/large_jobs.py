@@ -1,31 +1,39 @@
 import traceback
-import time
 import logging
 from pathlib import Path
 
 from one.api import ONE
-from ibllib.pipes.local_server import task_queue
-from ibllib.pipes.tasks import run_alyx_task
+
+from queue_mirror import task_queue
+from task_pool import run_tasks_parallel
+from admission import ResourceAdmission
+from polling import AdaptiveBackoff, wait_for_wake
+from jobs import DEFINED_PORTS
 
 _logger = logging.getLogger('ibllib')
 subjects_path = Path('/mnt/s0/Data/Subjects/')
-sleep_time = 3600
+backoff = AdaptiveBackoff('large_jobs')  # sleep time doubles from 30s up to 60min while the queue is empty
+max_tasks = 4  # maximum number of large tasks running at the same time
 
 try:
     one = ONE(cache_rest=None)
     waiting_tasks = task_queue(mode='large', lab=None, alyx=one.alyx)
 
     if len(waiting_tasks) == 0:
-        _logger.info(f'No large tasks in the queue, retrying in {int(sleep_time / 60)} min')
-        # Query again only in 60min if queue is empty
-        time.sleep(sleep_time)
+        sleep_time = backoff.idle()
+        _logger.info(f'No large tasks in the queue, retrying in {int(sleep_time / 60)} min or when woken up')
+        wait_for_wake(DEFINED_PORTS['large_jobs'], sleep_time)
     else:
-        tdict = waiting_tasks[0]
-        _logger.info(f"Running task {tdict['name']} for session {tdict['session']}")
-        ses = one.alyx.rest('sessions', 'list', django=f"pk,{tdict['session']}")[0]
-        session_path = Path(subjects_path).joinpath(
-            Path(ses['subject'], ses['start_time'][:10], str(ses['number']).zfill(3)))
-        run_alyx_task(tdict=tdict, session_path=session_path, one=one)
+        # Run as many large tasks at once as the resources of the server allow, dispatching new
+        # tasks for at most an hour so that the service loop can check the environments for updates
+        admission = ResourceAdmission()
+        dsets = run_tasks_parallel(subjects_path, waiting_tasks, one=one, n_workers=max_tasks, count=max_tasks,
+                                   time_out=3600, admit=admission.admit)
+        if dsets:
+            backoff.reset()
+        else:
+            # nothing was admitted or registered, don't poll the queue again straight away
+            wait_for_wake(DEFINED_PORTS['large_jobs'], backoff.idle())
 except Exception:
     _logger.error(f'Error running large task queue \n {traceback.format_exc()}')
-    time.sleep(int(sleep_time / 2))
+    wait_for_wake(DEFINED_PORTS['large_jobs'], backoff.idle())
@@ -0,0 +1,25 @@
+"""
+Local SQLite databases holding the persistent state of the server jobs.
+Each component uses its own database file in STATE_DIR so that the jobs running in separate
+processes don't contend for the same lock.
+"""
+from pathlib import Path
+import sqlite3
+
+STATE_DIR = Path.home().joinpath('.ibl_server')
+
+
+def connect(name, db_file=None):
+    """
+    Opens a connection to a local state database, creating the file if needed
+    :param name: database name, the file is STATE_DIR/<name>.sqlite
+    :param db_file: optional full path of the database file, overrides name
+    :return: sqlite3.Connection with rows returned as sqlite3.Row
+    """
+    db_file = Path(db_file or STATE_DIR.joinpath(f'{name}.sqlite'))
+    db_file.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(db_file, timeout=60)
+    con.row_factory = sqlite3.Row
+    # write ahead logging allows the readers of other processes to proceed while a job writes
+    con.execute('PRAGMA journal_mode=WAL')
+    return con
@@ -1,10 +1,14 @@
+from collections import Counter, defaultdict
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
+import functools
 import logging
 import os
 from datetime import datetime
-import shutil
+import tarfile
+import time
 
-import numpy as np
 from one.api import ONE
 from one.alf.files import get_session_path
 from one.remote.globus import get_lab_from_endpoint_id
@@ -18,17 +22,41 @@ from ibllib.pipes.local_server import _get_volume_usage
 import ibllib.io.session_params as session_params
 from ibllib.pipes.dynamic_pipeline import acquisition_description_legacy_session
 
+from checkpoints import Checkpoints
+from file_index import FileIndex
+from io_governor import CHUNK_SIZE, get_governor, set_idle_priority
+import reclaim
+from session_catalog import SessionCatalog
+from session_resolver import SessionResolver
+from session_walker import glob_sessions
+from sweep import Sweep
 
 ROOT_PATH = Path('/mnt/s0/Data/Subjects')
+FILE_INDEX_MAX_AGE = 600  # seconds after which the file index is refreshed before a query
+N_TAR_WORKERS = 4  # number of ks2 outputs tarred at the same time
+MIN_DISK_AVAILABLE = 500  # GB, no new ks2 tar is started below this
+REST_BATCH_SIZE = 100  # maximum number of sessions per Alyx query
 
 _logger = logging.getLogger('ibllib')
 
 
+def _rglob(pattern, index=None):
+    """
+    Same as ROOT_PATH.rglob(pattern) for files, from the persistent file index, see file_index.py
+    :param index: optional FileIndex of ROOT_PATH opened for the run, else an index is opened and closed
+    :return: list of Path
+    """
+    if index is not None:
+        return list(index.rglob(pattern, max_age=FILE_INDEX_MAX_AGE))
+    with closing(FileIndex(ROOT_PATH)) as index:
+        return list(index.rglob(pattern, max_age=FILE_INDEX_MAX_AGE))
+
+
 def correct_ephys_manual_video_copies():
     """
     FIXME What does this function do???
     """
-    for flag in ROOT_PATH.rglob('ephys_data_transferred.flag'):
+    for flag in _rglob('ephys_data_transferred.flag'):
         video = True
         passive = True
         behaviour = True
@@ -44,23 +72,101 @@ def correct_ephys_manual_video_copies():
         _logger.info(f"{session_path} V{video}, B{behaviour}, P{passive}")
 
 
+def _session_catalog(index=None):
+    """Session catalog updated from the file index, see session_catalog.py"""
+    if index is None:
+        with closing(FileIndex(ROOT_PATH)) as index:
+            return _session_catalog(index=index)
+    if (index.last_refresh or 0) < time.time() - FILE_INDEX_MAX_AGE:
+        index.refresh()
+    return SessionCatalog(ROOT_PATH, index=index).update()
+
+
+def _biased_ephys_sessions(catalog):
+    """Paths of the biased choice world sessions acquired on an ephys rig, from the session catalog"""
+    selection = catalog['rig'].str.contains('ephys', na=False) & (catalog['protocol'] == '_iblrig_tasks_biasedChoiceWorld')
+    return set(map(Path, catalog.loc[selection, 'session_path']))
+
+
+def _correct_flag_biased_in_ephys_rig(flag, n_days=7, biased_ephys=None):
+    """
+    Handles one video_data_transferred.flag, see correct_flags_biased_in_ephys_rig
+    :param biased_ephys: set of the biased sessions acquired on ephys rigs, if None the session settings are read
+    """
+    session_path = get_session_path(flag)
+    ses_date = datetime.strptime(session_path.parts[-2], "%Y-%m-%d")
+    if (datetime.now() - ses_date).days > n_days:
+        if biased_ephys is None:
+            settings = raw.load_settings(session_path)
+            is_biased_ephys = settings is not None and (
+                'ephys' in settings['PYBPOD_BOARD'] and settings['PYBPOD_PROTOCOL'] == '_iblrig_tasks_biasedChoiceWorld')
+        else:
+            is_biased_ephys = session_path in biased_ephys
+        if is_biased_ephys:
+            _logger.info(session_path)
+            flag.unlink()
+            session_path.joinpath('raw_session.flag').touch()
+
+
 def correct_flags_biased_in_ephys_rig():
     """
     Biased sessions acquired on ephys rigs do not convert video transferred flag
     To not interfere with ongoing transfers, only handle sessions that are older than 7 days
     """
-    N_DAYS = 7
-    for flag in ROOT_PATH.rglob('video_data_transferred.flag'):
-        session_path = get_session_path(flag)
-        ses_date = datetime.strptime(session_path.parts[-2], "%Y-%M-%d")
-        if (datetime.now() - ses_date).days > N_DAYS:
-            settings = raw.load_settings(session_path)
-            if settings is not None:
-                if ('ephys' in settings['PYBPOD_BOARD'] and
-                        settings['PYBPOD_PROTOCOL'] == '_iblrig_tasks_biasedChoiceWorld'):
-                    _logger.info(session_path)
-                    flag.unlink()
-                    session_path.joinpath('raw_session.flag').touch()
+    with closing(FileIndex(ROOT_PATH)) as index:
+        flags = _rglob('video_data_transferred.flag', index=index)
+        biased_ephys = _biased_ephys_sessions(_session_catalog(index=index))
+    for flag in flags:
+        _correct_flag_biased_in_ephys_rig(flag, biased_ephys=biased_ephys)
+
+
+def _passive_target(flag):
+    """Session path where the passive data of a passive_data_for_ephys.flag belongs: the other, or latest, session of the day"""
+    passive_data_path = get_session_path(flag)
+    # find the session number that isn't, if more than one we register passive to the latest one
+    data_sess = sorted(sess for sess in os.listdir(passive_data_path.parent) if sess != passive_data_path.stem)
+    return passive_data_path.parent.joinpath(data_sess[-1])
+
+
+def _resolve_passive_targets(flags, one):
+    """
+    Eids of the sessions receiving the passive data of the flags, resolved in a single call
+    :return: dict {session_path: eid or None}
+    """
+    session_paths = []
+    for flag in flags:
+        try:
+            session_paths.append(_passive_target(flag))
+        except (OSError, IndexError) as e:
+            _logger.warning(f'No session found for the passive data of {flag}: {e}')
+    return SessionResolver(one).resolve(session_paths)
+
+
+def _correct_passive_in_wrong_folder(flag, one=None, eids=None):
+    """
+    Handles one passive_data_for_ephys.flag, see correct_passive_in_wrong_folder
+    :param eids: dict {session_path: eid} of the sessions receiving the passive data, see _resolve_passive_targets
+    """
+    passive_data_path = get_session_path(flag)
+    passive_folder = passive_data_path.joinpath('raw_behavior_data')
+    session_path = _passive_target(flag)
+
+    # copy the file
+    data_path = session_path.joinpath('raw_passive_data')
+    get_governor().copytree(passive_folder, data_path)
+    _logger.info(f'moved {passive_folder} to {data_path}')
+
+    # remove the passive flag
+    flag.unlink()
+
+    # find the tasks for this session and set it to waiting
+    if eids is None or session_path not in eids:
+        eids = SessionResolver(one).resolve([session_path])
+    if eid := eids[session_path]:
+        tasks = one.alyx.rest('tasks', 'list', session=eid, name='TrainingRegisterRaw')
+        if len(tasks) > 0:
+            stat = {'status': 'Waiting'}
+            one.alyx.rest('tasks', 'partial_update', id=tasks[0]['id'], data=stat)
 
 
 def correct_passive_in_wrong_folder():
@@ -71,40 +177,10 @@ def correct_passive_in_wrong_folder():
     one = ONE(cache_rest=None)
     lab = get_lab_from_endpoint_id(alyx=one.alyx)
     if lab[0] == 'wittenlab':
-
-        for flag in ROOT_PATH.rglob('passive_data_for_ephys.flag'):
-            passive_data_path = get_session_path(flag)
-            passive_session = passive_data_path.stem
-            passive_folder = passive_data_path.joinpath('raw_behavior_data')
-            sessions = os.listdir(passive_data_path.parent)
-
-            # find the session number that isn't
-            data_sess = [sess for sess in sessions if sess != passive_session]
-            if len(data_sess) == 1:
-                session_path = passive_data_path.parent.joinpath(data_sess[0])
-            else:
-                # If more than one we register passive to the latest one
-                data_sess.sort()
-                session_path = passive_data_path.parent.joinpath(data_sess[-1])
-
-            # copy the file
-            data_path = session_path.joinpath('raw_passive_data')
-            shutil.copytree(passive_folder, data_path)
-            _logger.info(f'moved {passive_folder} to {data_path}')
-
-            # remove the passive flag
-            flag.unlink()
-
-            # find the tasks for this session and set it to waiting
-            eid = one.path2eid(session_path)
-            if eid:
-                tasks = one.alyx.rest('tasks', 'list', session=eid, name='TrainingRegisterRaw')
-                if len(tasks) > 0:
-                    stat = {'status': 'Waiting'}
-                    one.alyx.rest('tasks', 'partial_update', id=tasks[0]['id'], data=stat)
-
-    else:
-        return
+        flags = _rglob('passive_data_for_ephys.flag')
+        eids = _resolve_passive_targets(flags, one)
+        for flag in flags:
+            _correct_passive_in_wrong_folder(flag, one=one, eids=eids)
 
 
 def spike_amplitude_patching():
@@ -174,23 +250,26 @@ def spike_amplitude_patching():
 
     one = ONE(cache_rest=None)
 
-    for ks2_out in ROOT_PATH.rglob('spike_sorting_ks2.log'):
+    # probes already looked at, the amps_patching_local_server2.flag files of previous versions are honoured
+    checkpoints = Checkpoints('spike_amplitude_patching')
+    ks2_outs = [f for f in _rglob('spike_sorting_ks2.log')
+                if not checkpoints.done(f.parent, flag=f.parent.joinpath('amps_patching_local_server2.flag'))]
+    # resolve the eids of the sessions in bulk
+    eids = SessionResolver(one).resolve(get_session_path(f) for f in ks2_outs)
+
+    for ks2_out in ks2_outs:
         ks2_path = Path(ks2_out).parent
 
         # Clean up old flags if they exist
         if ks2_path.joinpath('amps_patching_local_server.flag').exists():
             ks2_path.joinpath('amps_patching_local_server.flag').unlink()
 
-        # If we already looked at this session previously, no need to try again
-        if ks2_path.joinpath('amps_patching_local_server2.flag').exists():
-            continue
-
-        # Make the flag if it is the first time looking into session
-        ks2_path.joinpath('amps_patching_local_server2.flag').touch()
+        # Record the probe as looked at the first time, it is not tried again
+        checkpoints.mark(ks2_path)
 
         # Now proceed with everything else
         session_path = get_session_path(ks2_out)
-        eid = one.path2eid(session_path)
+        eid = eids.get(session_path)
         if eid is None:
             # Skip sessions that don't exist on alyx!
             continue
@@ -232,111 +311,196 @@ def spike_amplitude_patching():
             continue
 
 
-def upload_ks2_output():
+def _ks2_to_tar(ks2_path, tar_dir):
+    """
+    Tars the output of a probe in a worker process, see upload_ks2_output
+    Same as ibllib.ephys.spikes.ks2_to_tar, with the tar written through the I/O governor so that it
+    is throttled as it is streamed, and renamed once complete so that a partial tar is not registered
+    """
+    tar_dir.mkdir(exist_ok=True, parents=True)
+    out_file = tar_dir.joinpath('_kilosort_raw.output.tar')
+    if out_file.exists():
+        _logger.info(f'Already converted ks2 to tar: for {ks2_path}, skipping.')
+        return [out_file]
+    part_file = out_file.with_suffix('.tar.part')
+    with get_governor().open(part_file, 'wb') as f, tarfile.open(fileobj=f, mode='w', copybufsize=CHUNK_SIZE) as tar:
+        for file in sorted(Path(ks2_path).iterdir()):
+            if file.name in reclaim.KS2_OUTPUT:
+                tar.add(file, file.name)
+    part_file.rename(out_file)
+    return [out_file]
+
+
+def _registered_ks2_tars(one, eids):
+    """
+    Probes whose _kilosort_raw.output.tar is registered, from one datasets query per batch of sessions
+    :return: set of (eid, probe)
+    """
+    eids = list(eids)
+    dsets = []
+    for i in range(0, len(eids), REST_BATCH_SIZE):
+        batch = eids[i:i + REST_BATCH_SIZE]
+        try:
+            dsets.extend(one.alyx.rest('datasets', 'list', name='_kilosort_raw.output.tar',
+                                       django=f'session__in,{batch}'))
+        except Exception as e:
+            _logger.warning(f'Bulk datasets query failed, querying sessions one by one: {e}')
+            for eid in batch:
+                dsets.extend(one.alyx.rest('datasets', 'list', session=eid, name='_kilosort_raw.output.tar'))
+    return set((str(ds['session']).split('/')[-1], ds['collection'].rsplit('/', 1)[-1]) for ds in dsets)
+
+
+def upload_ks2_output(n_workers=N_TAR_WORKERS):
     """
     Copy ks2 output to a .tar file and upload to flatiron for all past sessions that have
     spike sorting output
+    The tars are built in a pool of processes, and registered in one call per session once all its
+    probes are done. The free disk space is checked before each tar is started, and the volume of
+    the tars is throttled by the I/O governor as they are written, see io_governor.py.
+    :param n_workers: number of tars built at the same time
     """
-    # if the space on the disk > 500Gb continue, otherwise, don't bother
-    usage = _get_volume_usage('/mnt/s0/Data', 'disk')
-    if usage['disk_available'] < 500:
+    def disk_full():
+        # if the space on the disk > 500Gb continue, otherwise, don't bother
+        return _get_volume_usage('/mnt/s0/Data', 'disk')['disk_available'] < MIN_DISK_AVAILABLE
+
+    if disk_full():
         return
 
     one = ONE(cache_rest=None)
+    # tars registered, the tar_existed.flag files of previous versions are honoured
+    checkpoints = Checkpoints('upload_ks2_output')
 
-    for ilog, ks2_out in enumerate(ROOT_PATH.rglob('spike_sorting_ks2.log')):
-        # check space on disk after every 25 extractions. stop if we are running low!
-        if np.mod(ilog, 25) == 0:
-            usage = _get_volume_usage('/mnt/s0/Data', 'disk')
-            if usage['disk_available'] < 500:
-                return
-
+    # probes that have not been tarred yet, grouped by session
+    probes = defaultdict(list)
+    for ks2_out in _rglob('spike_sorting_ks2.log'):
         ks2_path = Path(ks2_out).parent
         session_path = get_session_path(ks2_out)
-
-        probe = ks2_path.stem
-        tar_dir = session_path.joinpath('spike_sorters', 'ks2_matlab', probe)
-        tar_dir.mkdir(exist_ok=True, parents=True)
-
-        # If the flag exists it means we have already extracted
-        if tar_dir.joinpath('tar_existed.flag').exists():
-            # We already done this, no need to repeat!!
+        tar_dir = session_path.joinpath('spike_sorters', 'ks2_matlab', ks2_path.stem)
+        # If the probe is checkpointed it means we have already extracted
+        if checkpoints.done(tar_dir, flag=tar_dir.joinpath('tar_existed.flag')):
             continue
-
-        eid = one.path2eid(session_path)
-
-        # For latest sessions tar file will be created by task and automatically registered so we
-        # may have a case where tar file already registered and uploaded but no tar_existed.flag
-        if tar_dir.joinpath('_kilosort_raw.output.tar').exists():
-            # double check it indeed has been registered for this probe
-            dset = one.alyx.rest('datasets', 'list', session=eid, name='_kilosort_raw.output.tar')
-            collection = [ds['collection'].rsplit('/', 1)[-1] for ds in dset]
-            if probe in collection:
-                tar_dir.joinpath('tar_existed.flag').touch()
+        probes[session_path].append((ks2_path, tar_dir))
+
+    eids = SessionResolver(one).resolve(probes)
+    registered = _registered_ks2_tars(one, set(filter(None, eids.values())))
+
+    to_tar = []
+    for session_path, session_probes in probes.items():
+        eid = eids[session_path]
+        for ks2_path, tar_dir in session_probes:
+            # For latest sessions tar file will be created by task and automatically registered so we
+            # may have a case where tar file already registered and uploaded but not checkpointed
+            if tar_dir.joinpath('_kilosort_raw.output.tar').exists() and (str(eid), ks2_path.stem) in registered:
+                checkpoints.mark(tar_dir)
+                continue
+            if eid is None:
+                # Skip sessions that don't exist on alyx!
                 continue
+            to_tar.append((session_path, ks2_path, tar_dir))
 
-        if eid is None:
-            # Skip sessions that don't exist on alyx!
-            continue
+    n_pending = Counter(session_path for session_path, *_ in to_tar)
+    out_files = defaultdict(list)  # tars of each session waiting for registration
 
-        out = spikes.ks2_to_tar(ks2_path, tar_dir)
-        register_dataset(out, one=one)
-        # Make flag to indicate data already registered for this session
-        tar_dir.joinpath('tar_existed.flag').touch()
-
-
-def remove_old_spike_sortings_outputs():
-
-    ks2_output = ['amplitudes.npy',
-                  'channel_map.npy',
-                  'channel_positions.npy',
-                  'cluster_Amplitude.tsv',
-                  'cluster_ContamPct.tsv',
-                  'cluster_group.tsv',
-                  'cluster_KSLabel.tsv',
-                  'params.py',
-                  'pc_feature_ind.npy',
-                  'pc_features.npy',
-                  'similar_templates.npy',
-                  'spike_clusters.npy',
-                  'spike_sorting_ks2.log',
-                  'spike_templates.npy',
-                  'spike_times.npy',
-                  'template_feature_ind.npy',
-                  'template_features.npy',
-                  'templates.npy',
-                  'templates_ind.npy',
-                  'whitening_mat.npy',
-                  'whitening_mat_inv.npy']
-    siz = 0
-    for ks2_flag in ROOT_PATH.rglob('spike_sorting_ks2.log'):
-        session_path = get_session_path(ks2_flag)
-        ks2_path = ks2_flag.parent
-        probe = ks2_path.parts[-1]
-        tar_dir = session_path.joinpath('spike_sorters', 'ks2_matlab', probe)
-        if not any((tar_dir.joinpath('tar_existed.flag').exists(), tar_dir.joinpath('_kilosort_raw.output.tar'))):
-            continue
-        for fn in ks2_output:
-            fil = next(tar_dir.glob(fn), None)
-            if fil is None:
-                continue
-            siz += fil.stat().st_size
-            fil.unlink()
-    _logger.info(f'remove old spike sorting outputs removed {siz / 1024 ** 3} Go')
+    def register(session_path):
+        tars = out_files.pop(session_path)
+        try:
+            register_dataset([f for _, out in tars for f in out], one=one)
+        except Exception as e:
+            _logger.error(f'Registration of the ks2 tars of {session_path} failed: {e}')
+            return
+        # Checkpoint to indicate data already registered for this session
+        for tar_dir, _ in tars:
+            checkpoints.mark(tar_dir)
+
+    governor = get_governor()
+    running = {}
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=set_idle_priority if governor.idle else None) as executor:
+        while to_tar or running:
+            while to_tar and len(running) < n_workers:
+                if disk_full():
+                    _logger.warning('Less than 500 GB available, no new ks2 tar is started')
+                    to_tar = []
+                    break
+                session_path, ks2_path, tar_dir = to_tar.pop(0)
+                running[executor.submit(_ks2_to_tar, ks2_path, tar_dir)] = (session_path, tar_dir)
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                session_path, tar_dir = running.pop(future)
+                n_pending[session_path] -= 1
+                try:
+                    out_files[session_path].append((tar_dir, future.result()))
+                except Exception as e:
+                    _logger.error(f'ks2 tar failed for {tar_dir}: {e}')
+                # all the probes of the session are done: register them in a single call
+                if n_pending[session_path] == 0 and out_files.get(session_path):
+                    register(session_path)
+    # the sessions whose remaining probes were not started because of the disk space
+    for session_path in [sp for sp, tars in out_files.items() if tars]:
+        register(session_path)
+
+
+def remove_old_spike_sortings_outputs(policy=None, n_threads=reclaim.N_THREADS, dry=False):
+    """
+    Removes the ks2 output files of the probes whose output has been tarred, see reclaim.py
+    The plan is saved in the reclaim ledger before deleting: an interrupted run can be resumed with
+    `python reclaim.py execute <run_id>`
+    :param policy: reclaim.Policy, defaults to all the tarred probes
+    :param n_threads: number of files deleted at the same time
+    :param dry: if True, only logs the space that would be freed
+    :return: run id of the reclaim ledger
+    """
+    policy = policy or reclaim.Policy()
+    with closing(FileIndex(ROOT_PATH)) as index:
+        if (index.last_refresh or 0) < time.time() - FILE_INDEX_MAX_AGE:
+            index.refresh()
+        registered = None
+        if policy.require_registered:
+            one = ONE(cache_rest=None)
+            session_paths = set(get_session_path(f) for f in index.rglob('spike_sorting_ks2.log'))
+            eids = SessionResolver(one).resolve(session_paths)
+            session_of = {str(eid): sp for sp, eid in eids.items() if eid}
+            registered = set((session_of[eid], probe) for eid, probe in _registered_ks2_tars(one, session_of))
+        run_id = reclaim.save_plan(reclaim.make_plan(index, policy, registered=registered), policy.name)
+    reclaim.execute(run_id, n_threads=n_threads, dry=dry, governor=get_governor())
+    return run_id
+
+
+def glob_sessions_fast(pattern, root_path=ROOT_PATH, ordered=False):
+    """
+    Files matching a pattern within the session folders subject/20*/0*, the subjects are walked in
+    parallel, see session_walker.py
+    :param pattern: glob pattern relative to the session folder, e.g. '_device/photometry_00.yaml'
+    :param ordered: if True the files are yielded in sorted order, else as the subjects complete
+    """
+    yield from glob_sessions(pattern, root_path, ordered=ordered)
 
 
-def glob_sessions_fast(pattern, root_path=ROOT_PATH):
-    for sub_dir in root_path.glob('*'):
-        if not sub_dir.is_dir():
-            continue
-        for date_dir in sub_dir.glob('20*'):
-            if not date_dir.is_dir():
-                continue
-            for session_path in date_dir.glob('0*'):
-                if not session_path.is_dir():
-                    continue
-                for fn in session_path.glob(pattern):
-                    yield fn
+def _transition_photometry(photometry_yaml, checkpoints=None, described=None):
+    """
+    Handles one _device/photometry_00.yaml file, see dynamic_pipeline_transition_photometry
+    :param checkpoints: optional Checkpoints of the sessions already transitioned, skipped without touching the disk
+    :param described: optional set of the sessions with an experiment description, from the session catalog.
+     The catalog may be stale: it only skips sessions, the description file is checked before writing one
+    """
+    session_path = get_session_path(photometry_yaml)
+    if checkpoints and checkpoints.done(session_path):
+        return
+    description_file = session_path.joinpath('_ibl_experiment.description.yaml')
+    if session_path in (described or ()) or description_file.exists():
+        if checkpoints:
+            checkpoints.mark(session_path)
+        return
+    print(f"Found photometry yaml: {photometry_yaml}, create acquisition description file and raw session flag")
+    fp_description = session_params.read_params(photometry_yaml)
+    description = acquisition_description_legacy_session(session_path)
+    description['devices']['photometry'] = fp_description['devices']['photometry']
+    description['procedures'] = list(set(description['procedures'] + ['Fiber photometry']))
+    session_params.write_params(session_path, description)
+    session_path.joinpath('raw_session.flag').touch()
+    if checkpoints:
+        checkpoints.mark(session_path)
 
 
 def dynamic_pipeline_transition_photometry():
@@ -344,25 +508,43 @@ def dynamic_pipeline_transition_photometry():
     Looks for a _device/photometry_00.yaml file if found create an acquisition description file and add
     a raw_session_flag
     """
+    checkpoints = Checkpoints('dynamic_pipeline_transition_photometry')
+    catalog = _session_catalog()
+    described = set(map(Path, catalog.loc[catalog['has_description'].astype(bool), 'session_path']))
     for photometry_yaml in glob_sessions_fast("_device/photometry_00.yaml"):
-        session_path = get_session_path(photometry_yaml)
-        if session_path.joinpath('_ibl_experiment.description.yaml').exists():
-            continue
-        print(f"Found photometry yaml: {photometry_yaml}, create acquisition description file and raw session flag")
-        fp_description = session_params.read_params(photometry_yaml)
-        description = acquisition_description_legacy_session(session_path)
-        description['devices']['photometry'] = fp_description['devices']['photometry']
-        description['procedures'] = list(set(description['procedures'] + ['Fiber photometry']))
-        session_params.write_params(session_path, description)
-        session_path.joinpath('raw_session.flag').touch()
+        _transition_photometry(photometry_yaml, checkpoints=checkpoints, described=described)
+
+
+def maintenance_sweep():
+    """
+    Runs the periodic maintenance handlers over a single traversal of ROOT_PATH, see sweep.py
+    The handlers select their sessions from the session catalog, updated after the traversal
+    :return: dict of matches, errors and duration per handler
+    """
+    one = ONE(cache_rest=None)
+    sweep = Sweep(ROOT_PATH)
+    with closing(sweep.index):
+        sweep.index.refresh()
+        catalog = _session_catalog(index=sweep.index)
+        described = set(map(Path, catalog.loc[catalog['has_description'].astype(bool), 'session_path']))
+        handler = functools.partial(_correct_flag_biased_in_ephys_rig, biased_ephys=_biased_ephys_sessions(catalog))
+        sweep.register('video_data_transferred.flag', handler, name='correct_flags_biased_in_ephys_rig')
+        if get_lab_from_endpoint_id(alyx=one.alyx)[0] == 'wittenlab':
+            eids = _resolve_passive_targets(sweep.index.rglob('passive_data_for_ephys.flag'), one)
+            handler = functools.partial(_correct_passive_in_wrong_folder, one=one, eids=eids)
+            sweep.register('passive_data_for_ephys.flag', handler, name='correct_passive_in_wrong_folder')
+        # subject/date/number/_device/photometry_00.yaml, same as glob_sessions_fast
+        handler = functools.partial(_transition_photometry, described=described,
+                                    checkpoints=Checkpoints('dynamic_pipeline_transition_photometry'))
+        sweep.register('*/20*/0*/_device/photometry_00.yaml', handler, name='dynamic_pipeline_transition_photometry')
+        return sweep.run(refresh=False)
 
 
 if __name__ == "__main__":
-    correct_flags_biased_in_ephys_rig()
+    # correct_flags_biased_in_ephys_rig, correct_passive_in_wrong_folder and dynamic_pipeline_transition_photometry
+    maintenance_sweep()
     # correct_ephys_manual_video_copies()
     # remove_iti_duration()
     # spike_amplitude_patching()
     # upload_ks2_output()
-    correct_passive_in_wrong_folder()
     # remove_old_spike_sortings_outputs()
-    dynamic_pipeline_transition_photometry()
@@ -0,0 +1,99 @@
+"""
+Health and throughput metrics of the resident jobs, served as json by the control socket.
+
+There is one JobMetrics instance per job function and process, obtained with get_metrics. The
+scheduler records the runs and the task runners record the queue depth and the task durations.
+
+>>> get_metrics('run_tasks').task_done('TrainingTrials', 12.3, failed=False)
+>>> get_metrics('run_tasks').to_dict()
+"""
+from collections import deque, defaultdict
+import math
+import os
+import threading
+import time
+
+N_DURATIONS = 500  # number of most recent durations kept per task name for the percentiles
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_metrics(name):
+    """Returns the metrics of a job function, created on first call"""
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = JobMetrics(name)
+        return _registry[name]
+
+
+def percentile(values, q):
+    """Nearest rank percentile of a list of numbers, q in [0, 100]"""
+    values = sorted(values)
+    return values[max(math.ceil(q / 100 * len(values)) - 1, 0)]
+
+
+def process_rss():
+    """Resident set size of this process in MB, None if /proc is not available"""
+    try:
+        with open('/proc/self/status') as fid:
+            for line in fid:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+class JobMetrics:
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.n_runs = 0
+        self.last_start = None
+        self.last_duration = None
+        self.tasks_processed = 0
+        self.tasks_failed = 0
+        self.queue_depth = None
+        self.durations = defaultdict(lambda: deque(maxlen=N_DURATIONS))
+
+    def run_done(self, tstart, duration):
+        with self._lock:
+            self.n_runs += 1
+            self.last_start = tstart
+            self.last_duration = duration
+
+    def task_done(self, task_name, duration, failed=False):
+        """Records a task run, duration is None if unknown"""
+        with self._lock:
+            self.tasks_processed += 1
+            self.tasks_failed += int(failed)
+            if duration is not None:
+                self.durations[task_name].append(duration)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'runs': self.n_runs,
+                'last_run_start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.last_start))
+                if self.last_start else None,
+                'last_run_duration': self.last_duration,
+                'tasks_processed': self.tasks_processed,
+                'tasks_failed': self.tasks_failed,
+                'queue_depth': self.queue_depth,
+                'task_durations': {
+                    name: {'n': len(d), 'p50': percentile(d, 50), 'p95': percentile(d, 95)}
+                    for name, d in self.durations.items() if d},
+            }
+
+
+def snapshot(timers):
+    """
+    Metrics of a set of scheduler timers and of the process, as a json serializable dict
+    :param timers: list of scheduler.Timer
+    """
+    return {
+        'status': "I'm fine, helicopter mum",
+        'pid': os.getpid(),
+        'rss_mb': process_rss(),
+        'jobs': {t.name: {'running': t.running, 'stopped': t.stopped, **t.metrics.to_dict()} for t in timers},
+    }
@@ -0,0 +1,104 @@
+"""
+Adaptive polling of the task queue and wake up signalling of the task runners.
+
+The runners poll the queue quickly after recent activity and double their sleep time each time
+the queue is found empty, up to MAX_SLEEP. The sleep time is persisted as the runner scripts are
+started again by the service loop after each cycle.
+While sleeping, a runner listens on its localhost UDP port, so that the create job can wake it up
+as soon as new tasks are registered by sending b'WAKE'.
+
+>>> backoff = AdaptiveBackoff('small_jobs')
+>>> wait_for_wake(54324, backoff.idle())  # queue empty
+>>> backoff.reset()  # tasks were run
+>>> send_wake(54324)  # from another process
+"""
+import json
+import logging
+import socket
+import time
+
+import local_db
+
+_logger = logging.getLogger('ibllib')
+
+MIN_SLEEP = 30
+MAX_SLEEP = 3600
+
+
+class AdaptiveBackoff:
+    """
+    Exponential backoff of the polling interval, persisted in a small json file
+    :param name: name of the runner, the state is saved in local_db.STATE_DIR/<name>.backoff.json
+    :param min_sleep: sleep time in seconds after activity
+    :param max_sleep: maximum sleep time in seconds
+    :param factor: multiplicative increase of the sleep time on each idle poll
+    """
+    def __init__(self, name, min_sleep=MIN_SLEEP, max_sleep=MAX_SLEEP, factor=2, state_file=None):
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.factor = factor
+        self.state_file = state_file or local_db.STATE_DIR.joinpath(f'{name}.backoff.json')
+        try:
+            self.sleep_time = json.loads(self.state_file.read_text())['sleep_time']
+        except (OSError, ValueError, KeyError):
+            self.sleep_time = min_sleep
+
+    def _save(self):
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        self.state_file.write_text(json.dumps({'sleep_time': self.sleep_time}))
+
+    def reset(self):
+        """Called after activity: the next idle poll will sleep the minimum time"""
+        self.sleep_time = self.min_sleep
+        self._save()
+
+    def idle(self):
+        """Called when the queue is empty or on error, returns the time to sleep and increases the next one"""
+        sleep_time = self.sleep_time
+        self.sleep_time = min(self.sleep_time * self.factor, self.max_sleep)
+        self._save()
+        return sleep_time
+
+
+def wait_for_wake(port, timeout):
+    """
+    Sleeps for timeout seconds or until b'WAKE' is received on the localhost port
+    :param port: UDP port
+    :param timeout: seconds
+    :return: True if woken up, False if the timeout elapsed
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.bind(('localhost', port))
+    except OSError:
+        _logger.warning(f'Port {port} already in use, sleeping without wake up channel')
+        s.close()
+        time.sleep(timeout)
+        return False
+    end = time.time() + timeout
+    try:
+        while (remaining := end - time.time()) > 0:
+            s.settimeout(remaining)
+            try:
+                data, _ = s.recvfrom(4096)
+            except socket.timeout:
+                break
+            if data == b'WAKE':
+                _logger.info('Woken up, polling the queue')
+                return True
+        return False
+    finally:
+        s.close()
+
+
+def send_wake(*ports):
+    """Sends b'WAKE' to the runners listening on the localhost ports, no-op if they are not listening"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for port in ports:
+            try:
+                s.sendto(b'WAKE', ('localhost', port))
+            except OSError:
+                pass
+    finally:
+        s.close()
@@ -0,0 +1,140 @@
+"""
+Local incremental mirror of the Alyx task queue.
+
+Instead of downloading all the waiting tasks of the lab at each cycle, the mirror only pulls the
+tasks modified since the last synchronisation (the Alyx task `datetime` field is updated on each
+modification) and keeps them in a local SQLite database. The runners then read the waiting
+tasks from the mirror.
+Only the waiting tasks are kept: a task pulled with another status is removed from the mirror.
+A full synchronisation is done periodically to forget the tasks deleted from Alyx.
+
+>>> from queue_mirror import task_queue
+>>> waiting_tasks = task_queue(mode='small', alyx=one.alyx)
+"""
+import functools
+import importlib
+import json
+import logging
+import time
+
+from one.remote.globus import get_lab_from_endpoint_id
+from ibllib.oneibl.data_handlers import get_local_data_repository
+
+import local_db
+
+_logger = logging.getLogger('ibllib')
+
+FULL_SYNC_INTERVAL = 24 * 3600  # seconds between full synchronisations
+
+
+@functools.lru_cache(maxsize=None)
+def get_job_size(executable):
+    """
+    Returns the job size ('small' or 'large') of a task class
+    :param executable: full task class name, e.g. 'ibllib.pipes.training_preprocessing.TrainingTrials'
+    :return: str
+    """
+    strmodule, strclass = executable.rsplit('.', 1)
+    return getattr(importlib.import_module(strmodule), strclass).job_size
+
+
+class TaskQueueMirror:
+    """
+    Mirrors the tasks of a lab and data repository in a local SQLite database
+    :param alyx: AlyxClient instance, or any object with an equivalent `rest` method
+    :param lab: list of lab names
+    :param data_repository: name of the local data repository
+    :param db_file: optional database file, defaults to local_db.STATE_DIR/task_queue.sqlite
+    :param job_size: function returning the job size from the task executable
+    """
+    def __init__(self, alyx, lab, data_repository, db_file=None, job_size=get_job_size):
+        self.alyx = alyx
+        self.job_size = job_size
+        self.scope = f'session__lab__name__in,{lab},data_repository__name,{data_repository}'
+        self.con = local_db.connect('task_queue', db_file=db_file)
+        with self.con:
+            self.con.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                id TEXT PRIMARY KEY, scope TEXT, status TEXT, priority INTEGER, job_size TEXT,
+                datetime TEXT, data TEXT)""")
+            self.con.execute('CREATE INDEX IF NOT EXISTS tasks_status ON tasks (scope, status)')
+            self.con.execute("""CREATE TABLE IF NOT EXISTS syncs (
+                scope TEXT PRIMARY KEY, watermark TEXT, full_sync REAL)""")
+
+    def _sync_state(self):
+        row = self.con.execute('SELECT watermark, full_sync FROM syncs WHERE scope = ?', (self.scope,)).fetchone()
+        return (row['watermark'], row['full_sync']) if row else (None, None)
+
+    def _classify(self, task):
+        """Job size of a task, 'large' if it can't be determined so that the task still runs"""
+        try:
+            return self.job_size(task['executable'])
+        except Exception as e:
+            _logger.warning(f"Could not get the job size of {task['executable']}, running it as a large task: {e}")
+            return 'large'
+
+    def sync(self, full=False):
+        """
+        Pulls the tasks modified since the last synchronisation into the mirror
+        :param full: if True, pulls all waiting tasks and forgets the local tasks absent from Alyx
+        :return: number of tasks pulled
+        """
+        watermark, last_full_sync = self._sync_state()
+        full = full or watermark is None or time.time() - last_full_sync > FULL_SYNC_INTERVAL
+        if full:
+            tasks = self.alyx.rest('tasks', 'list', status='Waiting', django=self.scope, no_cache=True)
+        else:
+            tasks = self.alyx.rest('tasks', 'list', django=f'{self.scope},datetime__gte,{watermark}', no_cache=True)
+        rows = [(t['id'], self.scope, t['status'], t['priority'], self._classify(t), t['datetime'], json.dumps(t))
+                for t in tasks if t['status'] == 'Waiting']
+        with self.con:
+            if full:
+                self.con.execute('DELETE FROM tasks WHERE scope = ?', (self.scope,))
+            else:
+                self.con.executemany('DELETE FROM tasks WHERE id = ?', [(t['id'],) for t in tasks if t['status'] != 'Waiting'])
+            self.con.executemany('INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            watermark = max([watermark or ''] + [t['datetime'] for t in tasks]) or None
+            last_full_sync = time.time() if full else last_full_sync
+            self.con.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?, ?)', (self.scope, watermark, last_full_sync))
+        _logger.debug(f'Task queue mirror: pulled {len(tasks)} tasks ({"full" if full else "incremental"})')
+        return len(tasks)
+
+    def waiting_tasks(self, mode='all'):
+        """
+        Returns the waiting tasks from the mirror, sorted by decreasing priority
+        :param mode: 'all', 'small' or 'large'
+        :return: list of task dictionaries
+        """
+        sql = "SELECT data FROM tasks WHERE scope = ? AND status = 'Waiting'"
+        args = [self.scope]
+        if mode == 'small':
+            sql += " AND job_size = 'small'"
+        elif mode == 'large':
+            sql += " AND (job_size IS NULL OR job_size != 'small')"
+        sql += ' ORDER BY priority DESC, rowid'
+        return [json.loads(r['data']) for r in self.con.execute(sql, args)]
+
+    def close(self):
+        self.con.close()
+
+
+def task_queue(mode='all', lab=None, alyx=None, db_file=None):
+    """
+    Syncs the local mirror and returns the waiting tasks, same as ibllib.pipes.local_server.task_queue
+    :param mode: 'all', 'small' or 'large'
+    :param lab: lab name, inferred from the globus installation if None
+    :param alyx: AlyxClient instance
+    :param db_file: optional database file of the mirror
+    :return: list of task dictionaries sorted by decreasing priority
+    """
+    if lab is None:
+        _logger.debug("Trying to infer lab from globus installation")
+        lab = get_lab_from_endpoint_id(alyx=alyx)
+    if lab is None:
+        _logger.error("No lab provided or found")
+        return
+    mirror = TaskQueueMirror(alyx, lab, get_local_data_repository(alyx), db_file=db_file)
+    try:
+        mirror.sync()
+        return mirror.waiting_tasks(mode=mode)
+    finally:
+        mirror.close()
@@ -0,0 +1,232 @@
+"""
+Reclamation of the disk space used by the old kilosort 2 outputs, in two phases.
+
+plan: from the file index only, lists the ks2 output files of the probes that satisfy a policy
+(tar of the output made, tar registered on Alyx, minimum session age) with their size, so that
+the space freed by a policy is known before deleting anything. The plan is saved in a ledger.
+execute: deletes the files of a saved plan with a pool of threads, marking each file in the
+ledger, so that an interrupted run is resumed where it stopped.
+
+>>> index = FileIndex('/mnt/s0/Data/Subjects')
+>>> policy = Policy('tarred_90d', min_age_days=90)
+>>> run_id = save_plan(make_plan(index, policy), policy.name)
+>>> print_summary(run_id)
+>>> execute(run_id)
+
+From the command line, plan refreshes the index first if it is older than INDEX_MAX_AGE:
+    python reclaim.py plan --min-age 90
+    python reclaim.py execute <run_id>
+    python reclaim.py status
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+import logging
+import time
+from pathlib import Path
+
+from one.alf.files import get_session_path
+
+from checkpoints import Checkpoints
+from file_index import FileIndex
+from io_governor import get_governor
+import local_db
+
+_logger = logging.getLogger('ibllib')
+
+ROOT_PATH = Path('/mnt/s0/Data/Subjects')
+N_THREADS = 8
+INDEX_MAX_AGE = 600  # seconds after which the file index is refreshed before planning
+KS2_OUTPUT = ['amplitudes.npy',
+              'channel_map.npy',
+              'channel_positions.npy',
+              'cluster_Amplitude.tsv',
+              'cluster_ContamPct.tsv',
+              'cluster_group.tsv',
+              'cluster_KSLabel.tsv',
+              'params.py',
+              'pc_feature_ind.npy',
+              'pc_features.npy',
+              'similar_templates.npy',
+              'spike_clusters.npy',
+              'spike_sorting_ks2.log',
+              'spike_templates.npy',
+              'spike_times.npy',
+              'template_feature_ind.npy',
+              'template_features.npy',
+              'templates.npy',
+              'templates_ind.npy',
+              'whitening_mat.npy',
+              'whitening_mat_inv.npy']
+
+
+@dataclass
+class Policy:
+    """
+    Conditions for the ks2 output of a probe to be deleted
+    :param name: name of the policy, part of the run id
+    :param min_age_days: minimum age of the session, from its date folder
+    :param require_tar: the output must have been tarred: the _kilosort_raw.output.tar is present, or the
+     probe is checkpointed by upload_ks2_output, or a tar_existed.flag of its previous versions is present
+    :param require_registered: the tar must be registered on Alyx, see make_plan
+    """
+    name: str = 'tarred'
+    min_age_days: int = 0
+    require_tar: bool = True
+    require_registered: bool = False
+
+
+def make_plan(index, policy, registered=None):
+    """
+    Lists the ks2 output files to delete from the file index, without touching the file system
+    :param index: file_index.FileIndex of the Subjects folder, refreshed
+    :param policy: Policy
+    :param registered: set of (session_path Path, probe) whose tar is registered, required if policy.require_registered
+    :return: list of (session_path, probe, file path, size)
+    """
+    if policy.require_registered and registered is None:
+        raise ValueError(f'Policy {policy.name} requires the set of registered tars')
+    # probes tarred and registered by upload_ks2_output
+    tarred = Checkpoints('upload_ks2_output')
+    plan = []
+    for ks2_log, _, _ in index.stat('spike_sorting_ks2.log'):
+        session_path = get_session_path(ks2_log)
+        probe = ks2_log.parent.name
+        tar_dir = session_path.joinpath('spike_sorters', 'ks2_matlab', probe)
+        files = {f.name: (f, size) for f, size, _ in index.files_in(tar_dir)}
+        if policy.require_tar and not ('_kilosort_raw.output.tar' in files or tarred.done(tar_dir) or
+                                       'tar_existed.flag' in files):
+            continue
+        if policy.require_registered and (session_path, probe) not in registered:
+            continue
+        try:
+            age = (datetime.now() - datetime.strptime(session_path.parts[-2], '%Y-%m-%d')).days
+        except ValueError:
+            continue
+        if age < policy.min_age_days:
+            continue
+        plan.extend((session_path, probe, *files[fn]) for fn in KS2_OUTPUT if fn in files)
+    tarred.close()
+    return plan
+
+
+def _ledger():
+    con = local_db.connect('reclaim')
+    with con:
+        con.execute("""CREATE TABLE IF NOT EXISTS ledger (
+            run_id TEXT, session_path TEXT, probe TEXT, path TEXT, size INTEGER, deleted REAL,
+            PRIMARY KEY (run_id, path))""")
+    return con
+
+
+def save_plan(plan, policy_name='tarred'):
+    """
+    Saves a plan in the ledger
+    :return: run id
+    """
+    run_id = f'{policy_name}_{datetime.now():%Y-%m-%dT%H%M%S}'
+    con = _ledger()
+    with con:
+        con.executemany('INSERT OR IGNORE INTO ledger VALUES (?, ?, ?, ?, ?, NULL)',
+                        [(run_id, str(sp), probe, str(f), size) for sp, probe, f, size in plan])
+    con.close()
+    return run_id
+
+
+def summary(run_id):
+    """
+    Bytes planned and deleted per session of a run
+    :return: list of dict with keys session_path, n_files, planned, deleted
+    """
+    con = _ledger()
+    rows = con.execute("""SELECT session_path, COUNT(*) AS n_files, SUM(size) AS planned,
+        SUM(CASE WHEN deleted IS NULL THEN 0 ELSE size END) AS deleted
+        FROM ledger WHERE run_id = ? GROUP BY session_path ORDER BY planned DESC""", (run_id,)).fetchall()
+    con.close()
+    return [dict(r) for r in rows]
+
+
+def print_summary(run_id, top=20):
+    sessions = summary(run_id)
+    planned, deleted = (sum(s[k] for s in sessions) / 1024 ** 3 for k in ('planned', 'deleted'))
+    print(f'{run_id}: {len(sessions)} sessions, {planned:.1f} GB planned, {deleted:.1f} GB deleted')
+    for s in sessions[:top]:
+        print(f"{s['session_path']:<80} {s['n_files']:>4} files {s['planned'] / 1024 ** 3:8.2f} GB")
+
+
+def execute(run_id, n_threads=N_THREADS, dry=False, governor=None):
+    """
+    Deletes the files of a saved plan that are not marked as deleted in the ledger yet
+    :param run_id: as returned by save_plan
+    :param n_threads: number of files deleted at the same time
+    :param dry: if True, only logs the bytes that would be freed
+    :param governor: io_governor.IOGovernor throttling the deletions, defaults to the one of the process
+    :return: bytes freed
+    """
+    governor = governor or get_governor()
+    con = _ledger()
+    rows = con.execute('SELECT path, size FROM ledger WHERE run_id = ? AND deleted IS NULL', (run_id,)).fetchall()
+    if dry:
+        freed = sum(r['size'] for r in rows)
+        _logger.info(f'{run_id}: {len(rows)} files to delete, {freed / 1024 ** 3:.2f} GB')
+        return freed
+
+    def delete(row):
+        try:
+            governor.unlink(row['path'])
+            return row['path'], row['size']
+        except FileNotFoundError:
+            return row['path'], 0  # already gone, e.g. deleted by a previous interrupted run
+        except OSError as e:
+            _logger.error(f'Could not delete {row["path"]}: {e}')
+            return None, 0
+
+    freed = 0
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for i, (path, size) in enumerate(executor.map(delete, rows)):
+            if path is None:
+                continue
+            freed += size
+            con.execute('UPDATE ledger SET deleted = ? WHERE run_id = ? AND path = ?', (time.time(), run_id, path))
+            if i % 1000 == 0:
+                con.commit()
+    con.commit()
+    con.close()
+    _logger.info(f'{run_id}: removed {freed / 1024 ** 3:.2f} GB of old spike sorting outputs')
+    governor.log_stats(run_id)
+    return freed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reclaim the disk space of the old ks2 outputs')
+    parser.add_argument('action', help='Action: plan, execute, status')
+    parser.add_argument('run_id', help='Run id of execute and status', nargs='?')
+    parser.add_argument('--min-age', help='Minimum session age in days', default=0, type=int)
+    parser.add_argument('--no-tar', help='Do not require the ks2 tar', action='store_true')
+    parser.add_argument('--threads', help='Number of deletion threads', default=N_THREADS, type=int)
+    parser.add_argument('--dry', help='Dry run', action='store_true')
+    args = parser.parse_args()
+    if args.action == 'plan':
+        policy = Policy(f"{'untarred' if args.no_tar else 'tarred'}_{args.min_age}d", min_age_days=args.min_age,
+                        require_tar=not args.no_tar)
+        index = FileIndex(ROOT_PATH)
+        # a plan from a stale index would delete files based on a past state of the disk
+        if (index.last_refresh or 0) < time.time() - INDEX_MAX_AGE:
+            index.refresh()
+        if index.last_refresh is None:
+            raise SystemExit(f'The file index of {ROOT_PATH} could not be built, no plan made')
+        plan = make_plan(index, policy)
+        print_summary(save_plan(plan, policy.name))
+    elif args.action == 'execute':
+        execute(args.run_id, n_threads=args.threads, dry=args.dry)
+    elif args.action == 'status':
+        if args.run_id:
+            print_summary(args.run_id)
+        else:
+            con = _ledger()
+            for r in con.execute('SELECT run_id, COUNT(*) AS n, SUM(size) AS size, COUNT(deleted) AS n_deleted '
+                                 'FROM ledger GROUP BY run_id ORDER BY run_id'):
+                print(f"{r['run_id']:<40} {r['n_deleted']:>8}/{r['n']} files deleted, {r['size'] / 1024 ** 3:.1f} GB planned")
+    else:
+        _logger.error(f'Action "{args.action}" not valid. Allowed actions are: plan, execute, status')
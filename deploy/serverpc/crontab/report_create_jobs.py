@@ -6,6 +6,8 @@ from one.api import ONE
 from ibllib.pipes.local_server import report_health
 from ibllib.pipes.local_server import job_creator
 
+from disk_usage import report_usage
+
 _logger = logging.getLogger('ibllib')
 
 subjects_path = Path('/mnt/s0/Data/Subjects/')
@@ -19,6 +21,13 @@ try:
 except BaseException:
     _logger.error(f"Error in report_health\n {traceback.format_exc()}")
 
+# Label the lab endpoint json field with the disk usage per collection, session age and subject
+try:
+    if report_usage(one=one):
+        _logger.info("Reported disk usage of local server")
+except BaseException:
+    _logger.error(f"Error in report_usage\n {traceback.format_exc()}")
+
 #  Create sessions: for this server, finds the extract_me flags, identify the session type,
 #  create the session on Alyx if it doesn't already exist, register the raw data and create
 #  the tasks backlog
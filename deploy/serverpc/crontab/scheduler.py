@@ -0,0 +1,186 @@
+"""
+Event driven scheduler for the resident server jobs.
+
+A scheduler hosts one or several jobs as timers. Each job runs in its own thread, at most one
+run at a time, and is started again `period` seconds after the start of its previous run.
+The main loop blocks on the control sockets and on the next deadline at the same time, so that it
+uses no CPU while idle and answers control messages immediately.
+
+Other file descriptors, such as an inotify instance, can be registered with a callback run by the
+main loop when they are readable. A timer can be woken up before its next deadline, and a timer
+without period only runs when woken up.
+
+Each control socket is bound to a localhost UDP port, which also guarantees a single instance per
+port. The following messages are understood:
+    - b'STOP': stop the timers attached to the socket. The acknowledgement is sent once their
+      current run, if any, is finished and the port is released.
+    - b'CHECK': health check, answered with the json metrics of the timers (see metrics.snapshot).
+    - b'WAKE': run the timers attached to the socket now, or as soon as their current run is finished.
+"""
+import json
+import logging
+import math
+import selectors
+import socket
+import threading
+import time
+import traceback
+
+from metrics import get_metrics, snapshot
+
+_logger = logging.getLogger('ibllib')
+
+
+class Timer:
+    """A job function run periodically by the scheduler, or only when woken up if period is None"""
+    def __init__(self, name, func, period, args=(), kwargs=None):
+        self.name = name
+        self.func = func
+        self.period = period
+        self.args = args
+        self.kwargs = kwargs or {}
+        # periodic timers run as soon as the scheduler starts
+        self.deadline = math.inf if period is None else 0
+        self.wake_at = math.inf
+        self.running = False
+        self.stopped = False
+        self.metrics = get_metrics(getattr(func, '__name__', name))
+
+    @property
+    def due(self):
+        return min(self.deadline, self.wake_at)
+
+    def __repr__(self):
+        return f'Timer({self.name}, period={self.period})'
+
+
+class Scheduler:
+    """
+    Runs timers and serves the control sockets
+    >>> scheduler = Scheduler()
+    >>> timer = scheduler.add_timer('create', job_creator, 900, args=('/mnt/s0/Data/Subjects',))
+    >>> scheduler.listen(54321, [timer])  # raises OSError if another instance is running
+    >>> scheduler.run()
+    """
+    def __init__(self):
+        self.timers = []
+        self.selector = selectors.DefaultSelector()
+        # the job threads write to this socket pair to wake up the main loop when they finish
+        self._done_r, self._done_w = socket.socketpair()
+        self._done_r.setblocking(False)
+        self.selector.register(self._done_r, selectors.EVENT_READ, None)
+        self._stop_requests = {}  # socket: list of addresses waiting for the stop acknowledgement
+
+    def add_timer(self, name, func, period, args=(), kwargs=None):
+        timer = Timer(name, func, period, args=args, kwargs=kwargs)
+        self.timers.append(timer)
+        return timer
+
+    def listen(self, port, timers):
+        """
+        Binds a control socket to a localhost port
+        :param port: UDP port number
+        :param timers: list of timers controlled by the socket
+        :raises OSError: if the port is already in use
+        """
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.bind(('localhost', port))
+        except OSError:
+            s.close()
+            raise
+        s.setblocking(False)
+        self.selector.register(s, selectors.EVENT_READ, list(timers))
+        return s
+
+    def add_reader(self, fileobj, callback):
+        """
+        Runs callback in the main loop whenever fileobj is readable
+        :param fileobj: object with a fileno() method, closed when the scheduler exits
+        :param callback: function without arguments
+        """
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def wake(self, timer, delay=0):
+        """
+        Runs a timer after delay seconds, or as soon as its current run is finished.
+        Can be called from any thread.
+        """
+        timer.wake_at = min(timer.wake_at, time.time() + delay)
+        self._done_w.send(b'.')  # interrupts the blocking select so that the timeout is updated
+
+    def _run_timer(self, timer):
+        tstart = time.time()
+        try:
+            timer.func(*timer.args, **timer.kwargs)
+        except Exception:
+            _logger.error(f'Error running job {timer.name}\n{traceback.format_exc()}')
+        finally:
+            timer.metrics.run_done(tstart, time.time() - tstart)
+            timer.deadline = math.inf if timer.period is None else tstart + timer.period
+            timer.running = False
+            self._done_w.send(b'.')
+
+    def _start_due_timers(self):
+        now = time.time()
+        for timer in self.timers:
+            if timer.stopped or timer.running or timer.due > now:
+                continue
+            timer.wake_at = math.inf
+            timer.running = True
+            threading.Thread(target=self._run_timer, args=(timer,), name=timer.name, daemon=True).start()
+
+    def _next_timeout(self):
+        deadlines = [t.due for t in self.timers if not (t.stopped or t.running)]
+        if min(deadlines, default=math.inf) == math.inf:
+            return None  # block until a message arrives or a job finishes
+        return max(0, min(deadlines) - time.time())
+
+    def _handle_message(self, sock, timers):
+        try:
+            data, address = sock.recvfrom(4096)
+        except BlockingIOError:
+            return
+        if data == b'STOP':
+            print('ABORT !!')
+            for timer in timers:
+                timer.stopped = True
+            self._stop_requests.setdefault(sock, []).append(address)
+        elif data == b'CHECK':
+            sock.sendto(json.dumps(snapshot(timers)).encode(), address)
+        elif data == b'WAKE':
+            for timer in timers:
+                if not timer.stopped:
+                    self.wake(timer)
+
+    def _acknowledge_stops(self):
+        """Sends the stop acknowledgements once the timers of a socket are idle and releases the port"""
+        for sock, addresses in list(self._stop_requests.items()):
+            if any(t.running for t in self.selector.get_key(sock).data):
+                continue
+            for address in addresses:
+                sock.sendto(b'ACK STOP', address)
+            self.selector.unregister(sock)
+            sock.close()
+            self._stop_requests.pop(sock)
+
+    def run(self):
+        """Runs the event loop until all the timers are stopped"""
+        while any(not t.stopped or t.running for t in self.timers):
+            self._start_due_timers()
+            for key, _ in self.selector.select(self._next_timeout()):
+                if key.fileobj is self._done_r:
+                    self._done_r.recv(4096)
+                elif callable(key.data):
+                    key.data()
+                else:
+                    self._handle_message(key.fileobj, key.data)
+            self._acknowledge_stops()
+        self.close()
+
+    def close(self):
+        for key in list(self.selector.get_map().values()):
+            self.selector.unregister(key.fileobj)
+            key.fileobj.close()
+        self._done_w.close()
+        self.selector.close()
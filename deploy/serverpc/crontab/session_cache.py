@@ -0,0 +1,129 @@
+"""
+Cache of the raw session data shared by the tasks of a session.
+
+The small tasks of a session (trials, QC, registration...) each load the same settings, Bpod data
+and sync/channel maps from disk. Within a `session_cache` context, the ibllib loaders listed in
+CACHED_LOADERS return the result of their first call with the same arguments, as long as the
+files of the collection they read are unchanged: a task that rewrites a file invalidates the
+entries loaded from its folder. The cache is discarded when the context exits, i.e. when all
+the tasks of the session have run.
+
+Each call returns a deep copy of the cached object, so that a task may modify the arrays and
+containers it loaded in place, as it would without the cache, without affecting the next tasks.
+Calls with arguments other than paths, strings and numbers, and None results, are not cached.
+
+The loaders are wrapped once per process in their module, so only the calls made through the
+module attribute (e.g. `raw.load_settings(...)`) are cached. The cache is local to the thread,
+and outside of a context the wrappers call the original loaders.
+
+>>> with session_cache():
+>>>     for tdict in session_tasks:
+>>>         run_alyx_task(tdict=tdict, session_path=session_path, one=one)
+"""
+from contextlib import contextmanager
+import copy
+import functools
+import importlib
+import inspect
+import logging
+import os
+from pathlib import Path
+import threading
+
+_logger = logging.getLogger('ibllib')
+
+# module, function, argument naming the collection read and its default collection
+CACHED_LOADERS = [
+    ('ibllib.io.raw_data_loaders', 'load_settings', 'task_collection', 'raw_behavior_data'),
+    ('ibllib.io.raw_data_loaders', 'load_data', 'task_collection', 'raw_behavior_data'),
+    ('ibllib.io.extractors.ephys_fpga', 'get_sync_and_chn_map', 'sync_collection', 'raw_ephys_data'),
+    ('ibllib.io.extractors.ephys_fpga', 'get_main_probe_sync', None, 'raw_ephys_data'),
+]
+
+_local = threading.local()
+_install_lock = threading.Lock()
+_installed = False
+
+
+def _normalize(value):
+    """Hashable key of an argument, paths and strings compare as normalized paths"""
+    if isinstance(value, (str, Path)):
+        return str(Path(value))
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    raise TypeError(f'{type(value)} arguments are not cached')
+
+
+def _fingerprint(folder):
+    """Names, sizes and modification times of the files of a folder and its sub-folders"""
+    files = []
+    for root, _, names in os.walk(folder):
+        for name in names:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            files.append((os.path.join(root, name), st.st_size, st.st_mtime_ns))
+    return tuple(sorted(files))
+
+
+def _memoize(func, collection_arg=None, default_collection=None):
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        cache = getattr(_local, 'cache', None)
+        if cache is None:
+            return func(*args, **kwargs)
+        try:
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (func.__module__, func.__name__) + tuple((k, _normalize(v)) for k, v in bound.arguments.items())
+            collection = bound.arguments.get(collection_arg) or default_collection
+            folder = Path(next(iter(bound.arguments.values()))).joinpath(collection)
+            fingerprint = _fingerprint(folder)
+        except TypeError:
+            return func(*args, **kwargs)
+        if key in cache and cache[key][0] == fingerprint:
+            _local.hits += 1
+            return copy.deepcopy(cache[key][1])
+        value = func(*args, **kwargs)
+        if value is None:  # e.g. missing file, the next task may create it
+            cache.pop(key, None)
+            return value
+        try:
+            cached = copy.deepcopy(value)
+        except Exception as e:  # e.g. an object holding a file handle
+            _logger.debug(f'Session cache: {func.__name__} result not cached: {e}')
+            return value
+        # fingerprint after the call, as a loader may write files, e.g. the extracted sync
+        cache[key] = (_fingerprint(folder), cached)
+        return value
+    return wrapper
+
+
+def _install():
+    """Wraps the loaders in their modules, once per process"""
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        for module_name, func_name, collection_arg, default_collection in CACHED_LOADERS:
+            try:
+                module = importlib.import_module(module_name)
+                setattr(module, func_name, _memoize(getattr(module, func_name), collection_arg, default_collection))
+            except (ImportError, AttributeError) as e:
+                _logger.debug(f'Session cache: {module_name}.{func_name} not available: {e}')
+        _installed = True
+
+
+@contextmanager
+def session_cache():
+    """Caches the raw data loaded within the context, see module docstring"""
+    _install()
+    _local.cache, _local.hits = {}, 0
+    try:
+        yield _local.cache
+    finally:
+        _logger.debug(f'Session cache: {len(_local.cache)} objects loaded, {_local.hits} loads avoided')
+        _local.cache = None
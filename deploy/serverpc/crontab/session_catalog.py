@@ -0,0 +1,125 @@
+"""
+Catalog of the sessions of the server, saved as a Parquet table.
+
+One row per session with the key fields of its _iblrig_taskSettings.raw.json and of its
+_ibl_experiment.description.yaml: rig, protocol, collections, devices, procedures and duration.
+The catalog is updated from the file index: only the sessions whose settings or description file
+changed since the last update are parsed again. The maintenance jobs select their target
+sessions with a vectorized filter rather than opening the files of every session.
+
+>>> catalog = SessionCatalog('/mnt/s0/Data/Subjects').update()
+>>> biased = catalog['protocol'] == '_iblrig_tasks_biasedChoiceWorld'
+>>> biased_ephys = catalog[catalog['rig'].str.contains('ephys', na=False) & biased]
+"""
+from datetime import datetime
+import json
+import logging
+import os
+from pathlib import Path
+
+import pandas as pd
+import yaml
+
+from file_index import FileIndex
+import local_db
+
+_logger = logging.getLogger('ibllib')
+
+ROOT_PATH = Path('/mnt/s0/Data/Subjects')
+SETTINGS_PATTERN = '*/20*/0*/*/_iblrig_taskSettings.raw.json'
+DESCRIPTION_PATTERN = '*/20*/0*/_ibl_experiment.description.yaml'
+COLUMNS = ['session_path', 'subject', 'date', 'number', 'rig', 'protocol', 'task_protocols', 'collections',
+           'devices', 'procedures', 'start_time', 'duration', 'has_description', 'settings_mtime', 'description_mtime']
+
+
+def _parse_settings(settings_file):
+    """Rig, protocol, start time and duration in seconds from a task settings file"""
+    try:
+        settings = json.loads(Path(settings_file).read_text())
+    except (OSError, ValueError) as e:
+        _logger.warning(f'Could not read {settings_file}: {e}')
+        return {}
+    out = dict(rig=settings.get('PYBPOD_BOARD'), protocol=settings.get('PYBPOD_PROTOCOL'))
+    try:
+        start = datetime.fromisoformat(settings.get('SESSION_START_TIME') or settings['SESSION_DATETIME'])
+        out['start_time'] = start.isoformat()
+        out['duration'] = (datetime.fromisoformat(settings['SESSION_END_TIME']) - start).total_seconds()
+    except (KeyError, TypeError, ValueError):
+        pass
+    return out
+
+
+def _parse_description(description_file):
+    """Protocols, collections, devices and procedures from an experiment description file"""
+    try:
+        description = yaml.safe_load(Path(description_file).read_text()) or {}
+    except (OSError, yaml.YAMLError) as e:
+        _logger.warning(f'Could not read {description_file}: {e}')
+        return {}
+    tasks = [(name, pars or {}) for task in description.get('tasks') or [] for name, pars in task.items()]
+    collections = [pars.get('collection') for _, pars in tasks]
+    for device in (description.get('devices') or {}).values():
+        # either {'collection': ...} or {sub-device name: {'collection': ...}}, e.g. cameras
+        device = device or {}
+        collections.append(device.get('collection'))
+        collections += [pars.get('collection') for pars in device.values() if isinstance(pars, dict)]
+    return dict(task_protocols=[name for name, _ in tasks],
+                collections=sorted(set(filter(None, collections))),
+                devices=sorted(description.get('devices') or {}),
+                procedures=list(description.get('procedures') or []))
+
+
+class SessionCatalog:
+    """
+    :param root_path: Subjects folder
+    :param index: optional file_index.FileIndex of the root path, it is not refreshed by the catalog
+    :param catalog_file: optional Parquet file, defaults to local_db.STATE_DIR/session_catalog.pqt
+    """
+    def __init__(self, root_path=ROOT_PATH, index=None, catalog_file=None):
+        self.index = index or FileIndex(root_path)
+        self.catalog_file = Path(catalog_file or local_db.STATE_DIR.joinpath('session_catalog.pqt'))
+        self.df = pd.read_parquet(self.catalog_file) if self.catalog_file.exists() else pd.DataFrame(columns=COLUMNS)
+
+    def _sources(self, pattern, levels):
+        """{session path: (file, mtime)} of the indexed files matching the pattern, first file by path"""
+        sources = {}
+        for file, _, mtime in sorted(self.index.stat(pattern)):
+            sources.setdefault(str(file.parents[levels]), (file, mtime))
+        return sources
+
+    def update(self):
+        """
+        Parses the settings and description files that changed since the last update
+        :return: pandas.DataFrame, the catalog
+        """
+        settings = self._sources(SETTINGS_PATTERN, 1)
+        descriptions = self._sources(DESCRIPTION_PATTERN, 0)
+        previous = {r['session_path']: r for r in self.df.to_dict('records')}
+        rows, n_parsed = [], 0
+        for session_path in sorted(set(settings) | set(descriptions)):
+            settings_file, settings_mtime = settings.get(session_path, (None, -1))
+            description_file, description_mtime = descriptions.get(session_path, (None, -1))
+            row = previous.get(session_path)
+            if row is None or (row['settings_mtime'], row['description_mtime']) != (settings_mtime, description_mtime):
+                n_parsed += 1
+                subject, date, number = Path(session_path).parts[-3:]
+                row = dict.fromkeys(COLUMNS)
+                row.update(session_path=session_path, subject=subject, date=date,
+                           number=int(number) if number.isdigit() else None,
+                           task_protocols=[], collections=[], devices=[], procedures=[],
+                           has_description=description_file is not None,
+                           settings_mtime=settings_mtime, description_mtime=description_mtime)
+                if settings_file:
+                    row.update(_parse_settings(settings_file))
+                if description_file:
+                    row.update(_parse_description(description_file))
+                if not row['collections'] and settings_file:
+                    row['collections'] = [settings_file.parent.name]
+            rows.append(row)
+        self.df = pd.DataFrame(rows, columns=COLUMNS)
+        self.catalog_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.catalog_file.with_suffix('.tmp')
+        self.df.to_parquet(tmp_file)
+        os.replace(tmp_file, self.catalog_file)
+        _logger.info(f'Session catalog: {len(rows)} sessions, {n_parsed} parsed')
+        return self.df
@@ -0,0 +1,115 @@
+"""
+Resolution of session uuids to local session paths for the task runners.
+
+The sessions of all the queued tasks are looked up at once: the paths already known are read
+from a persistent cache, and the missing ones are fetched from Alyx with one query per batch of
+sessions. A cached path that doesn't exist locally is fetched again, in case the session was renamed.
+The cache keeps the most recently used sessions and evicts the others. A lookup that only hits the
+cache doesn't write to it: the recency of the sessions used is only updated when the cache is full.
+
+>>> from session_paths import resolve_session_paths
+>>> session_paths = resolve_session_paths(one, '/mnt/s0/Data/Subjects', [t['session'] for t in waiting_tasks])
+"""
+import logging
+import time
+from pathlib import Path
+
+import local_db
+
+_logger = logging.getLogger('ibllib')
+
+MAX_SIZE = 50000  # maximum number of sessions kept in the cache
+BATCH_SIZE = 100  # maximum number of sessions per Alyx query
+
+
+def _relative_path(ses):
+    return '/'.join((ses['subject'], ses['start_time'][:10], str(ses['number']).zfill(3)))
+
+
+class SessionPathCache:
+    """
+    Persistent eid -> relative session path cache with least recently used eviction
+    :param one: ONE instance used to fetch the missing sessions
+    :param db_file: optional database file, defaults to local_db.STATE_DIR/session_paths.sqlite
+    :param max_size: maximum number of sessions kept in the cache
+    :param subjects_path: optional local Subjects folder, the cached paths missing from it are fetched again
+    """
+    def __init__(self, one, db_file=None, max_size=MAX_SIZE, subjects_path=None):
+        self.one = one
+        self.max_size = max_size
+        self.subjects_path = None if subjects_path is None else Path(subjects_path)
+        self.con = local_db.connect('session_paths', db_file=db_file)
+        with self.con:
+            self.con.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                eid TEXT PRIMARY KEY, relative_path TEXT, last_used REAL)""")
+            self.con.execute('CREATE INDEX IF NOT EXISTS sessions_last_used ON sessions (last_used)')
+
+    def _fetch(self, eids):
+        """Queries Alyx for a batch of sessions, falling back to one query per session"""
+        try:
+            sessions = self.one.alyx.rest('sessions', 'list', django=f'pk__in,{list(eids)}')
+        except Exception as e:
+            _logger.warning(f'Bulk session query failed, querying sessions one by one: {e}')
+            sessions = []
+            for eid in eids:
+                sessions.extend(self.one.alyx.rest('sessions', 'list', django=f'pk,{eid}'))
+        return {ses['id']: _relative_path(ses) for ses in sessions}
+
+    def resolve(self, eids):
+        """
+        Returns the relative session paths of a list of sessions
+        :param eids: iterable of session uuids, may contain duplicates
+        :return: dict {eid: 'subject/yyyy-mm-dd/nnn'}, sessions not found on Alyx are omitted
+        """
+        eids = list(dict.fromkeys(map(str, eids)))
+        hits = {}
+        for i in range(0, len(eids), BATCH_SIZE):
+            batch = eids[i:i + BATCH_SIZE]
+            rows = self.con.execute(f"SELECT eid, relative_path FROM sessions WHERE eid IN "
+                                    f"({','.join('?' * len(batch))})", batch)
+            hits.update({r['eid']: r['relative_path'] for r in rows})
+        if self.subjects_path is not None:
+            stale = [eid for eid, rel_path in hits.items() if not self.subjects_path.joinpath(rel_path).exists()]
+            for eid in stale:
+                hits.pop(eid)
+        misses = [eid for eid in eids if eid not in hits]
+        fetched = {}
+        for i in range(0, len(misses), BATCH_SIZE):
+            fetched.update(self._fetch(misses[i:i + BATCH_SIZE]))
+        paths = {**hits, **fetched}
+        if missing := set(eids).difference(paths):
+            _logger.error(f'Sessions not found on Alyx: {", ".join(sorted(missing))}')
+        if not fetched and not missing:
+            return paths
+        now = time.time()
+        with self.con:
+            self.con.executemany('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                                 [(eid, rel_path, now) for eid, rel_path in fetched.items()])
+            # the cached sessions that are no longer on Alyx
+            self.con.executemany('DELETE FROM sessions WHERE eid = ?', [(eid,) for eid in missing])
+            if self.con.execute('SELECT COUNT(*) FROM sessions').fetchone()[0] > self.max_size:
+                # the sessions used by this lookup are kept, the least recently used others are evicted
+                self.con.executemany('UPDATE sessions SET last_used = ? WHERE eid = ?', [(now, eid) for eid in hits])
+                self.con.execute('DELETE FROM sessions WHERE eid IN (SELECT eid FROM sessions '
+                                 'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_size,))
+        return paths
+
+    def close(self):
+        self.con.close()
+
+
+def resolve_session_paths(one, subjects_path, eids, db_file=None):
+    """
+    Resolves the local session paths of a list of sessions in bulk, the cached paths missing
+    from subjects_path are fetched again from Alyx
+    :param one: ONE instance
+    :param subjects_path: "/mnt/s0/Data/Subjects"
+    :param eids: iterable of session uuids
+    :param db_file: optional database file of the cache
+    :return: dict {eid: pathlib.Path}, sessions not found on Alyx are omitted
+    """
+    cache = SessionPathCache(one, db_file=db_file, subjects_path=subjects_path)
+    try:
+        return {eid: Path(subjects_path).joinpath(rel_path) for eid, rel_path in cache.resolve(eids).items()}
+    finally:
+        cache.close()
@@ -0,0 +1,83 @@
+"""
+Bulk resolution of local session paths to eids for the maintenance jobs.
+
+one.path2eid filters the whole sessions cache table for each path, and queries Alyx for each
+session missing from the cache. Here the sessions cache table of ONE is loaded once into a
+pandas Series keyed by 'subject/yyyy-mm-dd/nnn', so that any number of session paths are looked
+up with a single reindex. The sessions missing from the cache are queried from Alyx with one
+query per subject, and added to the table for the next calls.
+
+>>> resolver = SessionResolver(one)
+>>> eids = resolver.resolve(session_paths)  # {session_path: eid or None}
+"""
+from collections import defaultdict
+import logging
+from pathlib import Path
+
+import pandas as pd
+
+_logger = logging.getLogger('ibllib')
+
+
+def _key(subject, date, number):
+    return f'{subject}/{date}/{int(number):03d}'
+
+
+def _path_key(session_path):
+    """'subject/yyyy-mm-dd/nnn' key of a session path, None if it doesn't end with a session number"""
+    try:
+        return _key(*session_path.parts[-3:])
+    except (TypeError, ValueError):
+        return None
+
+
+class SessionResolver:
+    """
+    :param one: ONE instance, its sessions cache table is read once
+    """
+    def __init__(self, one):
+        self.one = one
+        self.table = self._load_cache()
+
+    def _load_cache(self):
+        """Series of eids indexed by 'subject/yyyy-mm-dd/nnn' from the ONE sessions cache table"""
+        sessions = getattr(self.one, '_cache', {}).get('sessions')
+        if sessions is None or len(sessions) == 0:
+            return pd.Series(dtype=object)
+        dates = pd.to_datetime(sessions['date']).dt.strftime('%Y-%m-%d')
+        keys = sessions['subject'].astype(str) + '/' + dates + '/' + sessions['number'].astype(int).map('{:03d}'.format)
+        table = pd.Series(sessions.index.astype(str), index=keys.values)
+        return table[~table.index.duplicated()]
+
+    def _query(self, keys):
+        """Queries Alyx for the sessions missing from the cache, one query per subject"""
+        by_subject = defaultdict(list)
+        for key in keys:
+            subject, date, _ = key.split('/')
+            by_subject[subject].append(date)
+        found = {}
+        for subject, dates in by_subject.items():
+            try:
+                sessions = self.one.alyx.rest('sessions', 'list', subject=subject, date_range=[min(dates), max(dates)])
+            except Exception as e:
+                _logger.warning(f'Session query failed for subject {subject}: {e}')
+                continue
+            found.update({_key(subject, s['start_time'][:10], s['number']): s['id'] for s in sessions})
+        return found
+
+    def resolve(self, session_paths):
+        """
+        :param session_paths: iterable of session paths, ending with subject/yyyy-mm-dd/nnn
+        :return: dict {session_path: eid}, eid None for the sessions not found on Alyx
+        """
+        session_paths = list(dict.fromkeys(map(Path, session_paths)))
+        keys = [_path_key(p) for p in session_paths]
+        eids = self.table.reindex(keys)
+        if missing := [k for k, eid in zip(keys, eids) if k and pd.isna(eid)]:
+            found = self._query(set(missing))
+            if found:
+                self.table = pd.concat([self.table, pd.Series(found, dtype=object)])
+                self.table = self.table[~self.table.index.duplicated()]
+                eids = self.table.reindex(keys)
+            _logger.debug(f'{len(missing)} sessions not in the ONE cache, {len(found)} found on Alyx')
+        return {p: (None if pd.isna(eid) else eid) for p, eid in zip(session_paths, eids)}
@@ -0,0 +1,91 @@
+"""
+Parallel walk of the session folders of a Subjects root: subject/yyyy-mm-dd/nnn.
+
+Each subject folder is walked by a worker thread with os.scandir, so that the folder types come
+with the listing instead of one stat per entry, and the listing latency of network storage is
+overlapped between subjects. The results are streamed subject by subject, either as the subjects
+complete or in sorted order.
+
+>>> for session_path in walk_sessions('/mnt/s0/Data/Subjects'):
+>>>     print(session_path)
+>>> yamls = list(glob_sessions('_device/photometry_00.yaml', '/mnt/s0/Data/Subjects', ordered=True))
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import glob
+import logging
+import os
+from pathlib import Path
+
+_logger = logging.getLogger('ibllib')
+
+N_THREADS = 16
+
+
+def _subdirs(path, prefix):
+    """Sub-folders of a folder whose name starts with prefix, from a single scandir"""
+    try:
+        with os.scandir(path) as it:
+            return [e.path for e in it if e.name.startswith(prefix) and e.is_dir()]
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+
+
+def _walk_subject(subject_path, pattern=None, ordered=False):
+    """
+    Session paths of a subject, or the files matching the pattern in its sessions
+    :return: list of str
+    """
+    out = []
+    for date_path in _subdirs(subject_path, '20'):
+        for session_path in _subdirs(date_path, '0'):
+            if pattern is None:
+                out.append(session_path)
+            elif glob.has_magic(pattern):
+                out.extend(glob.glob(os.path.join(glob.escape(session_path), pattern)))
+            elif os.path.exists(file := os.path.join(session_path, pattern)):
+                out.append(file)
+    return sorted(out) if ordered else out
+
+
+def _walk(root_path, pattern, n_threads, ordered):
+    subjects = _subdirs(root_path, '')
+    if ordered:
+        subjects.sort()
+    executor = ThreadPoolExecutor(max_workers=n_threads)
+    futures = []
+    try:
+        futures.extend(executor.submit(_walk_subject, s, pattern, ordered) for s in subjects)
+        for future in (futures if ordered else as_completed(futures)):
+            try:
+                yield from map(Path, future.result())
+            except Exception as e:
+                _logger.error(f'Error walking {root_path}: {e}')
+    finally:
+        # when the generator is closed early, the subjects not started yet are not walked
+        # NB: shutdown(cancel_futures=True) requires python 3.9
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def walk_sessions(root_path, n_threads=N_THREADS, ordered=False):
+    """
+    Generator of the session folders subject/20*/0* below a root folder
+    :param root_path: e.g. /mnt/s0/Data/Subjects
+    :param n_threads: number of subjects walked at the same time
+    :param ordered: if True the sessions are yielded in sorted order, else as the subjects complete
+    :return: generator of Path
+    """
+    yield from _walk(root_path, None, n_threads, ordered)
+
+
+def glob_sessions(pattern, root_path, n_threads=N_THREADS, ordered=False):
+    """
+    Generator of the files matching a glob pattern relative to each session folder
+    :param pattern: e.g. '_device/photometry_00.yaml', 'raw_video_data/*.avi'
+    :param root_path: e.g. /mnt/s0/Data/Subjects
+    :param n_threads: number of subjects walked at the same time
+    :param ordered: if True the files are yielded in sorted order, else as the subjects complete
+    :return: generator of Path
+    """
+    yield from _walk(root_path, pattern, n_threads, ordered)
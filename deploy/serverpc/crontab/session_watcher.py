@@ -0,0 +1,166 @@
+"""
+Inotify based detection of the session flags on Linux.
+
+The watcher follows the Subjects/subject/date/number folders and queues the session paths where a
+`raw_session.flag` or `extract_me.flag` file is written. Watching all the sessions of a server
+would exceed the inotify watches limit, so only the date folders of the last RECENT_DAYS days are
+watched, in addition to all the folders created while the watcher runs. Flags written in older
+sessions are found by the periodic full scan of job_creator.
+
+>>> watcher = SessionWatcher('/mnt/s0/Data/Subjects')
+>>> selector.register(watcher, selectors.EVENT_READ)
+>>> watcher.read_events()  # when readable
+>>> for session_path in watcher.pop_settled():
+>>>     job_creator(session_path)
+"""
+import ctypes
+import ctypes.util
+from datetime import date, timedelta
+import errno
+import logging
+import os
+from pathlib import Path
+import struct
+import sys
+import threading
+import time
+
+_logger = logging.getLogger('ibllib')
+
+FLAGS = ('raw_session.flag', 'extract_me.flag')
+RECENT_DAYS = 30  # date folders watched at start-up
+SETTLE_TIME = 10  # seconds without events on a session before it is processed
+
+# see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct('iIII')
+_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+
+
+def inotify_available():
+    return sys.platform.startswith('linux') and ctypes.util.find_library('c') is not None
+
+
+class SessionWatcher:
+    """
+    Watches the session folders of a Subjects folder for new flag files
+    :param root_path: "/mnt/s0/Data/Subjects"
+    :param recent_days: number of past days of date folders watched at start-up
+    """
+    def __init__(self, root_path, recent_days=RECENT_DAYS):
+        self.root_path = Path(root_path)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}  # watch descriptor: folder path
+        self.pending = {}  # session path: time of the last flag event
+        self.overflowed = False  # set when events were lost and a full scan is needed
+        self._lock = threading.Lock()
+        oldest = str(date.today() - timedelta(days=recent_days))
+        self._watch(self.root_path)
+        for subject in self._subdirs(self.root_path):
+            self._watch(subject)
+            for day in self._subdirs(subject):
+                if day.name >= oldest:
+                    self._watch_tree(day, depth=2)
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    @staticmethod
+    def _subdirs(folder):
+        try:
+            with os.scandir(folder) as it:
+                return [Path(e.path) for e in it if e.is_dir(follow_symlinks=False)]
+        except OSError:
+            return []
+
+    def _depth(self, folder):
+        return len(folder.relative_to(self.root_path).parts)
+
+    def _watch(self, folder):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(folder), _MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                _logger.warning(f'inotify watches limit reached, {folder} will only be scanned periodically')
+            elif err != errno.ENOENT:
+                _logger.warning(f'Could not watch {folder}: {os.strerror(err)}')
+            return
+        self.watches[wd] = folder
+
+    def _watch_tree(self, folder, depth):
+        """Watches a new folder and its sub-folders down to the session level, queues existing flags"""
+        self._watch(folder)
+        if depth == 3:
+            if any(folder.joinpath(flag).exists() for flag in FLAGS):
+                self._queue(folder)
+            return
+        for sub_dir in self._subdirs(folder):
+            self._watch_tree(sub_dir, depth + 1)
+
+    def _queue(self, session_path):
+        with self._lock:
+            self.pending[session_path] = time.time()
+
+    def read_events(self):
+        """
+        Reads the available inotify events, to be called when the file descriptor is readable
+        :return: number of sessions pending
+        """
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = _EVENT.unpack_from(buffer, offset)
+                name = buffer[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+                offset += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    _logger.warning('inotify queue overflow, some flags may only be found by the full scan')
+                    self.overflowed = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                folder = self.watches.get(wd)
+                if folder is None or not name:
+                    continue
+                path = folder.joinpath(os.fsdecode(name))
+                depth = self._depth(folder)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and depth < 3:
+                        self._watch_tree(path, depth + 1)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and depth == 3 and path.name in FLAGS:
+                    self._queue(folder)
+        return len(self.pending)
+
+    def pop_settled(self, settle_time=SETTLE_TIME):
+        """
+        Returns the sessions without flag events for settle_time seconds and removes them from the queue
+        :param settle_time: seconds
+        :return: list of session paths, time in seconds until the next pending session settles (or None)
+        """
+        now = time.time()
+        with self._lock:
+            settled = [s for s, t in self.pending.items() if now - t >= settle_time]
+            for session_path in settled:
+                self.pending.pop(session_path)
+            next_in = min((settle_time - (now - t) for t in self.pending.values()), default=None)
+        return settled, next_in
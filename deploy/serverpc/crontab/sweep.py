@@ -0,0 +1,82 @@
+"""
+Single pass maintenance sweep of the data root.
+
+Each maintenance handler registers the file patterns it acts upon. A sweep refreshes the file
+index of the root folder once, which is the only traversal of the tree, then dispatches the
+indexed files matching each pattern to the handlers. The number of matches, errors and the time
+spent in each handler are reported at the end of the sweep.
+
+>>> sweep = Sweep('/mnt/s0/Data/Subjects')
+>>> sweep.register('video_data_transferred.flag', correct_flag, name='correct_flags')
+>>> stats = sweep.run()
+"""
+from dataclasses import dataclass
+import logging
+import time
+import traceback
+
+from file_index import FileIndex
+
+_logger = logging.getLogger('ibllib')
+
+
+@dataclass
+class Handler:
+    name: str
+    patterns: tuple
+    func: callable
+    matches: int = 0
+    errors: int = 0
+    duration: float = 0.
+
+
+class Sweep:
+    """
+    Dispatches the files of a root folder to the handlers registered for their patterns
+    :param root_path: e.g. /mnt/s0/Data/Subjects
+    :param index: optional file_index.FileIndex of the root path
+    """
+    def __init__(self, root_path, index=None):
+        self.index = index or FileIndex(root_path)
+        self.handlers = []
+
+    def register(self, patterns, func, name=None):
+        """
+        :param patterns: file pattern or list of file patterns, see FileIndex.rglob
+        :param func: function(file_path) called for each existing file matching one of the patterns
+        :param name: name of the handler in the report, defaults to the function name
+        """
+        patterns = (patterns,) if isinstance(patterns, str) else tuple(patterns)
+        self.handlers.append(Handler(name or func.__name__, patterns, func))
+
+    def run(self, refresh=True):
+        """
+        Runs all the handlers over a single refresh of the file index.
+        An error on a file is logged and the handler carries on with the next file.
+        :param refresh: if False, uses the index as is
+        :return: dict {handler name: {'matches', 'errors', 'duration'}}
+        """
+        tstart = time.time()
+        if refresh:
+            self.index.refresh()
+        for handler in self.handlers:
+            t0 = time.time()
+            handler.matches, handler.errors = 0, 0
+            seen = set()
+            for pattern in handler.patterns:
+                for file in self.index.rglob(pattern):
+                    if file in seen:  # a file matching several patterns is handled once
+                        continue
+                    seen.add(file)
+                    handler.matches += 1
+                    try:
+                        handler.func(file)
+                    except Exception:
+                        handler.errors += 1
+                        _logger.error(f'{handler.name} failed on {file}\n{traceback.format_exc()}')
+            handler.duration = time.time() - t0
+        stats = {h.name: dict(matches=h.matches, errors=h.errors, duration=h.duration) for h in self.handlers}
+        lines = [f'{name:<48} {s["matches"]:>8} matches {s["errors"]:>6} errors {s["duration"]:10.1f} s'
+                 for name, s in stats.items()]
+        _logger.info(f'Sweep done in {time.time() - tstart:.1f} s\n' + '\n'.join(lines))
+        return stats
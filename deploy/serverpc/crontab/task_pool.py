@@ -0,0 +1,310 @@
+"""
+Parallel execution of the Alyx task queue on a local server.
+
+The tasks returned by `ibllib.pipes.local_server.task_queue` are dispatched to a bounded pool of
+worker processes. A task is only dispatched once none of its parents are still waiting or
+running within the same batch, so that the dependency check in `run_alyx_task` sees the final
+status of the parents. The number of concurrent tasks can be capped per task name.
+
+The small tasks can instead be grouped by session, each group running back-to-back in a single
+worker with the raw data loaded by the tasks shared between them, see session_cache.py.
+"""
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import logging
+import time
+import traceback
+
+from one.api import ONE
+
+from session_cache import session_cache
+from session_paths import resolve_session_paths
+from task_profiling import run_task
+
+_logger = logging.getLogger('ibllib')
+
+N_WORKERS = 4  # default number of worker processes
+MAX_PER_TASK = {}  # default per task name concurrency caps, e.g. {'EphysPulses': 1}
+ADMISSION_INTERVAL = 60  # seconds between admission checks while tasks are running
+
+_one = None  # ONE instance of the worker process, see _init_worker
+
+
+def _init_worker():
+    """Each worker process instantiates its own ONE as the REST client can't be shared"""
+    global _one
+    _one = ONE(cache_rest=None)
+
+
+def _task_failed(task):
+    """run_alyx_task returns the task instance, or the task dictionary if it didn't run"""
+    return getattr(task, 'status', 0) == -1
+
+
+def _run_task(tdict, session_path):
+    """
+    Runs a single Alyx task in a worker process.
+    The job deck is not passed so that the parents status is read from Alyx at run time.
+    :param tdict: task dictionary from Alyx
+    :param session_path: local session path
+    :return: list of registered datasets, whether the task failed, duration in seconds
+    """
+    tstart = time.time()
+    task, dsets = run_task(tdict=tdict, session_path=session_path, one=_one)
+    return dsets, _task_failed(task), time.time() - tstart
+
+
+def _run_session_group(tdicts, session_path, one=None):
+    """
+    Runs the tasks of a session one after the other, sharing the raw data they load
+    :param tdicts: list of task dictionaries of the same session, in running order
+    :param session_path: local session path
+    :param one: ONE instance, defaults to the one of the worker process
+    :return: list of (task name, registered datasets, whether the task failed, duration in seconds)
+    """
+    results = []
+    with session_cache():
+        for tdict in tdicts:
+            _logger.info(f"Running task {tdict['name']} for session {session_path}")
+            tstart = time.time()
+            try:
+                task, dsets = run_task(tdict=tdict, session_path=session_path, one=one or _one)
+                failed = _task_failed(task)
+            except Exception:
+                _logger.error(f"Error running task {tdict['name']} for session {session_path}\n{traceback.format_exc()}")
+                dsets, failed = [], True
+            results.append((tdict['name'], dsets, failed, time.time() - tstart))
+    return results
+
+
+def group_by_session(waiting_tasks):
+    """
+    Groups the tasks per session, sessions in order of their first task in the queue
+    Within a session the tasks are sorted by level so that the parents run before their children
+    :param waiting_tasks: list of task dictionaries, as returned by task_queue
+    :return: dict {eid: [tdict, ...]}
+    """
+    groups = defaultdict(list)
+    for tdict in waiting_tasks:
+        groups[tdict['session']].append(tdict)
+    for tdicts in groups.values():
+        tdicts.sort(key=lambda t: (t.get('level') or 0, -(t.get('priority') or 0)))
+    return dict(groups)
+
+
+def parse_task_caps(caps):
+    """
+    Parses per task name concurrency caps from the command line
+    :param caps: list of strings formatted as 'TaskName=N'
+    :return: dict {'TaskName': N}
+    """
+    out = {}
+    for cap in caps or []:
+        name, _, n = cap.partition('=')
+        if not n.isdigit():
+            raise ValueError(f'Invalid task cap "{cap}", expected TaskName=N')
+        out[name] = int(n)
+    return out
+
+
+def run_tasks_serial(subjects_path, waiting_tasks, one=None, count=20, time_out=None, dry=False, metrics=None):
+    """
+    Runs the waiting tasks one after the other in this process, same as
+    ibllib.pipes.local_server.tasks_runner but with the session paths resolved in bulk
+    :param subjects_path: "/mnt/s0/Data/Subjects"
+    :param waiting_tasks: list of task dictionaries, as returned by task_queue
+    :param one: ONE instance
+    :param count: maximum number of tasks registering datasets before returning
+    :param time_out: time in seconds after which no new tasks are run
+    :param dry: if True, only prints the session paths and task names
+    :param metrics: optional metrics.JobMetrics instance recording the task durations
+    :return: list of registered datasets
+    """
+    one = one or ONE(cache_rest=None)
+    session_paths = resolve_session_paths(one, subjects_path, [t['session'] for t in waiting_tasks])
+    tstart = time.time()
+    all_datasets = []
+    c = 0
+    for tdict in waiting_tasks:
+        # if the count is reached or if the time_out has been elapsed, break the loop and return
+        if c >= count or (time_out and time.time() - tstart > time_out):
+            break
+        if tdict['session'] not in session_paths:
+            continue
+        session_path = session_paths[tdict['session']]
+        if dry:
+            print(session_path, tdict['name'])
+            continue
+        t0 = time.time()
+        task, dsets = run_task(tdict=tdict, session_path=session_path, one=one, job_deck=waiting_tasks)
+        if metrics:
+            metrics.task_done(tdict['name'], time.time() - t0, failed=_task_failed(task))
+        if dsets:
+            all_datasets.extend(dsets)
+            c += 1
+    return all_datasets
+
+
+def run_tasks_parallel(subjects_path, waiting_tasks, one=None, n_workers=N_WORKERS, max_per_task=None,
+                       count=20, time_out=None, dry=False, admit=None, metrics=None):
+    """
+    Runs the waiting tasks concurrently in a pool of worker processes.
+    Tasks are dispatched in queue order. Tasks whose parents are part of the batch are held back
+    until the parents are finished. Once `count` tasks have registered datasets or `time_out`
+    has elapsed, no new tasks are dispatched and the running tasks are awaited.
+    An admission function can hold back tasks according to the resources of the server, in which
+    case the admission of the pending tasks is checked again every ADMISSION_INTERVAL seconds.
+    :param subjects_path: "/mnt/s0/Data/Subjects"
+    :param waiting_tasks: list of task dictionaries, as returned by task_queue
+    :param one: ONE instance, used to resolve session paths
+    :param n_workers: maximum number of tasks running at the same time
+    :param max_per_task: dict of maximum number of concurrent tasks per task name, overrides MAX_PER_TASK
+    :param count: maximum number of tasks registering datasets before returning
+    :param time_out: time in seconds after which no new tasks are dispatched
+    :param dry: if True, only prints the session paths and task names
+    :param admit: function(tdict, running_tasks) -> bool, see admission.ResourceAdmission
+    :param metrics: optional metrics.JobMetrics instance recording the task durations
+    :return: list of registered datasets
+    """
+    one = one or ONE(cache_rest=None)
+    max_per_task = {**MAX_PER_TASK, **(max_per_task or {})}
+    session_paths = resolve_session_paths(one, subjects_path, [t['session'] for t in waiting_tasks])
+    waiting_tasks = [t for t in waiting_tasks if t['session'] in session_paths]
+    if dry:
+        for tdict in waiting_tasks:
+            print(session_paths[tdict['session']], tdict['name'])
+        return []
+
+    tstart = time.time()
+    pending = list(waiting_tasks)
+    unfinished = set(t['id'] for t in pending)  # tasks of the batch that are not finished yet
+    running = {}
+    n_running = Counter()
+    all_datasets = []
+    c = 0
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker) as executor:
+        while pending or running:
+            if c >= count or (time_out and time.time() - tstart > time_out):
+                pending = []
+            for tdict in list(pending):
+                if len(running) >= n_workers:
+                    break
+                if unfinished.intersection(tdict['parents'] or []):
+                    continue
+                if n_running[tdict['name']] >= max_per_task.get(tdict['name'], n_workers):
+                    continue
+                if admit and not admit(tdict, list(running.values())):
+                    continue
+                pending.remove(tdict)
+                session_path = session_paths[tdict['session']]
+                _logger.info(f"Running task {tdict['name']} for session {session_path}")
+                running[executor.submit(_run_task, tdict, session_path)] = tdict
+                n_running[tdict['name']] += 1
+            if not running:
+                # the remaining tasks have parents that can't be run in this batch, or aren't admitted
+                break
+            done, _ = wait(running, timeout=ADMISSION_INTERVAL if admit else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                tdict = running.pop(future)
+                n_running[tdict['name']] -= 1
+                unfinished.discard(tdict['id'])
+                try:
+                    dsets, failed, duration = future.result()
+                except Exception:
+                    _logger.error(f"Error running task {tdict['name']} for session {tdict['session']}\n"
+                                  f"{traceback.format_exc()}")
+                    if metrics:
+                        metrics.task_done(tdict['name'], None, failed=True)
+                    continue
+                if metrics:
+                    metrics.task_done(tdict['name'], duration, failed=failed)
+                if dsets:
+                    all_datasets.extend(dsets)
+                    c += 1  # i.e. only tasks that output datasets are counted towards count
+    return all_datasets
+
+
+def run_session_groups(subjects_path, waiting_tasks, one=None, n_workers=1, max_per_task=None, count=20,
+                       time_out=None, dry=False, metrics=None):
+    """
+    Runs the waiting tasks grouped by session: all the tasks of a session run back-to-back in the
+    same worker and share the settings, Bpod data and sync they load, see session_cache.py.
+    Once `count` tasks have registered datasets or `time_out` has elapsed, no new session is started.
+    A session is held back while one of its task names is at its cap in the running sessions.
+    Admission doesn't apply, this is meant for the small tasks.
+    :param subjects_path: "/mnt/s0/Data/Subjects"
+    :param waiting_tasks: list of task dictionaries, as returned by task_queue
+    :param one: ONE instance
+    :param n_workers: number of sessions processed at the same time, if 1 the groups run in this process
+    :param max_per_task: dict of maximum number of concurrent tasks per task name, overrides MAX_PER_TASK
+    :param count: maximum number of tasks registering datasets before returning
+    :param time_out: time in seconds after which no new session is started
+    :param dry: if True, only prints the session paths and task names
+    :param metrics: optional metrics.JobMetrics instance recording the task durations
+    :return: list of registered datasets
+    """
+    one = one or ONE(cache_rest=None)
+    session_paths = resolve_session_paths(one, subjects_path, [t['session'] for t in waiting_tasks])
+    groups = [(session_paths[eid], tdicts) for eid, tdicts in group_by_session(waiting_tasks).items()
+              if eid in session_paths]
+    if dry:
+        for session_path, tdicts in groups:
+            print(session_path, ', '.join(t['name'] for t in tdicts))
+        return []
+
+    tstart = time.time()
+    all_datasets = []
+    c = 0
+
+    def _record(results):
+        nonlocal c
+        for name, dsets, failed, duration in results:
+            if metrics:
+                metrics.task_done(name, duration, failed=failed)
+            if dsets:
+                all_datasets.extend(dsets)
+                c += 1  # i.e. only tasks that output datasets are counted towards count
+
+    def _stop():
+        return c >= count or (time_out and time.time() - tstart > time_out)
+
+    if n_workers == 1:
+        for session_path, tdicts in groups:
+            if _stop():
+                break
+            _record(_run_session_group(tdicts, session_path, one=one))
+        return all_datasets
+
+    max_per_task = {**MAX_PER_TASK, **(max_per_task or {})}
+    running = {}
+    n_running = Counter()  # number of running sessions having each task name
+
+    def _capped(tdicts):
+        return any(n_running[name] >= max_per_task[name] for name in set(t['name'] for t in tdicts) if name in max_per_task)
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker) as executor:
+        while groups or running:
+            if _stop():
+                groups = []
+            for session_path, tdicts in list(groups):
+                if len(running) >= n_workers:
+                    break
+                if _capped(tdicts):
+                    continue
+                groups.remove((session_path, tdicts))
+                running[executor.submit(_run_session_group, tdicts, session_path)] = (session_path, tdicts)
+                n_running.update(set(t['name'] for t in tdicts))
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                session_path, tdicts = running.pop(future)
+                n_running.subtract(set(t['name'] for t in tdicts))
+                try:
+                    _record(future.result())
+                except Exception:
+                    _logger.error(f"Error running the tasks of session {session_path}\n{traceback.format_exc()}")
+                    if metrics:
+                        for tdict in tdicts:
+                            metrics.task_done(tdict['name'], None, failed=True)
+    return all_datasets
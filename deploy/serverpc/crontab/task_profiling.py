@@ -0,0 +1,141 @@
+"""
+Opt-in profiling of the Alyx tasks run on the local server.
+
+When the IBL_TASK_PROFILE environment variable is set (or jobs.py is run with --profile), each
+task is run under cProfile and tracemalloc. The profile and the top memory allocations are saved
+in PROFILE_DIR/<task name>/, keeping the N_KEEP most recent runs of each task name.
+NB: tracemalloc slows down allocation heavy tasks noticeably, this is meant for investigations.
+tracemalloc and cProfile are global to the process: when tasks run in several threads of the same
+process (jobs.py daemon), only one task at a time is profiled and the others run normally.
+Profiling never changes the outcome of a task, the errors while saving a profile are only logged.
+
+Aggregate the hottest functions over all the saved runs of a task:
+    python task_profiling.py summarize TrainingTrials --sort tottime --top 30
+List the task names and number of saved runs:
+    python task_profiling.py list
+"""
+import argparse
+import cProfile
+from datetime import datetime
+import logging
+import os
+from pathlib import Path
+import pstats
+import threading
+import tracemalloc
+
+from ibllib.pipes.tasks import run_alyx_task
+
+import local_db
+
+_logger = logging.getLogger('ibllib')
+
+ENV_VAR = 'IBL_TASK_PROFILE'
+PROFILE_DIR = local_db.STATE_DIR.joinpath('profiles')
+N_KEEP = 20  # number of profiles kept per task name
+N_MEMORY_LINES = 25  # number of top allocation sites saved per run
+
+_profiling = threading.Lock()  # held while a task of the process is profiled
+
+
+def profiling_enabled():
+    return os.environ.get(ENV_VAR, '').lower() in ('1', 'true', 'yes')
+
+
+def _rotate(task_dir, n_keep=N_KEEP):
+    """Removes the oldest profiles of a task name, the worker processes of a pool may rotate them at the same time"""
+    for prof_file in sorted(task_dir.glob('*.prof'))[:-n_keep]:
+        prof_file.unlink(missing_ok=True)
+        prof_file.with_suffix('.mem.txt').unlink(missing_ok=True)
+
+
+def run_task(tdict=None, session_path=None, profile=None, profile_dir=None, **kwargs):
+    """
+    Runs run_alyx_task, under cProfile and tracemalloc if profiling is enabled
+    :param tdict: task dictionary from Alyx
+    :param session_path: local session path
+    :param profile: bool, defaults to the IBL_TASK_PROFILE environment variable
+    :param profile_dir: root folder of the profiles, defaults to PROFILE_DIR
+    :param kwargs: passed to run_alyx_task
+    :return: task, registered datasets
+    """
+    if not (profiling_enabled() if profile is None else profile):
+        return run_alyx_task(tdict=tdict, session_path=session_path, **kwargs)
+    if not _profiling.acquire(blocking=False):
+        _logger.info(f"Another task is being profiled in this process, running {tdict['name']} without profiling")
+        return run_alyx_task(tdict=tdict, session_path=session_path, **kwargs)
+    try:
+        profiler = cProfile.Profile()
+        try:
+            tracemalloc.start()
+            profiler.enable()
+        except Exception as e:  # e.g. another profiler is active on python 3.12
+            tracemalloc.stop()
+            _logger.warning(f"Could not profile {tdict['name']}: {e}")
+            return run_alyx_task(tdict=tdict, session_path=session_path, **kwargs)
+        try:
+            return run_alyx_task(tdict=tdict, session_path=session_path, **kwargs)
+        finally:
+            profiler.disable()
+            try:
+                _save_profile(profiler, tdict['name'], session_path, profile_dir)
+            except Exception as e:
+                _logger.warning(f"Could not save the profile of {tdict['name']}: {e}")
+            finally:
+                tracemalloc.stop()
+    finally:
+        _profiling.release()
+
+
+def _save_profile(profiler, task_name, session_path, profile_dir=None):
+    """Saves the cProfile stats and the tracemalloc top allocations of a run, then rotates the profiles"""
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    task_dir = Path(profile_dir or PROFILE_DIR).joinpath(task_name)
+    task_dir.mkdir(parents=True, exist_ok=True)
+    stem = f"{datetime.now():%Y-%m-%dT%H%M%S%f}_{'_'.join(Path(session_path).parts[-3:])}"
+    profiler.dump_stats(task_dir.joinpath(f'{stem}.prof'))
+    lines = [f'peak traced memory: {peak / 1024 ** 2:.1f} MB']
+    lines += [str(stat) for stat in snapshot.statistics('lineno')[:N_MEMORY_LINES]]
+    task_dir.joinpath(f'{stem}.mem.txt').write_text('\n'.join(lines))
+    _rotate(task_dir)
+    _logger.info(f"Saved profile of {task_name} in {task_dir.joinpath(stem)}.prof")
+
+
+def summarize(task_name, sort='cumulative', top=30, profile_dir=None):
+    """
+    Prints the hottest functions aggregated over all the saved runs of a task name
+    :param task_name: e.g. 'TrainingTrials'
+    :param sort: pstats sort key, e.g. 'cumulative', 'tottime'
+    :param top: number of functions printed
+    """
+    task_dir = Path(profile_dir or PROFILE_DIR).joinpath(task_name)
+    prof_files = sorted(task_dir.glob('*.prof'))
+    if not prof_files:
+        print(f'No profiles found in {task_dir}')
+        return
+    print(f'{task_name}: {len(prof_files)} runs from {prof_files[0].stem} to {prof_files[-1].stem}')
+    peaks = []
+    for mem_file in task_dir.glob('*.mem.txt'):
+        peaks.append(float(mem_file.read_text().split('\n', 1)[0].split()[-2]))
+    if peaks:
+        print(f'peak traced memory: median {sorted(peaks)[len(peaks) // 2]:.1f} MB, max {max(peaks):.1f} MB')
+    stats = pstats.Stats(*map(str, prof_files))
+    stats.strip_dirs().sort_stats(sort).print_stats(top)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the task profiles')
+    parser.add_argument('action', help='Action: summarize, list')
+    parser.add_argument('task', help='Task name', nargs='?')
+    parser.add_argument('--sort', help='pstats sort key', default='cumulative')
+    parser.add_argument('--top', help='Number of functions to print', default=30, type=int)
+    parser.add_argument('--dir', help='Profiles folder', default=None)
+    args = parser.parse_args()
+    if args.action == 'summarize':
+        summarize(args.task, sort=args.sort, top=args.top, profile_dir=args.dir)
+    elif args.action == 'list':
+        for task_dir in sorted(Path(args.dir or PROFILE_DIR).glob('*')):
+            print(f"{task_dir.name:<40} {len(list(task_dir.glob('*.prof')))} runs")
+    else:
+        _logger.error(f'Action "{args.action}" not valid. Allowed actions are: summarize, list')
@@ -12,9 +12,16 @@ how to read and manipulate SpikeGLX meta and binary files.
 The most important part of the demo is readMeta().
 Please read the comments for that function. Use of
 the 'meta' dictionary will make your data handling
-much easier!
+much easier! It is parsed once per meta file, so the
+helper functions below are cheap to call repeatedly.
 
 """
+import bisect
+from collections import OrderedDict
+from collections.abc import Mapping
+import glob
+import re
+
 import numpy as np
 import matplotlib.pyplot as plt
 from pathlib import Path
@@ -22,33 +29,143 @@ from tkinter import Tk
 from tkinter import filedialog
 
 
-# Parse ini file returning a dictionary whose keys are the metadata
-# left-hand-side-tags, and values are string versions of the right-hand-side
-# metadata values. We remove any leading '~' characters in the tags to match
-# the MATLAB version of readMeta.
+# Parsed SpikeGLX metadata, as returned by readMeta. It behaves as the
+# read-only dictionary of strings returned previously, so meta['tag'] still
+# works, and exposes the parsed values as attributes: the numbers and the
+# channel index and gain vectors are parsed on first access only, and kept
+# for the lifetime of the object. The vectors are read-only arrays shared by
+# all the callers.
 #
-# The string values are converted to numbers using the "int" and "float"
-# fucntions. Note that python 3 has no size limit for integers.
+class SGLXMeta(Mapping):
+    _lazy = ('_sampRate', '_int2Volts', '_origChans', '_gainsIM', '_gainsNI',
+             '_countsIM', '_countsNI')
+    __slots__ = ('path', '_tags') + _lazy
+
+    def __init__(self, tags, path=None):
+        self.path = path
+        self._tags = dict(tags)
+        for slot in self._lazy:
+            setattr(self, slot, None)
+
+    # Parse ini file into a dictionary whose keys are the metadata
+    # left-hand-side-tags, and values are string versions of the
+    # right-hand-side metadata values. We remove any leading '~' characters
+    # in the tags to match the MATLAB version of readMeta.
+    @classmethod
+    def fromFile(cls, metaPath):
+        tags = {}
+        with Path(metaPath).open() as f:
+            for m in f.read().splitlines():
+                key, _, value = m.partition('=')
+                tags[key[1:] if key.startswith('~') else key] = value
+        return cls(tags, path=Path(metaPath))
+
+    def __getitem__(self, key):
+        return self._tags[key]
+
+    def __iter__(self):
+        return iter(self._tags)
+
+    def __len__(self):
+        return len(self._tags)
+
+    def __repr__(self):
+        return f"SGLXMeta('{self.path}', {len(self._tags)} tags)"
+
+    def _cached(self, slot, parse):
+        value = getattr(self, slot)
+        if value is None:
+            value = parse()
+            setattr(self, slot, value)
+        return value
+
+    @property
+    def isImec(self):
+        return self._tags['typeThis'] == 'imec'
+
+    @property
+    def sampRate(self):
+        return self._cached('_sampRate', lambda: float(
+            self._tags['imSampRate'] if self.isImec else self._tags['niSampRate']))
+
+    @property
+    def int2Volts(self):
+        return self._cached('_int2Volts', lambda: float(self._tags['imAiRangeMax']) / 512
+                            if self.isImec else float(self._tags['niAiRangeMax']) / 32768)
+
+    @property
+    def nSavedChans(self):
+        return int(self._tags['nSavedChans'])
+
+    @property
+    def nFileSamp(self):
+        return int(self._tags['fileSizeBytes']) // (2 * self.nSavedChans)
+
+    @property
+    def originalChans(self):
+        return self._cached('_origChans', self._parseOriginalChans)
+
+    @property
+    def chanGainsIM(self):
+        return self._cached('_gainsIM', self._parseChanGainsIM)
+
+    @property
+    def gainsNI(self):
+        return self._cached('_gainsNI', lambda: (float(self._tags['niMNGain']), float(self._tags['niMAGain'])))
+
+    @property
+    def channelCountsIM(self):
+        return self._cached('_countsIM', lambda: tuple(int(c) for c in self._tags['snsApLfSy'].split(sep=',')[:3]))
+
+    @property
+    def channelCountsNI(self):
+        return self._cached('_countsNI', lambda: tuple(int(c) for c in self._tags['snsMnMaXaDw'].split(sep=',')[:4]))
+
+    # snsSaveChanSubset is either 'all' or a comma separated list of channels
+    # and of chan1:chan2 inclusive ranges of contiguous channels
+    def _parseOriginalChans(self):
+        if self._tags['snsSaveChanSubset'] == 'all':
+            # output = int32, 0 to nSavedChans - 1
+            chans = np.arange(0, self.nSavedChans)
+        else:
+            ranges = [sL.split(sep=':') for sL in self._tags['snsSaveChanSubset'].split(sep=',')]
+            chans = np.concatenate([np.arange(0, 0)] + [np.arange(int(r[0]), int(r[-1]) + 1) for r in ranges])
+        chans.flags.writeable = False
+        return chans
+
+    # imroTbl is a header entry followed by one entry per channel, each in
+    # parentheses, the AP and LF gains are the 4th and 5th fields of an entry
+    def _parseChanGainsIM(self):
+        entries = self._tags['imroTbl'].split(sep=')')[1:-1]
+        gains = np.array([e.split(sep=' ')[3:5] for e in entries], dtype=float).reshape(-1, 2)
+        APgain, LFgain = np.ascontiguousarray(gains[:, 0]), np.ascontiguousarray(gains[:, 1])
+        APgain.flags.writeable = LFgain.flags.writeable = False
+        return APgain, LFgain
+
+
+# {metaPath: (mtime, SGLXMeta)}, a meta file is parsed again once modified
+_metaCache = {}
+
+
+def _asMeta(meta):
+    return meta if isinstance(meta, SGLXMeta) else SGLXMeta(meta)
+
+
+# Return the SGLXMeta of a binary file, see above. The metadata is parsed
+# once per version of the meta file: the calls for the same file return the
+# same object as long as its modification time is unchanged.
 #
 def readMeta(binFullPath):
-    metaName = binFullPath.stem + ".meta"
-    metaPath = Path(binFullPath.parent / metaName)
-    metaDict = {}
-    if metaPath.exists():
-        # print("meta file present")
-        with metaPath.open() as f:
-            mdatList = f.read().splitlines()
-            # convert the list entries into key value pairs
-            for m in mdatList:
-                csList = m.split(sep='=')
-                if csList[0][0] == '~':
-                    currKey = csList[0][1:len(csList[0])]
-                else:
-                    currKey = csList[0]
-                metaDict.update({currKey: csList[1]})
-    else:
+    binFullPath = Path(binFullPath)
+    metaPath = binFullPath.parent / (binFullPath.stem + ".meta")
+    if not metaPath.exists():
         print("no meta file")
-    return metaDict
+        return SGLXMeta({})
+    mtime = metaPath.stat().st_mtime_ns
+    cached = _metaCache.get(metaPath)
+    if cached is None or cached[0] != mtime:
+        cached = _metaCache[metaPath] = (mtime, SGLXMeta.fromFile(metaPath))
+    return cached[1]
 
 
 # Return sample rate as python float.
@@ -56,8 +173,7 @@ def readMeta(binFullPath):
 # Use python command sys.float_info to get properties of float on your system.
 #
 def SampRate(meta):
-    srate = float(meta['imSampRate']) if meta['typeThis'] == 'imec' else float(meta['niSampRate'])
-    return srate
+    return _asMeta(meta).sampRate
 
 
 # Return a multiplicative factor for converting 16-bit file data
@@ -67,11 +183,7 @@ def SampRate(meta):
 # Note that each channel may have its own gain.
 #
 def Int2Volts(meta):
-    if meta['typeThis'] == 'imec':
-        fI2V = float(meta['imAiRangeMax']) / 512
-    else:
-        fI2V = float(meta['niAiRangeMax']) / 32768
-    return fI2V
+    return _asMeta(meta).int2Volts
 
 
 # Return array of original channel IDs. As an example, suppose we want the
@@ -83,35 +195,14 @@ def Int2Volts(meta):
 # Note that the SpikeGLX channels are 0 based.
 #
 def OriginalChans(meta):
-    if meta['snsSaveChanSubset'] == 'all':
-        # output = int32, 0 to nSavedChans - 1
-        chans = np.arange(0, int(meta['nSavedChans']))
-    else:
-        # parse the snsSaveChanSubset string
-        # split at commas
-        chStrList = meta['snsSaveChanSubset'].split(sep=',')
-        chans = np.arange(0, 0)  # creates an empty array of int32
-        for sL in chStrList:
-            currList = sL.split(sep=':')
-            if len(currList) > 1:
-                # each set of contiguous channels specified by
-                # chan1:chan2 inclusive
-                newChans = np.arange(int(currList[0]), int(currList[1]) + 1)
-            else:
-                newChans = np.arange(int(currList[0]), int(currList[0]) + 1)
-            chans = np.append(chans, newChans)
-    return chans
+    return _asMeta(meta).originalChans
 
 
 # Return counts of each nidq channel type that composes the timepoints
 # stored in the binary file.
 #
 def ChannelCountsNI(meta):
-    chanCountList = meta['snsMnMaXaDw'].split(sep=',')
-    MN = int(chanCountList[0])
-    MA = int(chanCountList[1])
-    XA = int(chanCountList[2])
-    DW = int(chanCountList[3])
+    MN, MA, XA, DW = _asMeta(meta).channelCountsNI
     return MN, MA, XA, DW
 
 
@@ -119,10 +210,7 @@ def ChannelCountsNI(meta):
 # stored in the binary files.
 #
 def ChannelCountsIM(meta):
-    chanCountList = meta['snsApLfSy'].split(sep=',')
-    AP = int(chanCountList[0])
-    LF = int(chanCountList[1])
-    SY = int(chanCountList[2])
+    AP, LF, SY = _asMeta(meta).channelCountsIM
     return AP, LF, SY
 
 
@@ -131,9 +219,9 @@ def ChannelCountsIM(meta):
 #
 def ChanGainNI(ichan, savedMN, savedMA, meta):
     if ichan < savedMN:
-        gain = float(meta['niMNGain'])
+        gain = _asMeta(meta).gainsNI[0]
     elif ichan < (savedMN + savedMA):
-        gain = float(meta['niMAGain'])
+        gain = _asMeta(meta).gainsNI[1]
     else:
         gain = 1    # non multiplexed channels have no extra gain
     return gain
@@ -143,16 +231,7 @@ def ChanGainNI(ichan, savedMN, savedMA, meta):
 # Index into these with the original (acquired) channel IDs.
 #
 def ChanGainsIM(meta):
-    imroList = meta['imroTbl'].split(sep=')')
-    # One entry for each channel plus header entry,
-    # plus a final empty entry following the last ')'
-    nChan = len(imroList) - 2
-    APgain = np.zeros(nChan)        # default type = float
-    LFgain = np.zeros(nChan)
-    for i in range(0, nChan):
-        currList = imroList[i + 1].split(sep=' ')
-        APgain[i] = currList[3]
-        LFgain[i] = currList[4]
+    APgain, LFgain = _asMeta(meta).chanGainsIM
     return APgain, LFgain
 
 
@@ -165,21 +244,26 @@ def ChanGainsIM(meta):
 # [2,6,20]  just these three channels (zero based, as they appear in SGLX).
 #
 def GainCorrectNI(dataArray, chanList, meta):
+    # dataArray contains only the channels in chanList, so output matches
+    # that shape
+    convArray = dataArray * ChanConvNI(chanList, meta)[:, np.newaxis]
+    return convArray
+
+
+# Return the vector of factors converting the saved nidq channels in
+# chanList to volts: fI2V / gain of each channel.
+#
+def ChanConvNI(chanList, meta):
+    meta = _asMeta(meta)
     MN, MA, XA, DW = ChannelCountsNI(meta)
     fI2V = Int2Volts(meta)
-    # print statements used for testing...
-    # print("NI fI2V: %.3e" % (fI2V))
-    # print("NI ChanGainNI: %.3f" % (ChanGainNI(0, MN, MA, meta)))
-
-    # make array of floats to return. dataArray contains only the channels
-    # in chanList, so output matches that shape
-    convArray = np.zeros(dataArray.shape, dtype=float)
-    for i in range(0, len(chanList)):
-        j = chanList[i]             # index into timepoint
-        conv = fI2V / ChanGainNI(j, MN, MA, meta)
-        # dataArray contains only the channels in chanList
-        convArray[i, :] = dataArray[i, :] * conv
-    return convArray
+    j = np.asarray(chanList)    # index into timepoint
+    if MN + MA == 0:
+        return np.full(j.shape, fI2V)
+    MNgain, MAgain = meta.gainsNI
+    # non multiplexed channels have no extra gain
+    gains = np.select([j < MN, j < MN + MA], [MNgain, MAgain], default=1)
+    return fI2V / gains
 
 
 # Having accessed a block of raw imec data using makeMemMapRaw, convert
@@ -193,41 +277,272 @@ def GainCorrectNI(dataArray, chanList, meta):
 # OriginalChans) will be in the range 384-767 for a standard 3A or 3B probe.
 #
 def GainCorrectIM(dataArray, chanList, meta):
+    # The dataArray contains only the channels in chList, so output matches
+    # that shape
+    convArray = dataArray * ChanConvIM(chanList, meta)[:, np.newaxis]
+    return convArray
+
+
+# Return the vector of factors converting the saved imec channels in
+# chanList to volts: fI2V / gain of each channel, 1 for the sync channel.
+#
+def ChanConvIM(chanList, meta):
+    meta = _asMeta(meta)
     # Look up gain with acquired channel ID
-    chans = OriginalChans(meta)
+    k = OriginalChans(meta)[np.asarray(chanList)]
     APgain, LFgain = ChanGainsIM(meta)
     nAP = len(APgain)
     nNu = nAP * 2
-
     # Common converstion factor
     fI2V = Int2Volts(meta)
+    conv = np.ones(k.shape)
+    isAP, isLF = k < nAP, (k >= nAP) & (k < nNu)
+    conv[isAP] = fI2V / APgain[k[isAP]]
+    conv[isLF] = fI2V / LFgain[k[isLF] - nAP]
+    return conv
 
-    # make array of floats to return. dataArray contains only the channels
-    # in chanList, so output matches that shape
-    convArray = np.zeros(dataArray.shape, dtype='float')
-    for i in range(0, len(chanList)):
-        j = chanList[i]     # index into timepoint
-        k = chans[j]        # acquisition index
-        if k < nAP:
-            conv = fI2V / APgain[k]
-        elif k < nNu:
-            conv = fI2V / LFgain[k - nAP]
-        else:
-            conv = 1
-        # The dataArray contains only the channels in chList
-        convArray[i, :] = dataArray[i, :] * conv
-    return convArray
 
-
-def makeMemMapRaw(binFullPath, meta):
-    nChan = int(meta['nSavedChans'])
-    nFileSamp = int(int(meta['fileSizeBytes']) / (2 * nChan))
+# Return the raw data of a binary file as an int16 array [channels X
+# timepoints]: a memmap for a .bin file, a CbinRaw for a .cbin file.
+#
+def makeMemMapRaw(binFullPath, meta, cacheBytes=2 ** 28):
+    meta = _asMeta(meta)
+    if Path(binFullPath).suffix == '.cbin':
+        return CbinRaw(binFullPath, meta, cacheBytes=cacheBytes)
+    nChan = meta.nSavedChans
+    nFileSamp = meta.nFileSamp
     print("nChan: %d, nFileSamp: %d" % (nChan, nFileSamp))
     rawData = np.memmap(binFullPath, dtype='int16', mode='r',
                         shape=(nChan, nFileSamp), offset=0, order='F')
     return rawData
 
 
+# Random access to a mtscomp compressed .cbin file, with the slicing
+# interface of the memmap returned by makeMemMapRaw: raw[chanList, first:last]
+# is an int16 array [channels X timepoints]. Only the chunks touched by a
+# slice are decompressed. The decompressed chunks are kept in a least
+# recently used cache of at most cacheBytes, so that reading random windows
+# costs one decompression per chunk as long as they fit in the cache.
+# The compression header is the .ch file next to the .cbin file.
+#
+class CbinRaw:
+
+    def __init__(self, cbinFullPath, meta=None, cacheBytes=2 ** 28):
+        # mtscomp is only needed to read compressed files
+        from mtscomp import Reader
+        self.path = Path(cbinFullPath)
+        self.reader = Reader()
+        self.reader.open(self.path, self.path.with_suffix('.ch'))
+        self.shape = (self.reader.n_channels, self.reader.n_samples)
+        self.dtype = self.reader.dtype
+        self.ndim = 2
+        if meta is not None and _asMeta(meta).nSavedChans != self.shape[0]:
+            raise ValueError(f"{self.path}: {self.shape[0]} channels, the meta file has {_asMeta(meta).nSavedChans}")
+        self.cacheBytes = cacheBytes
+        self.stats = dict(hits=0, misses=0)
+        self._cache = OrderedDict()
+        self._cachedBytes = 0
+
+    # Return the decompressed chunk [timepoints X channels], from the cache
+    # if possible.
+    def _chunk(self, iChunk):
+        chunk = self._cache.get(iChunk)
+        if chunk is not None:
+            self.stats['hits'] += 1
+            self._cache.move_to_end(iChunk)
+            return chunk
+        self.stats['misses'] += 1
+        offsets = self.reader.chunk_offsets
+        # the reader wraps read_chunk in its own cache of whole chunks, bypass it
+        chunk = type(self.reader).read_chunk(self.reader, iChunk, offsets[iChunk], offsets[iChunk + 1] - offsets[iChunk])
+        chunk.flags.writeable = False
+        self._cache[iChunk] = chunk
+        self._cachedBytes += chunk.nbytes
+        while self._cachedBytes > self.cacheBytes and len(self._cache) > 1:
+            self._cachedBytes -= self._cache.popitem(last=False)[1].nbytes
+        return chunk
+
+    def __getitem__(self, item):
+        chans, samples = item if isinstance(item, tuple) else (item, slice(None))
+        nSamp = self.shape[1]
+        if not isinstance(samples, slice):
+            iSamp = int(samples) + (nSamp if int(samples) < 0 else 0)
+            if not 0 <= iSamp < nSamp:
+                raise IndexError(f"index {samples} is out of bounds for axis 1 with size {nSamp}")
+            return self[chans, iSamp:iSamp + 1][..., 0]
+        first, last, step = samples.indices(nSamp)
+        if step < 0:
+            raise IndexError("negative steps are not supported")
+        if last <= first:
+            return np.zeros((self.shape[0], 0), self.dtype)[chans, :]
+        bounds = self.reader.chunk_bounds
+        pieces = []
+        for iChunk in range(bisect.bisect_right(bounds, first) - 1, bisect.bisect_right(bounds, last - 1)):
+            b0, b1 = bounds[iChunk], bounds[iChunk + 1]
+            pieces.append(self._chunk(iChunk)[max(first, b0) - b0:min(last, b1) - b0, chans])
+        return np.concatenate(pieces)[::step].T
+
+    def close(self):
+        self._cache.clear()
+        self._cachedBytes = 0
+        self.reader.close()
+
+
+# Tags that must be identical in the meta files of the segments of a
+# recording for their samples to be read on a common time axis.
+SEGMENT_TAGS = ('typeThis', 'nSavedChans', 'snsSaveChanSubset', 'imSampRate', 'niSampRate',
+                'imAiRangeMax', 'niAiRangeMax', 'snsApLfSy', 'snsMnMaXaDw', 'imroTbl', 'niMNGain', 'niMAGain')
+
+
+# Return the files of all the segments of the recording of binFullPath,
+# i.e. the files that differ by their _t trigger index only, ordered by
+# trigger index: x_g0_t0.imec.ap.bin, x_g0_t1.imec.ap.bin...
+#
+def SegmentFiles(binFullPath):
+    binFullPath = Path(binFullPath)
+    match = re.match(r'^(.*_g\d+_t)(\d+)(\..*)$', binFullPath.name)
+    if match is None:
+        return [binFullPath]
+    prefix, _, suffix = match.groups()
+    segments = {}
+    for f in binFullPath.parent.glob(f'{glob.escape(prefix)}*{suffix}'):
+        trigger = f.name[len(prefix):-len(suffix)]
+        if trigger.isdigit():
+            segments[int(trigger)] = f
+    return [segments[t] for t in sorted(segments)]
+
+
+# Virtual concatenation of the raw data of the segments of a recording on a
+# single time axis, with the slicing interface of the memmap returned by
+# makeMemMapRaw. The segments are memmaps or CbinRaw, see makeConcatRaw.
+# A slice reads each segment it overlaps, so that a read crossing a
+# boundary only copies the requested samples and a read within a segment
+# returns a view of its memmap. bounds[i] is the first sample of segment i
+# on the common time axis, use locate to map samples to (segment, offset).
+# The metadata of the segments are checked for consistency on SEGMENT_TAGS.
+#
+class ConcatRaw:
+
+    def __init__(self, raws, metas=None, files=None):
+        if len(raws) == 0:
+            raise ValueError("no segment to concatenate")
+        self.raws = list(raws)
+        self.metas = [_asMeta(m) for m in metas] if metas is not None else None
+        self.files = files
+        nChans = set(raw.shape[0] for raw in self.raws)
+        if len(nChans) > 1:
+            raise ValueError(f"the segments have different numbers of channels: {sorted(nChans)}")
+        for tag in SEGMENT_TAGS if self.metas else ():
+            values = [m.get(tag) for m in self.metas]
+            if any(v != values[0] for v in values):
+                raise ValueError(f"the segments have different {tag} in their meta files: {set(values)}")
+        self.bounds = np.cumsum([0] + [raw.shape[1] for raw in self.raws])
+        self.shape = (self.raws[0].shape[0], int(self.bounds[-1]))
+        self.dtype = self.raws[0].dtype
+        self.ndim = 2
+
+    # The metadata of the first segment, for the helpers taking a meta.
+    @property
+    def meta(self):
+        return self.metas[0] if self.metas else None
+
+    # Return the segment index and the sample index within the segment of
+    # samples of the common time axis.
+    def locate(self, samples):
+        samples = np.asarray(samples)
+        if np.any((samples < 0) | (samples >= self.shape[1])):
+            raise IndexError(f"sample out of bounds for axis 1 with size {self.shape[1]}")
+        iSeg = np.searchsorted(self.bounds, samples, side='right') - 1
+        return iSeg, samples - self.bounds[iSeg]
+
+    def __getitem__(self, item):
+        chans, samples = item if isinstance(item, tuple) else (item, slice(None))
+        if not isinstance(samples, slice):
+            iSamp = int(samples) + (self.shape[1] if int(samples) < 0 else 0)
+            iSeg, offset = self.locate(iSamp)
+            return self.raws[iSeg][chans, offset]
+        first, last, step = samples.indices(self.shape[1])
+        if step < 0:
+            raise IndexError("negative steps are not supported")
+        pieces = []
+        for iSeg, raw in enumerate(self.raws):
+            b0, b1 = self.bounds[iSeg], self.bounds[iSeg + 1]
+            if b1 <= first or b0 >= last:
+                continue
+            # first sample of the slice within this segment
+            start = first + -(-(max(first, b0) - first) // step) * step
+            if start < min(last, b1):
+                pieces.append(raw[chans, start - b0:min(last, b1) - b0:step])
+        if not pieces:
+            return np.zeros((self.shape[0], 0), self.dtype)[chans, :]
+        return pieces[0] if len(pieces) == 1 else np.concatenate(pieces, axis=-1)
+
+    def close(self):
+        for raw in self.raws:
+            if isinstance(raw, CbinRaw):
+                raw.close()
+
+
+# Return the raw data of all the segments of the recording of binFullPath
+# as a ConcatRaw, see SegmentFiles. The .bin and .cbin segments are read as
+# by makeMemMapRaw.
+#
+def makeConcatRaw(binFullPath):
+    files = SegmentFiles(binFullPath)
+    metas = [readMeta(f) for f in files]
+    return ConcatRaw([makeMemMapRaw(f, m) for f, m in zip(files, metas)], metas, files)
+
+
+# Yield the gain corrected voltages of the saved channels in chanList
+# between firstSamp and lastSamp inclusive, as consecutive float32 arrays
+# [channels X timepoints] of chunkSamp timepoints at most, so that long
+# ranges are converted at constant memory. The chunks are written into the
+# out buffer, of shape [channels X chunkSamp] at least and allocated once
+# if not given: a chunk is overwritten by the next one, copy it to keep it.
+#
+def GainCorrectChunks(rawData, chanList, firstSamp, lastSamp, meta, chunkSamp=2 ** 16, out=None):
+    chanList = np.asarray(chanList)
+    nChan = len(chanList)
+    if out is None:
+        out = np.empty((nChan, chunkSamp), dtype='float32')
+    elif out.dtype != np.float32 or out.shape[0] != nChan or out.shape[1] < chunkSamp:
+        raise ValueError(f"out must be a float32 array of at least {nChan} x {chunkSamp}")
+    conv = ChanConv(chanList, meta).astype('float32')[:, np.newaxis]
+    intBuf = np.empty((nChan, chunkSamp), dtype='int16')
+    lastSamp = min(lastSamp, rawData.shape[1] - 1)
+    for first in range(firstSamp, lastSamp + 1, chunkSamp):
+        n = min(chunkSamp, lastSamp + 1 - first)
+        np.take(rawData[:, first:first + n], chanList, axis=0, out=intBuf[:, :n])
+        np.multiply(intBuf[:, :n], conv, out=out[:, :n])
+        yield out[:, :n]
+
+
+# Return the vector of factors converting the saved channels in chanList
+# to volts, for imec or nidq files.
+#
+def ChanConv(chanList, meta):
+    return ChanConvIM(chanList, meta) if _asMeta(meta).isImec else ChanConvNI(chanList, meta)
+
+
+# Return the saved channel index of the digital word dwReq, None if the
+# file doesn't contain it.
+#
+def DigitalChan(dwReq, meta):
+    meta = _asMeta(meta)
+    if meta.isImec:
+        AP, LF, SY = ChannelCountsIM(meta)
+        if SY == 0:
+            print("No imec sync channel saved.")
+            return None
+        return AP + LF + dwReq
+    else:
+        MN, MA, XA, DW = ChannelCountsNI(meta)
+        if dwReq > DW - 1:
+            print("Maximum digital word in file = %d" % (DW - 1))
+            return None
+        return MN + MA + XA + dwReq
+
+
 # Return an array [lines X timepoints] of uint8 values for a
 # specified set of digital lines.
 #
@@ -236,24 +551,15 @@ def makeMemMapRaw(binFullPath, meta):
 # - dLineList is a zero-based list of one or more lines/bits
 #    to scan from word dwReq.
 #
+# The array takes one byte per line and timepoint, plus 16 bytes per
+# timepoint while unpacking: use ExtractDigitalEdges for long ranges.
+#
 def ExtractDigital(rawData, firstSamp, lastSamp, dwReq, dLineList, meta):
     # Get channel index of requested digial word dwReq
-    if meta['typeThis'] == 'imec':
-        AP, LF, SY = ChannelCountsIM(meta)
-        if SY == 0:
-            print("No imec sync channel saved.")
-            digArray = np.zeros(0, 'uint8')
-            return digArray
-        else:
-            digCh = AP + LF + dwReq
-    else:
-        MN, MA, XA, DW = ChannelCountsNI(meta)
-        if dwReq > DW - 1:
-            print("Maximum digital word in file = %d" % (DW - 1))
-            digArray = np.zeros(0, 'uint8')
-            return digArray
-        else:
-            digCh = MN + MA + XA + dwReq
+    digCh = DigitalChan(dwReq, meta)
+    if digCh is None:
+        digArray = np.zeros(0, 'uint8')
+        return digArray
 
     selectData = np.ascontiguousarray(rawData[digCh, firstSamp:lastSamp + 1], 'int16')
     nSamp = lastSamp - firstSamp + 1
@@ -273,6 +579,48 @@ def ExtractDigital(rawData, firstSamp, lastSamp, dwReq, dLineList, meta):
     return digArray
 
 
+# Return the transitions of a set of digital lines between firstSamp and
+# lastSamp inclusive, as three arrays sorted by sample:
+# - samples: index of the first sample in the new state
+# - lines: the line that changed, from dLineList
+# - polarities: 1 for a rising edge, -1 for a falling edge
+# The digital word is read by blocks of chunkSamp timepoints, and the state
+# of the last timepoint of a block is carried over to the next, so that the
+# memory used is bounded by the block size and the number of transitions.
+# As with np.diff on the output of ExtractDigital, the state at firstSamp
+# is the initial state and is not a transition.
+#
+def ExtractDigitalEdges(rawData, firstSamp, lastSamp, dwReq, dLineList, meta, chunkSamp=2 ** 20):
+    samples, lines, polarities = [np.zeros(0, 'int64')], [np.zeros(0, 'int64')], [np.zeros(0, 'int8')]
+    digCh = DigitalChan(dwReq, meta)
+    if digCh is None:
+        return samples[0], lines[0], polarities[0]
+
+    dLines = np.asarray(dLineList, dtype='int64')
+    mask = np.uint16(np.bitwise_or.reduce(1 << dLines))
+    lastSamp = min(lastSamp, rawData.shape[1] - 1)
+    prevWord = None
+    for first in range(firstSamp, lastSamp + 1, chunkSamp):
+        last = min(first + chunkSamp, lastSamp + 1)
+        words = np.ascontiguousarray(rawData[digCh, first:last], 'int16').view('uint16') & mask
+        if prevWord is None:
+            prevWord = words[0]
+        # timepoints whose word differs from the previous one, typically few
+        changed = np.flatnonzero(words != np.concatenate(([prevWord], words[:-1])))
+        if changed.size:
+            before = np.where(changed > 0, words[changed - 1], prevWord)
+            after = words[changed]
+            # bit of each line before and after each change, [changes X lines]
+            bitsBefore = (before[:, np.newaxis] >> dLines) & 1
+            bitsAfter = (after[:, np.newaxis] >> dLines) & 1
+            iChange, iLine = np.nonzero(bitsBefore != bitsAfter)
+            samples.append(first + changed[iChange])
+            lines.append(dLines[iLine])
+            polarities.append(np.where(bitsAfter[iChange, iLine] == 1, 1, -1).astype('int8'))
+        prevWord = words[-1]
+    return np.concatenate(samples), np.concatenate(lines), np.concatenate(polarities)
+
+
 # Sample calling program to get a file from the user,
 # read metadata fetch sample rate, voltage conversion
 # values for this file and channel, and plot a small range
@@ -309,7 +657,7 @@ def main():
     # For 3B2 imec data: the sync pulse is stored in line 6.
     dLineList = [0, 1, 6]
 
-    # Read in metadata; returns a dictionary with string for values
+    # Read in metadata; returns a SGLXMeta, a dictionary with string for values
     meta = readMeta(binFullPath)
 
     # parameters common to NI and imec data
@@ -13,7 +13,7 @@ import ibllib.io.spikeglx
 from ibllib.time import convert_pgts, uncycle_pgts
 import ibllib.plots
 
-from DemoReadSGLXData.readSGLX import readMeta, SampRate, makeMemMapRaw, ExtractDigital
+from DemoReadSGLXData.readSGLX import readMeta, SampRate, makeMemMapRaw, ExtractDigitalEdges
 
 SHOW_PLOTS = False
 _logger = logging.getLogger('ibllib')
@@ -74,6 +74,14 @@ ephys - for both probes
 
 
 def get_3b_sync_signal(binFullPath):
+    """
+    Transitions of the sync lines of the nidq file, read in blocks so that
+    the whole recording is scanned in constant memory.
+    The times are those of the last sample before each transition, as
+    previously obtained with np.diff on the sampled values of the lines.
+
+    :return: dict {label: {'times': seconds, 'polarities': 1 or -1}}
+    """
 
     # For a digital channel: zero based index of the digital word in
     # the saved file. For imec data there is never more than one digital word.
@@ -96,18 +104,26 @@ def get_3b_sync_signal(binFullPath):
     lastSamp = int(sRate * tEnd)
 
     rawData = makeMemMapRaw(binFullPath, meta)
-    digArray = ExtractDigital(rawData, firstSamp, lastSamp, dw,
-                              dLineList, meta)
+    samples, lines, polarities = ExtractDigitalEdges(rawData, firstSamp, lastSamp, dw,
+                                                     dLineList, meta)
     sync = {}
 
     # save it in sec
     for i in range(len(dlabel)):
+        iline = lines == dLineList[i]
         sync[dlabel[i]] = {}
-        sync[dlabel[i]]['timeStampsSec'] = np.arange(len(digArray[i])) / sRate
-        sync[dlabel[i]]['values'] = digArray[i]
+        sync[dlabel[i]]['times'] = (samples[iline] - 1 - firstSamp) / sRate
+        sync[dlabel[i]]['polarities'] = polarities[iline]
     return sync
 
 
+def get_up_fronts(sync, label):
+    """
+    Times in seconds of the up fronts of a sync line, see get_3b_sync_signal
+    """
+    return sync[label]['times'][sync[label]['polarities'] == 1]
+
+
 def get_ephys_data(raw_ephys_apfile):
     """
     That's the analog signal from the ap.bin file
@@ -165,8 +181,7 @@ def front_extraction_from_arduino_and_ephys(sr, sync):
     sync_fronts = {}
 
     # This is to correct for different sampling rates
-    diffs = np.diff(sync['Arduino']['values'])
-    sync_fronts['fpga up fronts'] = sync['Arduino']['timeStampsSec'][np.where(diffs == 1)[0]]
+    sync_fronts['fpga up fronts'] = get_up_fronts(sync, 'Arduino')
 
     # get times of fronts in smaples at 30 kHz for comparison
     sync_fronts['fpga up fronts'] = sync_fronts['fpga up fronts'] * sr.fs
@@ -317,16 +332,14 @@ def evaluate_camera_sync(d, sync, show_plots=SHOW_PLOTS):
         '_iblrig_leftCamera.raw.avi': 'Cam60Hz'}
 
     # get arduino sync signal in sec
-    diffs = np.diff(sync['Arduino']['values'])
-    s3 = sync['Arduino']['timeStampsSec'][np.where(diffs == 1)[0]]
+    s3 = get_up_fronts(sync, 'Arduino')
 
     for vid in d:
         # threshold brightness time-series of the camera to have it in {-1,1}
         r3 = [1 if x > np.mean(d[vid][0]) else -1 for x in d[vid][0]]
 
         # fpga cam time stamps
-        diffs = np.diff(sync[y[vid]]['values'])
-        cam_times = sync[y[vid]]['timeStampsSec'][np.where(diffs == 1)[0]]
+        cam_times = get_up_fronts(sync, y[vid])
 
         # assuming at the end the frames are dropped
         drops = len(cam_times) - len(r3)
@@ -411,8 +424,7 @@ def compare_bpod_json_with_fpga(sync_test_folder, sync, show_plots=SHOW_PLOTS):
     assert len(ups) == 500, 'not all pulses detected in bpod!'
 
     # get the fpga signal from sync
-    diffs = np.diff(sync['Arduino']['values'])
-    s3 = sync['Arduino']['timeStampsSec'][np.where(diffs == 1)[0]]
+    s3 = get_up_fronts(sync, 'Arduino')
 
     assert len(s3) == 500, 'not all fronts detected in fpga signal!'
 
@@ -0,0 +1,87 @@
+"""
+Benchmark of the session globbing used by the maintenance jobs.
+
+Builds a synthetic Subjects tree (subject/yyyy-mm-dd/nnn with a few files per session, and a
+photometry yaml in a fraction of the sessions), then times the search of the photometry yaml with:
+    - the previous serial glob_sessions_fast implementation
+    - Path.rglob over the whole tree
+    - the parallel scandir walker of session_walker.py, unordered and ordered
+
+python benchmark_glob_sessions.py /mnt/h0/bench_subjects --n-sessions 100000 --threads 4 16 32
+The tree is kept and reused by subsequent runs with the same path and size. On a network volume,
+drop the page cache between runs (echo 3 > /proc/sys/vm/drop_caches) to measure cold walks.
+"""
+import argparse
+from datetime import date, timedelta
+from pathlib import Path
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).parents[1].joinpath('crontab')))
+from session_walker import glob_sessions  # noqa
+
+PATTERN = '_device/photometry_00.yaml'
+
+
+def legacy_glob_sessions(pattern, root_path):
+    """glob_sessions_fast of maintenance_jobs.py before the parallel walker"""
+    for sub_dir in root_path.glob('*'):
+        if not sub_dir.is_dir():
+            continue
+        for date_dir in sub_dir.glob('20*'):
+            if not date_dir.is_dir():
+                continue
+            for session_path in date_dir.glob('0*'):
+                if not session_path.is_dir():
+                    continue
+                for fn in session_path.glob(pattern):
+                    yield fn
+
+
+def build_tree(root_path, n_sessions, sessions_per_subject=200, photometry_every=50):
+    """Creates the synthetic tree, unless a tree of the same size already exists"""
+    root_path = Path(root_path)
+    stamp = root_path.joinpath('.bench_tree')
+    if stamp.exists() and stamp.read_text() == str(n_sessions):
+        return
+    print(f'Building {n_sessions} sessions in {root_path}')
+    for i in range(n_sessions):
+        subject, n = divmod(i, sessions_per_subject)
+        day, number = divmod(n, 2)
+        session_path = root_path.joinpath(f'SUB_{subject:04d}', str(date(2020, 1, 1) + timedelta(days=day)),
+                                          f'{number + 1:03d}')
+        session_path.joinpath('raw_behavior_data').mkdir(parents=True, exist_ok=True)
+        session_path.joinpath('raw_behavior_data', '_iblrig_taskSettings.raw.json').touch()
+        session_path.joinpath('raw_session.flag').touch()
+        if i % photometry_every == 0:
+            session_path.joinpath('_device').mkdir(exist_ok=True)
+            session_path.joinpath('_device', 'photometry_00.yaml').touch()
+    stamp.write_text(str(n_sessions))
+
+
+def timeit(label, func, reference=None):
+    tstart = time.perf_counter()
+    files = sorted(func())
+    duration = time.perf_counter() - tstart
+    check = '' if reference is None else ('OK' if files == reference else 'MISMATCH')
+    print(f'{label:<36} {duration:8.2f} s {len(files):8d} files {check}')
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the session globbing of the maintenance jobs')
+    parser.add_argument('root_path', help='Folder of the synthetic Subjects tree')
+    parser.add_argument('--n-sessions', default=100000, type=int, help='Number of sessions [100000]')
+    parser.add_argument('--threads', default=[16], type=int, nargs='+', help='Numbers of threads of the walker [16]')
+    parser.add_argument('--skip-rglob', action='store_true', help='Skip the (slow) rglob run')
+    args = parser.parse_args()
+    root_path = Path(args.root_path)
+    build_tree(root_path, args.n_sessions)
+
+    reference = timeit('legacy glob_sessions_fast', lambda: legacy_glob_sessions(PATTERN, root_path))
+    if not args.skip_rglob:
+        timeit('Path.rglob', lambda: root_path.rglob(PATTERN), reference)
+    for n in args.threads:
+        timeit(f'session_walker {n} threads', lambda: glob_sessions(PATTERN, root_path, n_threads=n), reference)
+        timeit(f'session_walker {n} threads ordered',
+               lambda: glob_sessions(PATTERN, root_path, n_threads=n, ordered=True), reference)
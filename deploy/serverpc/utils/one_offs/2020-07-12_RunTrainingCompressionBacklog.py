@@ -1,15 +1,22 @@
 from pathlib import Path
+import sys
 
 import ibllib.io.extractors.base
 from oneibl.one import ONE
 import alf.io
 from ibllib.pipes import training_preprocessing
 
+sys.path.insert(0, str(Path(__file__).parents[2].joinpath('crontab')))
+from io_governor import get_governor  # noqa
+
 ROOT_PATH = Path('/mnt/s0/Data/Subjects')
 DRY = False
 
 avi_files = ROOT_PATH.rglob('_iblrig_leftCamera.raw.avi')
 one = ONE()
+# with IBL_IO_IDLE set, the compression runs in the idle I/O class, inherited by ffmpeg. NB: the
+# videos are read and written by ffmpeg, outside of the I/O budget of the governor
+get_governor()
 
 for avi_file in avi_files:
     session_path = alf.io.get_session_path(avi_file)